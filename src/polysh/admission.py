@@ -0,0 +1,222 @@
+"""Polysh - Connection Admission
+
+Starting the ssh processes of a large fleet all at once overloads the local
+CPU, the bastions and the MaxStartups limit of the remote sshd.  The hosts
+wait in a queue and are started only while fewer than --max-handshakes of
+the started ones are still connecting, and no faster than --connect-rate per
+second.  A connection is done with its handshake when its remote shell
+leaves the not_started state.  With --parallel, at most that many shells are
+alive at the same time, each dead shell leaving its place to the next host.
+
+Even without limits, the hosts are started by batches between which the
+event loop runs, so that the first shells connect while the next ones are
+being started.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import sys
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+
+from polysh import display_names, event_loop
+from polysh.console import console_output
+from polysh.exceptions import ExitNow
+
+# The hosts waiting to be started as (hostname, port, display name), in
+# order.  The display names are reserved when queued, so that they are the
+# same as without the queue.  A port of None only takes the color of a host
+# started by another sharded worker, at the same place in the order.
+_pending = collections.deque()  # type: Deque[Tuple[str, Optional[str], str]]
+
+# The number of started shells still connecting
+_nr_handshakes = 0
+
+# The number of started shells not dead yet
+_nr_alive = 0
+
+# The earliest time of the next start with --connect-rate
+_next_start = 0.0
+
+# Pending admission once the rate allows the next start, or after the event
+# loop ran between two batches
+_timer = None  # type: Optional[event_loop.Timer]
+
+# The number of shells started between two event loop iterations
+START_BATCH = 32
+_nr_started_in_batch = 0
+
+# The hosts submitted and started since the queue was last empty
+_nr_submitted = 0
+_nr_started = 0
+
+# A host failed to start with --abort-errors, no more hosts are started
+_aborting = False
+
+# In the coordinator of interactive sharded workers, the hosts started and
+# submitted by each worker, as last reported
+_shard_progress = {}  # type: Dict[int, Tuple[int, int]]
+
+
+def submit(hosts: List[Tuple[str, str]]) -> None:
+    """Start remote shells for the (hostname, port) as soon as the limits
+    allow it"""
+    global _nr_submitted, _nr_started
+    if _nr_started == _nr_submitted:
+        _nr_submitted = _nr_started = 0
+    _nr_submitted += len(hosts)
+    for hostname, port in hosts:
+        _pending.append(
+            (hostname, port, display_names.change(None, hostname))
+        )
+    admit()
+
+
+def reserve(hostname: str) -> None:
+    """Take the display name and color of a host started elsewhere"""
+    _pending.append((hostname, None, display_names.change(None, hostname)))
+    admit()
+
+
+def nr_pending() -> int:
+    """The number of hosts not started yet"""
+    started, submitted = progress()
+    return submitted - started
+
+
+def progress() -> Tuple[int, int]:
+    """The number of hosts started and submitted since the queue was last
+    empty"""
+    started, submitted = _nr_started, _nr_submitted
+    for shard_started, shard_submitted in _shard_progress.values():
+        started += shard_started
+        submitted += shard_submitted
+    return started, submitted
+
+
+def set_shard_progress(shard: int, started: int, submitted: int) -> None:
+    """The progress reported by a sharded worker to its coordinator"""
+    _shard_progress[shard] = started, submitted
+
+
+def shard_submitted(shard: int, nr_hosts: int) -> None:
+    """The coordinator sent hosts to start to a sharded worker"""
+    started, submitted = _shard_progress.get(shard, (0, 0))
+    _shard_progress[shard] = started, submitted + nr_hosts
+
+
+def handshake_done() -> None:
+    """A started shell is done connecting, successfully or not"""
+    global _nr_handshakes
+    _nr_handshakes -= 1
+    admit()
+
+
+def shell_dead() -> None:
+    """A started shell is dead, its ssh process is gone or killed"""
+    global _nr_alive
+    _nr_alive -= 1
+    admit()
+
+
+def _take_color() -> None:
+    from polysh import remote_dispatcher
+
+    if not remote_dispatcher.options.disable_color:
+        colors = remote_dispatcher.COLORS
+        colors.insert(0, colors.pop())
+
+
+def _start_failed(hostname: str, display_name: str, error: OSError) -> None:
+    global _aborting
+    from polysh import remote_dispatcher
+
+    # Like the dead shells, its name stays taken but is not aligned
+    display_names.set_enabled(display_name, False)
+    options = remote_dispatcher.options
+    options.exit_code = max(options.exit_code, 1)
+    msg = f'Failed to start {hostname}: {error}\n'
+    if options.format == 'jsonl':
+        # Keep stdout parseable
+        sys.stderr.write(msg)
+    else:
+        console_output(msg.encode())
+    if options.abort_error:
+        _aborting = True
+        # Raised from the event loop, where the main loop handles it, as the
+        # first hosts are started before
+        event_loop.call_later(0, _abort)
+
+
+def _abort() -> None:
+    raise ExitNow(1)
+
+
+def _schedule(delay: float) -> None:
+    global _timer
+    if _timer is None:
+        _timer = event_loop.call_later(delay, _timer_expired)
+
+
+def _timer_expired() -> None:
+    global _timer, _nr_started_in_batch
+    _timer = None
+    _nr_started_in_batch = 0
+    admit()
+
+
+def admit() -> None:
+    """Start the pending hosts allowed by the limits"""
+    global _nr_handshakes, _nr_alive, _next_start
+    global _nr_started_in_batch, _nr_started
+    from polysh import remote_dispatcher
+
+    options = remote_dispatcher.options
+    while _pending and not _aborting:
+        hostname, port, display_name = _pending[0]
+        if port is None:
+            _pending.popleft()
+            _take_color()
+            continue
+        if options.max_handshakes and _nr_handshakes >= options.max_handshakes:
+            # Resumed by handshake_done()
+            return
+        if options.parallel and _nr_alive >= options.parallel:
+            # Resumed by shell_dead()
+            return
+        if options.connect_rate:
+            now = time.monotonic()
+            if now < _next_start:
+                _schedule(_next_start - now)
+                return
+        if _nr_started_in_batch >= START_BATCH:
+            # Let the event loop read the shells started so far
+            _schedule(0)
+            return
+        if options.connect_rate:
+            _next_start = now + 1 / options.connect_rate
+        _pending.popleft()
+        _nr_started_in_batch += 1
+        _nr_started += 1
+        try:
+            remote_dispatcher.RemoteDispatcher(hostname, port, display_name)
+        except OSError as e:
+            # The failure is for this host only, not for the shell whose
+            # state change may have started it
+            _start_failed(hostname, display_name, e)
+            continue
+        _nr_handshakes += 1
+        _nr_alive += 1
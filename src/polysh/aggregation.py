@@ -0,0 +1,185 @@
+"""Polysh - Output Aggregation
+
+With many hosts, the output of a command is often the same on most of them.
+When aggregating, the output of each host is hashed as it arrives instead of
+being printed.  Once the command completed everywhere, each distinct output
+is printed once, with the list of the hosts that printed it.  Only the
+beginning of each output is kept in memory to be printed, in a tree of lines
+shared by the outputs that started with the same lines.  A host only keeps
+the digest of its output and its last line in the tree.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+from typing import Any, Dict, List, Optional
+
+from polysh.console import console_output
+from polysh.host_syntax import compress_syntax
+
+# The part of each distinct output kept to be printed
+MAX_SAMPLE_SIZE = 64 * 1024
+
+# The memory of the lines of all the samples, with the many hosts printing
+# distinct outputs
+MAX_SAMPLES_MEMORY = 16 * 1024 * 1024
+
+# Roughly the memory used by a line besides its bytes
+_LINE_OVERHEAD = 128
+
+
+class _Line:
+    """A line of the samples, after the same previous lines"""
+
+    __slots__ = ('previous', 'data', 'sample_size', 'next_lines')
+
+    def __init__(self, previous: Optional['_Line'], data: bytes) -> None:
+        self.previous = previous
+        self.data = data
+        self.sample_size = len(data)
+        if previous is not None:
+            self.sample_size += previous.sample_size
+        self.next_lines = None  # type: Optional[Dict[bytes, _Line]]
+
+
+# The first lines of the samples
+_first_lines = {}  # type: Dict[bytes, _Line]
+
+# The memory used by the lines of the samples
+_samples_memory = 0
+
+
+class _Output:
+    """The output of a host, or of a group of hosts with the same output"""
+
+    __slots__ = ('hash', 'last_line', 'sampling', 'size', 'names')
+
+    def __init__(self) -> None:
+        self.hash = hashlib.blake2b(digest_size=16)
+        # The end of the sample in the tree of lines
+        self.last_line = None  # type: Optional[_Line]
+        self.sampling = True
+        self.size = 0
+        self.names = []  # type: List[str]
+
+    def sample(self) -> bytes:
+        lines = []
+        line = self.last_line
+        while line is not None:
+            lines.append(line.data)
+            line = line.previous
+        return b''.join(reversed(lines))
+
+    def sample_size(self) -> int:
+        if self.last_line is None:
+            return 0
+        return self.last_line.sample_size
+
+    def add(self, lines: List[bytes]) -> None:
+        data = b'\n'.join(lines) + b'\n'
+        self.hash.update(data)
+        self.size += len(data)
+        if self.sampling:
+            self._add_to_sample(lines)
+
+    def _add_to_sample(self, lines: List[bytes]) -> None:
+        global _samples_memory
+        last_line = self.last_line
+        for data in lines:
+            if last_line is None:
+                next_lines = _first_lines
+                sample_size = 0
+            else:
+                if last_line.next_lines is None:
+                    last_line.next_lines = {}
+                next_lines = last_line.next_lines
+                sample_size = last_line.sample_size
+            data += b'\n'
+            if sample_size + len(data) > MAX_SAMPLE_SIZE:
+                data = data[: MAX_SAMPLE_SIZE - sample_size]
+            line = next_lines.get(data)
+            if line is None:
+                memory = len(data) + _LINE_OVERHEAD
+                if _samples_memory + memory > MAX_SAMPLES_MEMORY:
+                    # The sample of this output stays truncated
+                    self.sampling = False
+                    break
+                _samples_memory += memory
+                line = next_lines[data] = _Line(last_line, data)
+            last_line = line
+            if line.sample_size >= MAX_SAMPLE_SIZE:
+                self.sampling = False
+                break
+        self.last_line = last_line
+
+
+# The output of the commands still running, by remote dispatcher
+_running = {}  # type: Dict[Any, _Output]
+
+# The output of the completed commands, by digest
+_completed = {}  # type: Dict[bytes, _Output]
+
+
+def add_lines(shell: Any, lines: List[bytes]) -> None:
+    """Some output lines of the command running on shell"""
+    output = _running.get(shell)
+    if output is None:
+        output = _running[shell] = _Output()
+    output.add(lines)
+
+
+def command_done(shell: Any) -> None:
+    """The command completed on shell, possibly without any output"""
+    output = _running.pop(shell, None) or _Output()
+    group = _completed.setdefault(output.hash.digest(), output)
+    if output.sample_size() > group.sample_size():
+        # Truncated by the memory of the samples in the first host
+        group.last_line = output.last_line
+    group.names.append(shell.display_name)
+
+
+def print_results() -> None:
+    """Print each distinct output once, the still running commands are
+    considered completed"""
+    global _samples_memory
+    for shell in list(_running):
+        command_done(shell)
+    if not _completed:
+        return
+    groups = sorted(
+        _completed.values(), key=lambda g: (-len(g.names), sorted(g.names))
+    )
+    _completed.clear()
+    _first_lines.clear()
+    _samples_memory = 0
+    for group in groups:
+        nr_hosts = len(group.names)
+        hosts = ' '.join(compress_syntax(sorted(group.names)))
+        plural = '' if nr_hosts == 1 else 's'
+        msg = f'{hosts} ({nr_hosts} host{plural}):\n'.encode()
+        group_sample = group.sample()
+        if not group.size:
+            msg += b'(no output)\n'
+        elif group.size == len(group_sample):
+            msg += group_sample
+        else:
+            # Truncated, at a line boundary if possible
+            sample = group_sample[: group_sample.rfind(b'\n') + 1]
+            not_shown = group.size - len(sample)
+            if not sample:
+                sample = group_sample + b'\n'
+                not_shown = group.size - len(group_sample)
+            msg += sample + f'[{not_shown} more bytes]\n'.encode()
+        console_output(msg)
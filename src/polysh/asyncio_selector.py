@@ -0,0 +1,186 @@
+"""Polysh - asyncio Selector
+
+Implements the selectors API on top of an asyncio event loop, so that the
+polysh event loop can run its dispatchers on asyncio with
+loop.add_reader()/add_writer().  Anything else scheduled on the same asyncio
+loop (coroutines, call_later() timers) runs while polysh waits for events.
+
+select() runs the asyncio loop itself, while it is not running.  When polysh
+is embedded in an application already running the asyncio loop, the events
+are awaited with wait() instead, see main.run_async().
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import selectors
+import types
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+
+def _fileobj_to_fd(fileobj: Any) -> int:
+    if isinstance(fileobj, int):
+        return fileobj
+    return fileobj.fileno()
+
+
+class AsyncioSelector(selectors.BaseSelector):
+    """A selector whose select() runs an asyncio event loop, or whose wait()
+    awaits on the running one, until one of the registered file descriptors
+    is ready or the timeout expires"""
+
+    def __init__(
+        self, loop: Optional[asyncio.AbstractEventLoop] = None
+    ) -> None:
+        self._own_loop = loop is None
+        self._loop = loop or asyncio.new_event_loop()
+        self._keys = {}  # type: Dict[int, selectors.SelectorKey]
+        # Events reported by the asyncio loop, not yet returned by select()
+        self._ready = {}  # type: Dict[int, int]
+        self._wakeup = None  # type: Optional[asyncio.Future]
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The asyncio event loop running the polysh dispatchers"""
+        return self._loop
+
+    def _on_event(self, fd: int, event: int) -> None:
+        self._ready[fd] = self._ready.get(fd, 0) | event
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def _add_callbacks(self, key: selectors.SelectorKey) -> None:
+        if key.events & selectors.EVENT_READ:
+            self._loop.add_reader(
+                key.fd, self._on_event, key.fd, selectors.EVENT_READ
+            )
+        if key.events & selectors.EVENT_WRITE:
+            self._loop.add_writer(
+                key.fd, self._on_event, key.fd, selectors.EVENT_WRITE
+            )
+
+    def _remove_callbacks(self, key: selectors.SelectorKey) -> None:
+        if key.events & selectors.EVENT_READ:
+            self._loop.remove_reader(key.fd)
+        if key.events & selectors.EVENT_WRITE:
+            self._loop.remove_writer(key.fd)
+
+    def register(
+        self, fileobj: Any, events: int, data: Any = None
+    ) -> selectors.SelectorKey:
+        if not events or events & ~(
+            selectors.EVENT_READ | selectors.EVENT_WRITE
+        ):
+            raise ValueError(f'Invalid events: {events!r}')
+        fd = _fileobj_to_fd(fileobj)
+        if fd in self._keys:
+            raise KeyError(f'{fileobj!r} (FD {fd}) is already registered')
+        key = selectors.SelectorKey(fileobj, fd, events, data)
+        self._keys[fd] = key
+        self._add_callbacks(key)
+        return key
+
+    def unregister(self, fileobj: Any) -> selectors.SelectorKey:
+        fd = _fileobj_to_fd(fileobj)
+        key = self._keys.pop(fd)
+        self._remove_callbacks(key)
+        self._ready.pop(fd, None)
+        return key
+
+    def modify(
+        self, fileobj: Any, events: int, data: Any = None
+    ) -> selectors.SelectorKey:
+        fd = _fileobj_to_fd(fileobj)
+        old_key = self._keys[fd]
+        if events == old_key.events:
+            key = old_key._replace(data=data)
+            self._keys[fd] = key
+            return key
+        self.unregister(fileobj)
+        return self.register(fileobj, events, data)
+
+    def select(
+        self, timeout: Optional[float] = None
+    ) -> List[Tuple[selectors.SelectorKey, int]]:
+        if self._loop.is_running():
+            raise RuntimeError(
+                'The asyncio event loop is already running, use wait()'
+            )
+        if not self._ready:
+            timer = self._arm_wakeup(timeout)
+            try:
+                self._loop.run_until_complete(self._wakeup)
+            finally:
+                self._disarm_wakeup(timer)
+        return self._pop_ready()
+
+    async def wait(
+        self, timeout: Optional[float] = None
+    ) -> List[Tuple[selectors.SelectorKey, int]]:
+        """Like select(), from a coroutine running on our asyncio loop"""
+        if not self._ready:
+            timer = self._arm_wakeup(timeout)
+            try:
+                await self._wakeup
+            finally:
+                self._disarm_wakeup(timer)
+        return self._pop_ready()
+
+    def _arm_wakeup(
+        self, timeout: Optional[float]
+    ) -> Optional[asyncio.TimerHandle]:
+        self._wakeup = self._loop.create_future()
+        if timeout is None:
+            return None
+        return self._loop.call_later(
+            max(timeout, 0), self._on_timeout, self._wakeup
+        )
+
+    def _disarm_wakeup(self, timer: Optional[asyncio.TimerHandle]) -> None:
+        if timer is not None:
+            timer.cancel()
+        self._wakeup = None
+
+    def _pop_ready(self) -> List[Tuple[selectors.SelectorKey, int]]:
+        ready = []
+        for fd, events in self._ready.items():
+            key = self._keys.get(fd)
+            if key is not None and events & key.events:
+                ready.append((key, events & key.events))
+        self._ready.clear()
+        return ready
+
+    @staticmethod
+    def _on_timeout(wakeup: asyncio.Future) -> None:
+        if not wakeup.done():
+            wakeup.set_result(None)
+
+    def get_key(self, fileobj: Any) -> selectors.SelectorKey:
+        fd = _fileobj_to_fd(fileobj)
+        try:
+            return self._keys[fd]
+        except KeyError:
+            raise KeyError(f'{fileobj!r} is not registered') from None
+
+    def get_map(self) -> Mapping[int, selectors.SelectorKey]:
+        return types.MappingProxyType(self._keys)
+
+    def close(self) -> None:
+        for key in list(self._keys.values()):
+            self._remove_callbacks(key)
+        self._keys.clear()
+        self._ready.clear()
+        if self._own_loop and not self._loop.is_closed():
+            self._loop.close()
@@ -16,14 +16,15 @@ Copyright (c) 2024 InnoGames GmbH
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import errno
 import fcntl
+import itertools
 import os
 import sys
+from typing import Callable, Deque, List, Optional, Set, Union
 
 from polysh import dispatcher_registry
-from polysh.console import console_output
-from polysh.exceptions import ExitNow
 
 _TRACE = os.environ.get('POLYSH_TRACE')
 
@@ -33,6 +34,75 @@ def _trace(msg: str) -> None:
         print(f'[trace] {msg}', file=sys.stderr, flush=True)
 
 
+# Maximum number of segments in a single writev()
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+if IOV_MAX <= 0:
+    IOV_MAX = 16
+
+# The reads go there, only the bytes read are appended to the read buffer
+_READ_SCRATCH = memoryview(bytearray(64 * 1024))
+
+# fds of the dispatchers whose write queue went above their high-water mark
+# and did not drain below their low-water mark yet
+_congested = set()  # type: Set[int]
+# Called once no write queue is congested anymore
+_drained_callbacks = []  # type: List[Callable[[], None]]
+
+
+def congested() -> bool:
+    """Is any write queue above its high-water mark?"""
+    return bool(_congested)
+
+
+def when_drained(callback: Callable[[], None]) -> None:
+    """Call callback now if no write queue is congested, or else as soon as
+    they all drained below their low-water mark.  This is how producers of
+    data for the remote shells are paused."""
+    if _congested:
+        _drained_callbacks.append(callback)
+    else:
+        callback()
+
+
+# Set while the console output cannot keep up, see pause_reads()
+_reads_paused = False
+
+
+def pause_reads(paused: bool) -> None:
+    """Stop or restart reading from all the buffered dispatchers.  Their
+    output goes to the console, so this propagates the pressure of a slow
+    console to the remote shells."""
+    global _reads_paused
+    if paused != _reads_paused:
+        _trace(f'pause_reads: {paused}')
+        _reads_paused = paused
+        dispatcher_registry.mark_all_dirty()
+
+
+def reads_paused() -> bool:
+    """Are the reads stopped by a slow console?"""
+    return _reads_paused
+
+
+def _set_congested(fd: int, is_congested: bool) -> None:
+    global _drained_callbacks
+    if is_congested:
+        _trace(f'fd={fd}: write queue congested')
+        _congested.add(fd)
+        return
+    if fd not in _congested:
+        return
+    _trace(f'fd={fd}: write queue drained')
+    _congested.remove(fd)
+    if not _congested:
+        callbacks, _drained_callbacks = _drained_callbacks, []
+        for callback in callbacks:
+            callback()
+
+
 class BufferedDispatcher:
     """A dispatcher with a write buffer to allow asynchronous writers, and a
     read buffer to permit line oriented manipulations"""
@@ -40,10 +110,36 @@ class BufferedDispatcher:
     # 1 MiB should be enough for everybody
     MAX_BUFFER_SIZE = 1 * 1024 * 1024
 
+    # Flow control: the producers are paused when the write queue grows above
+    # WRITE_HIGH_WATER, and resumed when it drains below WRITE_LOW_WATER
+    WRITE_HIGH_WATER = MAX_BUFFER_SIZE
+    WRITE_LOW_WATER = MAX_BUFFER_SIZE // 4
+
+    # Bounds of the size of a single read from the file descriptor, it grows
+    # while reads fill it and shrinks for interactive trickle
+    MIN_READ_SIZE = 1024
+    MAX_READ_SIZE = len(_READ_SCRATCH)
+
     def __init__(self, fd: int) -> None:
         self.fd = fd
-        self.read_buffer = b''
-        self.write_buffer = b''
+        # Data is appended at the end of read_buffer and consumed from
+        # read_offset, the consumed part is dropped only once in a while.
+        self.read_buffer = bytearray()
+        self.read_offset = 0
+        # Position of read_buffer[0] in everything read so far, for the
+        # positions that must survive the dropping of consumed data
+        self.read_base = 0
+        # Position before which the data not consumed yet has no newline
+        self.newline_scan_pos = 0
+        self.read_size = 4096
+        # Statistics shown by :show_read_stats
+        self.nr_read_syscalls = 0
+        self.nr_read_bytes = 0
+        # Segments waiting to be written, partial writes only slice the
+        # first one
+        self.write_queue = collections.deque()  # type: Deque[memoryview]
+        self.write_queue_size = 0
+        self.write_congested = False
 
         # Set non-blocking mode
         flags = fcntl.fcntl(fd, fcntl.F_GETFL)
@@ -52,82 +148,207 @@ class BufferedDispatcher:
         # Register with the dispatcher registry
         dispatcher_registry.register(fd, self)
 
-    def recv(self, buffer_size: int) -> bytes:
-        """Read from the file descriptor."""
-        return os.read(self.fd, buffer_size)
+    def recv_into(self, buffer: memoryview) -> int:
+        """Read from the file descriptor into buffer."""
+        return os.readv(self.fd, [buffer])
+
+    def send_segments(self, segments: List[memoryview]) -> int:
+        """Write the segments to the file descriptor with a single system
+        call."""
+        return os.writev(self.fd, segments)
+
+    def send_queued(self) -> int:
+        """Write as much of the write queue as possible with a single
+        writev() and return the number of bytes written."""
+        segments = list(itertools.islice(self.write_queue, IOV_MAX))
+        num_sent = self.send_segments(segments)
+        self.write_queue_size -= num_sent
+        remaining = num_sent
+        while remaining:
+            segment = self.write_queue[0]
+            if remaining < len(segment):
+                self.write_queue[0] = segment[remaining:]
+                break
+            self.write_queue.popleft()
+            remaining -= len(segment)
+        if self.write_queue_size <= self.WRITE_LOW_WATER:
+            self._set_write_congested(False)
+        return num_sent
+
+    def clear_write_queue(self) -> None:
+        self.write_queue.clear()
+        self.write_queue_size = 0
+        self._set_write_congested(False)
 
-    def send(self, data: bytes) -> int:
-        """Write to the file descriptor."""
-        return os.write(self.fd, data)
+    def _set_write_congested(self, congested: bool) -> None:
+        if congested != self.write_congested:
+            self.write_congested = congested
+            self.write_congestion_changed(congested)
+
+    def write_congestion_changed(self, congested: bool) -> None:
+        """The write queue went above WRITE_HIGH_WATER, or drained below
+        WRITE_LOW_WATER: pause or resume the producers"""
+        _set_congested(self.fd, congested)
 
     def close(self) -> None:
         """Unregister and close the file descriptor."""
+        self._set_write_congested(False)
         dispatcher_registry.unregister(self.fd)
         try:
             os.close(self.fd)
         except OSError:
             pass
 
+    def update_interest(self) -> None:
+        """Our readable()/writable() answers may have changed outside of our
+        own handlers, ask the event loop to re-evaluate them"""
+        dispatcher_registry.mark_dirty(self.fd)
+
+    def read_buffer_size(self) -> int:
+        """Number of bytes read but not consumed yet"""
+        return len(self.read_buffer) - self.read_offset
+
+    def _read_data(self, start: int, end: Optional[int] = None) -> bytes:
+        """Copy of read_buffer[start:end], without an intermediate bytearray"""
+        with memoryview(self.read_buffer)[start:end] as data:
+            return bytes(data)
+
+    def consume_read(self, end: int) -> None:
+        """Mark the read data up to the end offset as consumed"""
+        if end >= len(self.read_buffer):
+            self.clear_read_buffer()
+            return
+        self.read_offset = end
+        if end > len(self.read_buffer) // 2:
+            # Compact when most of the buffer is consumed, so each byte is
+            # moved at most once on average
+            del self.read_buffer[:end]
+            self.read_base += end
+            self.read_offset = 0
+
+    def _find_newline(self, last: bool = False) -> int:
+        """Index in read_buffer of the first, or last, newline not consumed
+        yet, or -1.  The data already searched in vain is skipped, so that a
+        long line arriving in many reads is not searched again and again."""
+        start = max(self.read_offset, self.newline_scan_pos - self.read_base)
+        if last:
+            pos = self.read_buffer.rfind(b'\n', start)
+        else:
+            pos = self.read_buffer.find(b'\n', start)
+        if pos < 0:
+            self.newline_scan_pos = self.read_base + len(self.read_buffer)
+        return pos
+
+    def clear_read_buffer(self) -> None:
+        self.read_base += len(self.read_buffer)
+        del self.read_buffer[:]
+        self.read_offset = 0
+
     def handle_read(self) -> None:
         self._handle_read_chunk()
 
-    def _handle_read_chunk(self) -> bytes:
-        """Some data can be read"""
-        new_data = b''
-        buffer_length = len(self.read_buffer)
+    def _handle_read_chunk(self) -> int:
+        """Some data can be read, append it to the read buffer and return
+        the number of new bytes"""
+        buf = self.read_buffer
+        start = len(buf)
         try:
-            while buffer_length < self.MAX_BUFFER_SIZE:
+            while True:
+                room_size = min(
+                    self.read_size,
+                    self.MAX_BUFFER_SIZE - (len(buf) - self.read_offset),
+                )
+                if room_size <= 0:
+                    break
+                end = len(buf)
+                self.nr_read_syscalls += 1
                 try:
-                    piece = self.recv(4096)
+                    nr_read = self.recv_into(_READ_SCRATCH[:room_size])
                 except OSError as e:
                     if e.errno == errno.EAGAIN:
                         # End of the available data
-                        _trace(f'  _handle_read_chunk fd={self.fd}: EAGAIN after {len(new_data)}B')
+                        _trace(f'  _handle_read_chunk fd={self.fd}: EAGAIN after {end - start}B')
                         break
-                    if e.errno == errno.EIO and new_data:
+                    if e.errno == errno.EIO and end > start:
                         # Hopefully we could read an error message before the
                         # actual termination
-                        _trace(f'  _handle_read_chunk fd={self.fd}: EIO with {len(new_data)}B partial data')
+                        _trace(f'  _handle_read_chunk fd={self.fd}: EIO with {end - start}B partial data')
                         break
                     _trace(f'  _handle_read_chunk fd={self.fd}: OSError errno={e.errno} raising')
                     raise
+                buf += _READ_SCRATCH[:nr_read]
+                self.nr_read_bytes += nr_read
+                self._adapt_read_size(nr_read, room_size)
 
-                if not piece:
+                if not nr_read:
                     # A closed connection is indicated by signaling a read
                     # condition, and having recv() return 0.
                     # On macOS, pty master reads return 0 (EOF) after child
                     # exit, whereas Linux raises EIO.  If we already have
                     # partial data, return it first; the next call will see
                     # EOF again and raise to trigger handle_close().
-                    if not new_data:
+                    if end == start:
                         _trace(f'  _handle_read_chunk fd={self.fd}: EOF (0 bytes), raising synthetic EIO')
                         raise OSError(errno.EIO, 'Connection closed (EOF)')
-                    _trace(f'  _handle_read_chunk fd={self.fd}: EOF after {len(new_data)}B partial, deferring close')
+                    _trace(f'  _handle_read_chunk fd={self.fd}: EOF after {end - start}B partial, deferring close')
                     break
 
-                new_data += piece
-                buffer_length += len(piece)
-
         finally:
-            new_data = new_data.replace(b'\r', b'\n')
-            self.read_buffer += new_data
-        _trace(f'  _handle_read_chunk fd={self.fd}: returning {len(new_data)}B, buf now {len(self.read_buffer)}B')
-        return new_data
+            if buf.find(b'\r', start) >= 0:
+                # The ptys end lines with \r\n, replaced in C rather than
+                # one \r at a time
+                buf[start:] = buf[start:].replace(b'\r', b'\n')
+        new_length = len(buf) - start
+        _trace(f'  _handle_read_chunk fd={self.fd}: returning {new_length}B, buf now {self.read_buffer_size()}B')
+        return new_length
+
+    def _adapt_read_size(self, nr_read: int, room_size: int) -> None:
+        if nr_read == room_size == self.read_size:
+            # The read was full, more data is probably waiting
+            self.read_size = min(self.read_size * 2, self.MAX_READ_SIZE)
+        elif nr_read < self.read_size // 4:
+            self.read_size = max(self.read_size // 2, self.MIN_READ_SIZE)
+
+    def read_stats(self) -> List[bytes]:
+        """Columns summarizing the reads done so far"""
+        nr_syscalls = self.nr_read_syscalls
+        per_syscall = self.nr_read_bytes // nr_syscalls if nr_syscalls else 0
+        return [
+            f'{self.nr_read_bytes:d} bytes'.encode(),
+            f'in {nr_syscalls:d} reads:'.encode(),
+            f'{per_syscall:d} bytes/read,'.encode(),
+            f'read size {self.read_size:d}'.encode(),
+        ]
 
     def readable(self) -> bool:
-        """No need to ask data if our buffer is already full"""
-        return len(self.read_buffer) < self.MAX_BUFFER_SIZE
+        """No need to ask data if our buffer is already full, or if the
+        console cannot take more output"""
+        return (
+            not _reads_paused
+            and self.read_buffer_size() < self.MAX_BUFFER_SIZE
+        )
 
     def writable(self) -> bool:
         """Do we have something to write?"""
-        return self.write_buffer != b''
-
-    def dispatch_write(self, buf: bytes) -> bool:
-        """Augment the buffer with stuff to write when possible"""
-        self.write_buffer += buf
-        if len(self.write_buffer) > self.MAX_BUFFER_SIZE:
-            console_output(
-                f'Buffer too big ({len(self.write_buffer):d}) for {str(self)}\n'.encode()
-            )
-            raise ExitNow(1)
+        return self.write_queue_size > 0
+
+    def dispatch_write(self, buf: Union[bytes, memoryview]) -> bool:
+        """Queue stuff to write when possible.  bytes and memoryviews of
+        bytes are not copied, so the same data broadcast to many dispatchers
+        is stored once and freed when the slowest one has written it"""
+        if not buf:
+            return True
+        if isinstance(buf, memoryview) and isinstance(buf.obj, bytes):
+            segment = buf
+        else:
+            if not isinstance(buf, bytes):
+                # Only immutable data can be queued without a copy
+                buf = bytes(buf)
+            segment = memoryview(buf)
+        if not self.write_queue_size:
+            self.update_interest()
+        self.write_queue.append(segment)
+        self.write_queue_size += len(segment)
+        if self.write_queue_size > self.WRITE_HIGH_WATER:
+            self._set_write_congested(True)
         return True
@@ -12,6 +12,9 @@ trigger the callback.
 Example: The trigger FOOBAR could be split into FOO and BAR and sent as
          echo "FOO""BAR" so that the sent string does not contain FOOBAR.
 
+Each remote shell has its own triggers, released with it.  All the triggers
+start with the same prefix, searched only once in the output of the shell.
+
 Copyright (c) 2006 Guillaume Chazarain <guichaz@gmail.com>
 Copyright (c) 2024 InnoGames GmbH
 """
@@ -30,6 +33,7 @@ Copyright (c) 2024 InnoGames GmbH
 
 import random
 from typing import Callable
+from typing import Dict
 from typing import Tuple
 
 DIGITS_LETTERS = (
@@ -49,50 +53,82 @@ def random_string(length: int) -> str:
 COMMON_PREFIX = "polysh-{}:".format(random_string(5)).encode()
 NR_GENERATED_TRIGGERS = 0
 
-# {'random_string()': (function, repeat)}
-CALLBACKS = {}
-
-
-def add(name: bytes, function: Callable, repeat: bool) -> Tuple[bytes, bytes]:
-    name = name.replace(b"/", b"_")
-    global NR_GENERATED_TRIGGERS
-    nr = NR_GENERATED_TRIGGERS
-    NR_GENERATED_TRIGGERS += 1
-    trigger = (
-        COMMON_PREFIX
-        + name
-        + b":"
-        + random_string(5).encode()
-        + b":"
-        + str(nr).encode()
-        + b"/"
-    )
-    CALLBACKS[trigger] = (function, repeat)
-    trigger1 = trigger[: int(len(COMMON_PREFIX) / 2)]
-    trigger2 = trigger[len(trigger1) :]
-    return trigger1, trigger2
-
-
-def any_in(data: bytes) -> bool:
-    return COMMON_PREFIX in data
-
-
-def process(line: bytes) -> bool:
-    start = line.find(COMMON_PREFIX)
-    if start < 0:
-        return False
-
-    end = line.find(b"/", start) + 1
-    if end <= 0:
-        return False
-
-    trigger = line[start:end]
-    callback, repeat = CALLBACKS.get(trigger, (None, True))
-    if not callback:
-        return False
-
-    if not repeat:
-        del CALLBACKS[trigger]
-
-    callback(line[end:].strip())
-    return True
+
+class Callbacks:
+    """The triggers of a remote shell, and the search of their common prefix
+    in its output.
+
+    Positions are offsets in the whole output of the shell, so that they are
+    not invalidated when its read buffer is compacted."""
+
+    def __init__(self) -> None:
+        # {trigger: (function, repeat)}
+        self.callbacks = {}  # type: Dict[bytes, Tuple[Callable, bool]]
+        # Position of the first prefix found and not consumed yet, or -1
+        self.match = -1
+        # Where to resume the search, the output before was already searched
+        self.resume = 0
+
+    def add(
+        self, name: bytes, function: Callable, repeat: bool
+    ) -> Tuple[bytes, bytes]:
+        name = name.replace(b"/", b"_")
+        global NR_GENERATED_TRIGGERS
+        nr = NR_GENERATED_TRIGGERS
+        NR_GENERATED_TRIGGERS += 1
+        trigger = (
+            COMMON_PREFIX
+            + name
+            + b":"
+            + random_string(5).encode()
+            + b":"
+            + str(nr).encode()
+            + b"/"
+        )
+        self.callbacks[trigger] = (function, repeat)
+        trigger1 = trigger[: int(len(COMMON_PREFIX) / 2)]
+        trigger2 = trigger[len(trigger1) :]
+        return trigger1, trigger2
+
+    def find(self, data: bytearray, base: int, start: int) -> int:
+        """Return the position of the first prefix at or after start, or -1.
+        data holds the output from position base.  Only the data not
+        searched by the previous calls is searched, including a prefix split
+        across two reads."""
+        if self.match >= start:
+            return self.match
+        start = max(start, self.resume)
+        idx = data.find(COMMON_PREFIX, start - base)
+        if idx < 0:
+            self.match = -1
+            # The beginning of a prefix may be at the end
+            end = base + len(data) - len(COMMON_PREFIX) + 1
+            self.resume = max(start, end)
+        else:
+            self.match = base + idx
+            self.resume = self.match + 1
+        return self.match
+
+    def process(self, line: bytes) -> bool:
+        start = line.find(COMMON_PREFIX)
+        if start < 0:
+            return False
+
+        end = line.find(b"/", start) + 1
+        if end <= 0:
+            return False
+
+        trigger = line[start:end]
+        callback, repeat = self.callbacks.get(trigger, (None, True))
+        if not callback:
+            return False
+
+        if not repeat:
+            del self.callbacks[trigger]
+
+        callback(line[end:].strip())
+        return True
+
+    def clear(self) -> None:
+        """The shell is gone, release its triggers"""
+        self.callbacks.clear()
@@ -0,0 +1,113 @@
+"""Polysh - Child Process Watcher
+
+On Linux, a pidfd becomes readable when the process it refers to exits.
+Registering one per ssh process with the selector lets polysh reap its
+children as soon as they exit, instead of periodically calling waitpid() on
+each of them.  On other platforms watch() returns None and the caller has to
+fall back to polling.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import sys
+from typing import Callable, Optional
+
+from polysh import dispatcher_registry
+
+_TRACE = os.environ.get('POLYSH_TRACE')
+
+
+def _trace(msg: str) -> None:
+    if _TRACE:
+        print(f'[trace] {msg}', file=sys.stderr, flush=True)
+
+
+# os.pidfd_open() needs Python 3.9 and Linux 5.3, cleared on ENOSYS
+_pidfd_available = hasattr(os, 'pidfd_open')
+
+
+class ChildWatcher:
+    """Reap a child process when its pidfd becomes readable, and pass its
+    wait status to a callback"""
+
+    def __init__(self, pid: int, on_exit: Callable[[int], None]) -> None:
+        self.pid = pid
+        self.on_exit = on_exit
+        self.fd = os.pidfd_open(pid)
+        dispatcher_registry.register(self.fd, self)
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    def handle_read(self) -> None:
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            # Already reaped by a blocking waitpid()
+            pid, status = self.pid, 0
+        if pid == 0:
+            return
+        _trace(f'ChildWatcher: child {self.pid} exited, status={status}')
+        self.close()
+        self.on_exit(status)
+
+    def handle_write(self) -> None:
+        pass
+
+    def wait(self) -> int:
+        """Block until the child exits and return its wait status"""
+        _, status = os.waitpid(self.pid, 0)
+        self.close()
+        return status
+
+    def handle_close(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.fd < 0:
+            return
+        dispatcher_registry.unregister(self.fd)
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+        self.fd = -1
+
+
+def available() -> bool:
+    """Can children be watched without polling?"""
+    return _pidfd_available
+
+
+def watch(
+    pid: int, on_exit: Callable[[int], None]
+) -> Optional[ChildWatcher]:
+    """Call on_exit(wait_status) when the child exits, or return None if the
+    child cannot be watched and must be polled"""
+    global _pidfd_available
+    if not _pidfd_available:
+        return None
+    try:
+        return ChildWatcher(pid, on_exit)
+    except OSError as e:
+        _trace(f'watch: pidfd_open({pid}) failed: {e}')
+        if e.errno == errno.ENOSYS:
+            _pidfd_available = False
+        return None
@@ -16,18 +16,136 @@ Copyright (c) 2024 InnoGames GmbH
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import contextlib
 import errno
+import itertools
 import os
-from typing import Optional
+import stat
+import sys
+from typing import Iterator, List, Optional
+
+from polysh import buffered_dispatcher
+from polysh.buffered_dispatcher import IOV_MAX, BufferedDispatcher
+
+_TRACE = os.environ.get('POLYSH_TRACE')
+
+
+def _trace(msg: str) -> None:
+    if _TRACE:
+        print(f'[trace] {msg}', file=sys.stderr, flush=True)
+
 
 # We remember the length of the last printed status in order to
 # clear it with ' ' characters
 last_status_length = None
 
+# While the output is batched, console_output() stages the messages here and
+# flush_output() writes them all at once
+_staged_output = None  # type: Optional[List[bytes]]
+
+
+class StdoutWriter(BufferedDispatcher):
+    """Our own non-blocking open file description of stdout.  The console
+    output is queued when stdout is slow, instead of blocking the event loop.
+    Reading from the remote shells is paused while the queue is above its
+    high-water mark."""
+
+    def readable(self) -> bool:
+        return False
+
+    def write(self, buffers: List[bytes]) -> None:
+        """Queue the buffers and write as much as possible right away"""
+        for buf in buffers:
+            self.dispatch_write(buf)
+        try:
+            while self.writable() and self.send_queued():
+                pass
+        except BlockingIOError:
+            pass
+
+    def handle_write(self) -> None:
+        try:
+            self.send_queued()
+        except BlockingIOError:
+            # A pipe can be reported writable without room for our writev()
+            pass
+
+    def write_congestion_changed(self, congested: bool) -> None:
+        _trace(f'StdoutWriter: congested={congested}')
+        buffered_dispatcher.pause_reads(congested)
+
+    def handle_close(self) -> None:
+        global _stdout_writer
+        _trace('StdoutWriter: closed, falling back to blocking writes')
+        self.clear_write_queue()
+        self.close()
+        if _stdout_writer is self:
+            _stdout_writer = None
+
+
+_stdout_writer = None  # type: Optional[BufferedDispatcher]
+
+
+def _reopen_stdout() -> Optional[int]:
+    """Open stdout again, O_NONBLOCK is then not shared with the terminal
+    input nor with other processes writing to our stdout"""
+    try:
+        mode = os.fstat(1).st_mode
+        if stat.S_ISCHR(mode) and os.isatty(1):
+            path = os.ttyname(1)
+        elif stat.S_ISFIFO(mode):
+            # Only on Linux
+            path = '/proc/self/fd/1'
+        else:
+            # Files do not block
+            return None
+        return os.open(path, os.O_WRONLY | os.O_NONBLOCK | os.O_NOCTTY)
+    except OSError as e:
+        _trace(f'_reopen_stdout: {e}')
+        return None
+
+
+def open_stdout_writer() -> None:
+    """Write the console output without blocking the event loop, if stdout
+    can be reopened"""
+    global _stdout_writer
+    # A writer inherited through fork() is not ours
+    _stdout_writer = None
+    fd = _reopen_stdout()
+    if fd is not None:
+        _stdout_writer = StdoutWriter(fd)
+
+
+def set_stdout_writer(writer: Optional[BufferedDispatcher]) -> None:
+    """Write the console output with writer instead, e.g. to the coordinator
+    of a sharded worker.  Like a StdoutWriter, it has a write() method
+    taking a list of buffers."""
+    global _stdout_writer
+    _stdout_writer = writer
+
+
+def drain_output() -> None:
+    """Wait until the queued console output is written, before something
+    else writes to the terminal or before exiting"""
+    writer = _stdout_writer
+    if writer is None or not writer.writable():
+        return
+    os.set_blocking(writer.fd, True)
+    try:
+        while writer.writable():
+            writer.send_queued()
+    finally:
+        os.set_blocking(writer.fd, False)
+
 
 def safe_write(buf: bytes) -> None:
     """We can get a SIGWINCH when printing, which will cause write to raise
-    an EINTR. That's not a reason to stop printing."""
+    an EINTR. That's not a reason to stop printing.  With a StdoutWriter,
+    the data is queued instead."""
+    if _stdout_writer is not None:
+        _stdout_writer.write([buf])
+        return
     while True:
         try:
             os.write(1, buf)
@@ -37,22 +155,89 @@ def safe_write(buf: bytes) -> None:
                 raise
 
 
-def console_output(msg: bytes, logging_msg: Optional[bytes] = None) -> None:
-    """Use instead of print, to clear the status information before printing"""
+def safe_writev(buffers: List[bytes]) -> None:
+    """Like safe_write() for several buffers, with as few writev() calls as
+    possible"""
+    if _stdout_writer is not None:
+        _stdout_writer.write(buffers)
+        return
+    segments = collections.deque(memoryview(buf) for buf in buffers if buf)
+    while segments:
+        try:
+            written = os.writev(1, list(itertools.islice(segments, IOV_MAX)))
+        except IOError as e:
+            if e.errno != errno.EINTR:
+                raise
+            continue
+        while written:
+            segment = segments[0]
+            if written < len(segment):
+                segments[0] = segment[written:]
+                break
+            segments.popleft()
+            written -= len(segment)
+
+
+def _clear_status() -> None:
+    """Get the terminal ready for our output: interrupt the input and clear
+    the status"""
     from polysh import remote_dispatcher
 
-    remote_dispatcher.log(logging_msg or msg)
     if remote_dispatcher.options.interactive:
         from polysh.stdin import the_stdin_thread
 
+        if the_stdin_thread is None:
+            # A sharded worker, its coordinator has the prompt
+            return
         the_stdin_thread.no_raw_input()
         global last_status_length
         if last_status_length:
             safe_write("\r{}\r".format(last_status_length * " ").encode())
             last_status_length = 0
+
+
+def console_output(msg: bytes, logging_msg: Optional[bytes] = None) -> None:
+    """Use instead of print, to clear the status information before printing"""
+    from polysh import remote_dispatcher
+
+    remote_dispatcher.log(msg if logging_msg is None else logging_msg)
+    if _staged_output is not None:
+        # Even an empty message asks for the status to be cleared
+        _staged_output.append(msg)
+        return
+    _clear_status()
     safe_write(msg)
 
 
+def flush_output() -> None:
+    """Write the console output staged by batched_output() so far"""
+    if not _staged_output:
+        return
+    staged = _staged_output[:]
+    del _staged_output[:]
+    _clear_status()
+    safe_writev(staged)
+
+
+@contextlib.contextmanager
+def batched_output() -> Iterator[None]:
+    """Stage the console output of the block, and write it with a single
+    writev() and a single status clearing at the end"""
+    global _staged_output
+    if _staged_output is not None:
+        # Already batched by the caller
+        yield
+        return
+    _staged_output = []
+    try:
+        yield
+    finally:
+        try:
+            flush_output()
+        finally:
+            _staged_output = None
+
+
 def set_last_status_length(length: int) -> None:
     """The length of the prefix to be cleared when printing something"""
     global last_status_length
@@ -21,9 +21,17 @@ Copyright (c) 2024 InnoGames GmbH
 import os
 import shlex
 import sys
+import time
 from typing import List
 
-from polysh import dispatchers, remote_dispatcher, stdin
+from polysh import (
+    aggregation,
+    dispatchers,
+    latency,
+    remote_dispatcher,
+    sharding,
+    stdin,
+)
 
 _TRACE = os.environ.get('POLYSH_TRACE')
 
@@ -40,6 +48,8 @@ from polysh.control_commands_helpers import (
     toggle_shells,
 )
 from polysh.exceptions import ExitNow
+from polysh.host_syntax import compress_syntax
+from polysh.log_writer import LogWriter
 
 
 def complete_list(line: str, text: str) -> List[str]:
@@ -62,10 +72,13 @@ def complete_chdir(line: str, text: str) -> List[str]:
 
 
 def do_chdir(command: str) -> None:
+    path = expand_local_path(command.strip())
     try:
-        os.chdir(expand_local_path(command.strip()))
+        os.chdir(path)
     except OSError as e:
         console_output(f'{str(e)}\n'.encode())
+    else:
+        sharding.chdir(path)
 
 
 def complete_send_ctrl(line: str, text: str) -> List[str]:
@@ -86,10 +99,10 @@ def do_send_ctrl(command: str) -> None:
     if len(letter) != 1:
         console_output(f'Expected a single letter, got: {letter}\n'.encode())
         return
-    control_letter = chr(ord(letter.lower()) - ord('a') + 1)
+    control_letter = chr(ord(letter.lower()) - ord('a') + 1).encode()
     for i in selected_shells(' '.join(split[1:])):
         if i.enabled:
-            i.dispatch_write(control_letter.encode())
+            i.dispatch_write(control_letter)
 
 
 def complete_reset_prompt(line: str, text: str) -> List[str]:
@@ -98,7 +111,7 @@ def complete_reset_prompt(line: str, text: str) -> List[str]:
 
 def do_reset_prompt(command: str) -> None:
     for i in selected_shells(command):
-        i.dispatch_command(i.init_string)
+        i.reset_prompt()
 
 
 def complete_enable(line: str, text: str) -> List[str]:
@@ -178,7 +191,9 @@ def do_hide_password(command: str) -> None:
 
     if remote_dispatcher.options.log_file:
         console_output(b'Logging disabled to avoid writing passwords\n')
+        remote_dispatcher.options.log_file.close()
         remote_dispatcher.options.log_file = None
+        sharding.set_log(None)
 
 
 def complete_set_debug(line: str, text: str) -> List[str]:
@@ -204,6 +219,85 @@ def do_set_debug(command: str) -> None:
         i.debug = debug
 
 
+def complete_status(line: str, text: str) -> List[str]:
+    return complete_shells(line, text)
+
+
+def do_status(command: str) -> None:
+    nr_shells = 0
+    failed = []
+    # Only the shells where the last command of the user did not succeed are
+    # listed
+    statuses = []
+    for i in selected_shells(command):
+        nr_shells += 1
+        if not i.user_command_done or i.last_status == 0:
+            continue
+        if i.last_status is None:
+            status = b'unknown'
+        else:
+            status = str(i.last_status).encode()
+            failed.append(i.display_name)
+        statuses.append([i.display_name.encode(), status])
+    console_output(b''.join(dispatchers.format_info(statuses)))
+    summary = f'Failed on {len(failed)}/{nr_shells} shells'
+    if failed:
+        summary += ': ' + ' '.join(compress_syntax(failed))
+    console_output(f'{summary}\n'.encode())
+
+
+def do_stragglers(command: str) -> None:
+    try:
+        count = int(command or 10)
+    except ValueError:
+        console_output(f'Expected a number, got: {command}\n'.encode())
+        return
+    running = [
+        i
+        for i in dispatchers.all_instances()
+        if i.enabled and i.state is remote_dispatcher.STATE_RUNNING
+    ]
+    running.sort(key=lambda i: i.running_since)
+    now = time.monotonic()
+    stragglers = []
+    for i in running[:count]:
+        # Not the output of the previous command
+        line = b''
+        if i.last_printed_time >= i.running_since:
+            line = i.last_printed_line.strip()
+        stragglers.append(
+            [
+                i.display_name.encode(),
+                f'{now - i.running_since:.3f}s'.encode(),
+                line,
+            ]
+        )
+    console_output(b''.join(dispatchers.format_info(stragglers)))
+    console_output(f'{latency.summary()}\n'.encode())
+
+
+def complete_set_aggregate(line: str, text: str) -> List[str]:
+    if len(line[:-1].split()) >= 2:
+        return []
+    if text.lower() in ('y', 'n'):
+        return [text + ' ']
+    return ['y ', 'n ']
+
+
+def do_set_aggregate(command: str) -> None:
+    split = command.split()
+    if len(split) != 1 or split[0].lower() not in ('y', 'n'):
+        console_output(f"Expected 'y' or 'n', got: {command}\n".encode())
+        return
+    if remote_dispatcher.options.workers > 1:
+        console_output(b'--workers and --aggregate are incompatible\n')
+        return
+    remote_dispatcher.options.aggregate = split[0].lower() == 'y'
+    if not remote_dispatcher.options.aggregate:
+        # The output aggregated so far
+        aggregation.print_results()
+
+
 def do_export_vars(command: str) -> None:
     rank = 0
     for shell in dispatchers.all_instances():
@@ -235,26 +329,43 @@ def complete_set_log(line: str, text: str) -> List[str]:
 
 
 def do_set_log(command: str) -> None:
+    options = remote_dispatcher.options
+    if options.log_file:
+        # Written completely before appending to it again
+        options.log_file.close()
+        options.log_file = None
     command = command.strip()
     if command:
         try:
-            remote_dispatcher.options.log_file = open(command, 'a')
+            options.log_file = LogWriter(
+                command, options.log_compress, options.log_max_size
+            )
         except OSError as e:
             console_output(f'{str(e)}\n'.encode())
             command = None
+    sharding.set_log(command or None)
     if not command:
-        remote_dispatcher.options.log_file = None
         console_output(b'Logging disabled\n')
 
 
 def complete_show_read_buffer(line: str, text: str) -> List[str]:
     return complete_shells(
-        line, text, lambda i: i.read_buffer or i.read_in_state_not_started
+        line, text, lambda i: i.read_buffer_size() or i.read_in_state_not_started
     )
 
 
 def do_show_read_buffer(command: str) -> None:
     for i in selected_shells(command):
-        if i.read_in_state_not_started:
-            i.print_lines(i.read_in_state_not_started)
-            i.read_in_state_not_started = b''
+        i.print_read_in_state_not_started()
+
+
+def complete_show_read_stats(line: str, text: str) -> List[str]:
+    return complete_shells(line, text)
+
+
+def do_show_read_stats(command: str) -> None:
+    stats = [
+        [i.display_name.encode()] + i.read_stats()
+        for i in selected_shells(command)
+    ]
+    console_output(b''.join(dispatchers.format_info(stats)))
@@ -19,7 +19,7 @@ Copyright (c) 2024 InnoGames GmbH
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import selectors
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Set
 
 # Global selector instance
 _selector = selectors.DefaultSelector()
@@ -30,17 +30,23 @@ _dispatchers: Dict[int, Any] = {}
 # Track last-registered events per fd to avoid redundant epoll_ctl syscalls
 _current_events: Dict[int, int] = {}
 
+# fds whose readable()/writable() interest may have changed since their
+# selector registration was last updated. Only these are re-evaluated before
+# each select(), so an iteration costs O(changed) instead of O(all).
+_dirty: Set[int] = set()
+
 
 def register(fd: int, dispatcher: Any) -> None:
     """Register a dispatcher with the selector.
 
-    Initially registers with EVENT_READ - events are updated dynamically
-    based on readable()/writable() before each select().
+    Initially registers with EVENT_READ - events are updated based on
+    readable()/writable() before the next select().
     """
     _dispatchers[fd] = dispatcher
     # Register with EVENT_READ initially; loop_iteration will update as needed
     _selector.register(fd, selectors.EVENT_READ, dispatcher)
     _current_events[fd] = selectors.EVENT_READ
+    _dirty.add(fd)
 
 
 def unregister(fd: int) -> None:
@@ -48,6 +54,7 @@ def unregister(fd: int) -> None:
     if fd in _dispatchers:
         del _dispatchers[fd]
         _current_events.pop(fd, None)
+        _dirty.discard(fd)
         try:
             _selector.unregister(fd)
         except (KeyError, ValueError):
@@ -86,6 +93,27 @@ def modify_events(fd: int, events: int) -> None:
     _current_events[fd] = events
 
 
+def mark_dirty(fd: int) -> None:
+    """Note that the readable()/writable() interest of a dispatcher may have
+    changed, so it is re-evaluated before the next select()."""
+    if fd in _dispatchers:
+        _dirty.add(fd)
+
+
+def mark_all_dirty() -> None:
+    """Re-evaluate the readable()/writable() interest of every dispatcher
+    before the next select(), after a change affecting all of them."""
+    _dirty.update(_dispatchers)
+
+
+def pop_dirty() -> List[Any]:
+    """Return the dispatchers marked dirty since the last call and reset the
+    dirty set."""
+    dirty = [_dispatchers[fd] for fd in _dirty]
+    _dirty.clear()
+    return dirty
+
+
 def all_dispatchers() -> List[Any]:
     """Return a snapshot list of all registered dispatchers.
 
@@ -107,6 +135,31 @@ def get_selector() -> selectors.BaseSelector:
     return _selector
 
 
+def set_selector(selector: selectors.BaseSelector) -> None:
+    """Replace the global selector instance, e.g. with an
+    asyncio_selector.AsyncioSelector.  Current registrations are moved to the
+    new selector."""
+    global _selector
+    for fd, events in _current_events.items():
+        if events:
+            selector.register(fd, events, _dispatchers[fd])
+    _selector.close()
+    _selector = selector
+
+
+def reset(selector: selectors.BaseSelector) -> None:
+    """Forget all dispatchers and start over with a new selector.
+
+    Used in forked children: the inherited selector is shared with the
+    parent, so it must not be modified.
+    """
+    global _selector
+    _dispatchers.clear()
+    _current_events.clear()
+    _dirty.clear()
+    _selector = selector
+
+
 def get_dispatcher(fd: int) -> Any:
     """Return the dispatcher for a given file descriptor, or None."""
     return _dispatchers.get(fd)
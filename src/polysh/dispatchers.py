@@ -21,9 +21,15 @@ import os
 import struct
 import sys
 import termios
-from typing import List, Tuple
-
-from polysh import dispatcher_registry, display_names, remote_dispatcher
+from typing import Dict, List, Optional, Tuple
+
+from polysh import (
+    admission,
+    dispatcher_registry,
+    display_names,
+    remote_dispatcher,
+)
+from polysh.console import console_output, set_last_status_length
 from polysh.terminal_size import terminal_size
 
 _TRACE = os.environ.get('POLYSH_TRACE')
@@ -43,23 +49,33 @@ def _split_port(hostname: str) -> Tuple[str, str]:
     return s[0], '22'
 
 
+# In the coordinator of interactive sharded workers, the sharding.ShellProxy
+# of each shell run by the workers, by its key
+shell_proxies = None  # type: Optional[Dict[int, remote_dispatcher.RemoteDispatcher]]
+
+
+def _remote_dispatchers() -> List[remote_dispatcher.RemoteDispatcher]:
+    """The remote shells run by this process"""
+    return [
+        i
+        for i in dispatcher_registry.all_dispatchers()
+        if isinstance(i, remote_dispatcher.RemoteDispatcher)
+    ]
+
+
 def all_instances() -> List[remote_dispatcher.RemoteDispatcher]:
     """Iterator over all the remote_dispatcher instances"""
-    return sorted(
-        [
-            i
-            for i in dispatcher_registry.all_dispatchers()
-            if isinstance(i, remote_dispatcher.RemoteDispatcher)
-        ],
-        key=lambda i: i.display_name or '',
-    )
+    instances = _remote_dispatchers()
+    if shell_proxies is not None:
+        instances.extend(shell_proxies.values())
+    return sorted(instances, key=lambda i: i.display_name or '')
 
 
 def count_awaited_processes() -> Tuple[int, int]:
     """Return a tuple with the number of awaited processes and the total
     number"""
-    awaited = 0
-    total = 0
+    # The hosts waiting to be started are still to be awaited
+    awaited = total = admission.nr_pending()
     for i in all_instances():
         if i.enabled:
             total += 1
@@ -70,6 +86,8 @@ def count_awaited_processes() -> Tuple[int, int]:
 
 def all_terminated() -> bool:
     """For each remote shell determine if its terminated"""
+    if admission.nr_pending():
+        return False
     instances_found = False
     for i in all_instances():
         instances_found = True
@@ -80,6 +98,9 @@ def all_terminated() -> bool:
         ):
             _trace(f'all_terminated: {i.hostname} still in state {state_name}, enabled={i.enabled}')
             return False
+    # With --parallel, the dead shells are closed
+    if remote_dispatcher.options.parallel:
+        instances_found = True
     _trace(f'all_terminated: result={instances_found} (all dead/terminated)')
     return instances_found
 
@@ -94,7 +115,7 @@ def update_terminal_size() -> None:
     bug = struct.unpack('i', struct.pack('I', termios.TIOCSWINSZ))[0]
     packed_size = struct.pack('HHHH', h, w, 0, 0)
     term_size = w, h
-    for i in all_instances():
+    for i in _remote_dispatchers():
         if i.enabled and i.term_size != term_size:
             i.term_size = term_size
             fcntl.ioctl(i.fd, bug, packed_size)
@@ -126,19 +147,38 @@ def format_info(info_list: List[List[bytes]]) -> List[bytes]:
 
 
 def create_remote_dispatchers(hosts: List[str]) -> None:
-    last_message = ''
-    for i, host in enumerate(hosts):
-        if remote_dispatcher.options.interactive:
-            last_message = 'Started %d/%d remote processes\r' % (i, len(hosts))
-            sys.stdout.write(last_message)
-            sys.stdout.flush()
-        try:
-            hostname, port = _split_port(host)
-            remote_dispatcher.RemoteDispatcher(hostname, port)
-        except OSError:
-            print()
-            raise
-
-    if last_message:
-        sys.stdout.write(' ' * len(last_message) + '\r')
-        sys.stdout.flush()
+    """The remote shells are started by the event loop"""
+    if shell_proxies is not None:
+        from polysh import sharding
+
+        sharding.add_hosts(hosts)
+        return
+    admission.submit([_split_port(host) for host in hosts])
+
+
+# The startup progress shown in interactive mode
+_last_progress = ''
+
+
+def print_startup_progress() -> None:
+    """While hosts wait to be started, show how many were started and how
+    many are ready"""
+    global _last_progress
+    progress = ''
+    if admission.nr_pending():
+        started, submitted = admission.progress()
+        awaited, total = count_awaited_processes()
+        progress = 'Started %d/%d remote processes, %d ready' % (
+            started,
+            submitted,
+            total - awaited,
+        )
+    if progress == _last_progress:
+        return
+    if progress:
+        # Replacing the previous one
+        console_output(progress.encode() + b'\r', logging_msg=b'')
+        set_last_status_length(len(progress))
+    else:
+        console_output(b'', logging_msg=b'')
+    _last_progress = progress
@@ -1,6 +1,7 @@
 """Polysh - Event Loop
 
-Provides the main loop iteration using selectors, replacing asyncore.loop().
+Provides the main loop iteration using selectors, replacing asyncore.loop(),
+and timers so that subsystems can schedule work at a deadline.
 
 Copyright (c) 2006 Guillaume Chazarain <guichaz@gmail.com>
 Copyright (c) 2024 InnoGames GmbH
@@ -19,10 +20,13 @@ Copyright (c) 2024 InnoGames GmbH
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import errno
+import heapq
+import itertools
 import os
 import selectors
 import sys
-from typing import Optional
+import time
+from typing import Callable, List, Optional, Tuple
 
 from polysh import dispatcher_registry
 from polysh.exceptions import ExitNow
@@ -35,29 +39,73 @@ def _trace(msg: str) -> None:
         print(f'[trace] {msg}', file=sys.stderr, flush=True)
 
 
+class Timer:
+    """A callback scheduled by call_later()"""
+
+    __slots__ = ('deadline', 'callback', 'cancelled')
+
+    def __init__(self, deadline: float, callback: Callable[[], None]) -> None:
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+# Heap of (deadline, sequence number, timer), the sequence number keeps
+# timers with the same deadline in scheduling order
+_timers = []  # type: List[Tuple[float, int, Timer]]
+_timer_sequence = itertools.count()
+
+
+def call_later(delay: float, callback: Callable[[], None]) -> Timer:
+    """Call callback() from the event loop in delay seconds"""
+    timer = Timer(time.monotonic() + delay, callback)
+    heapq.heappush(_timers, (timer.deadline, next(_timer_sequence), timer))
+    return timer
+
+
+def _select_timeout(timeout: Optional[float]) -> Optional[float]:
+    """Shorten the select() timeout so we wake up for the next timer"""
+    while _timers and _timers[0][2].cancelled:
+        heapq.heappop(_timers)
+    if not _timers:
+        return timeout
+    delay = max(_timers[0][0] - time.monotonic(), 0)
+    if timeout is None:
+        return delay
+    return min(timeout, delay)
+
+
+def run_timers() -> None:
+    """Call the callbacks of the expired timers"""
+    now = time.monotonic()
+    while _timers and _timers[0][0] <= now:
+        timer = heapq.heappop(_timers)[2]
+        if not timer.cancelled:
+            _trace(f'run_timers: calling {timer.callback}')
+            timer.callback()
+
+
 def loop_iteration(timeout: Optional[float] = None) -> None:
     """Perform a single iteration of the event loop.
 
     This replaces asyncore.loop(count=1, timeout=timeout, use_poll=True).
+    The select() does not sleep past the next timer deadline, the expired
+    timers are run after the I/O events are dispatched.
 
-    Updates selector registrations based on each dispatcher's readable()/writable()
-    state, then performs select and dispatches events to handlers.
+    Updates the selector registrations of the dispatchers whose interest
+    may have changed (see dispatcher_registry.mark_dirty()), then performs
+    select and dispatches events to handlers.  Dispatchers that handled an
+    event are re-evaluated on the next iteration.
     """
+    _update_registrations()
     selector = dispatcher_registry.get_selector()
 
-    # Update event registrations based on current readable/writable state.
-    # Iterate the dict values directly — this loop doesn't mutate _dispatchers.
-    for dispatcher in dispatcher_registry.iter_dispatchers():
-        events = 0
-        if dispatcher.readable():
-            events |= selectors.EVENT_READ
-        if dispatcher.writable():
-            events |= selectors.EVENT_WRITE
-        dispatcher_registry.modify_events(dispatcher.fd, events)
-
     # Perform select
     try:
-        ready = selector.select(timeout)
+        ready = selector.select(_select_timeout(timeout))
     except OSError as e:
         if e.errno == errno.EINTR:
             # Interrupted by signal handler, just return
@@ -65,6 +113,36 @@ def loop_iteration(timeout: Optional[float] = None) -> None:
             return
         raise
 
+    _dispatch(ready, timeout)
+
+
+async def loop_iteration_async(timeout: Optional[float] = None) -> None:
+    """Like loop_iteration(), the events being awaited on the running asyncio
+    event loop instead of blocking in select().  The selector must be an
+    asyncio_selector.AsyncioSelector on this event loop."""
+    _update_registrations()
+    selector = dispatcher_registry.get_selector()
+    ready = await selector.wait(_select_timeout(timeout))
+    _dispatch(ready, timeout)
+
+
+def _update_registrations() -> None:
+    """Update the event registrations based on the current readable/writable
+    state, only for the dispatchers that reported a change"""
+    for dispatcher in dispatcher_registry.pop_dirty():
+        events = 0
+        if dispatcher.readable():
+            events |= selectors.EVENT_READ
+        if dispatcher.writable():
+            events |= selectors.EVENT_WRITE
+        dispatcher_registry.modify_events(dispatcher.fd, events)
+
+
+def _dispatch(
+    ready: List[Tuple[selectors.SelectorKey, int]], timeout: Optional[float]
+) -> None:
+    """Call the handlers of the ready dispatchers, then the expired
+    timers"""
     if not ready:
         _trace(f'loop_iteration: select returned 0 events (timeout={timeout})')
 
@@ -84,6 +162,10 @@ def loop_iteration(timeout: Optional[float] = None) -> None:
             _trace(f'loop_iteration: fd={key.fd} dispatcher gone before handle_read')
             continue
 
+        # Handlers change buffers and states, so re-evaluate the interest
+        # of this dispatcher before the next select()
+        dispatcher_registry.mark_dirty(key.fd)
+
         if events & selectors.EVENT_READ:
             try:
                 dispatcher.handle_read()
@@ -106,3 +188,5 @@ def loop_iteration(timeout: Optional[float] = None) -> None:
             except Exception as exc:
                 _trace(f'loop_iteration: fd={key.fd} {disp_name} handle_write raised {type(exc).__name__}: {exc}')
                 dispatcher.handle_close()
+
+    run_timers()
@@ -0,0 +1,281 @@
+"""Polysh - Fork Server
+
+Where spawning the ssh processes forks the calling process, forking polysh
+gets slower as it grows with the output buffers and the state of each host.
+A small fork server is then forked at launch, before any remote shell
+exists.  Polysh sends it the commands to start over a unix socket and gets
+back the pid and the pty master of each process, passed with SCM_RIGHTS.
+As the processes are not children of polysh, the fork server reaps them and
+sends back their wait status.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import sys
+from typing import Callable, Dict, List, Optional, Tuple
+
+from polysh import dispatcher_registry, event_loop, spawn
+
+_TRACE = os.environ.get('POLYSH_TRACE')
+
+
+def _trace(msg: str) -> None:
+    if _TRACE:
+        print(f'[trace] {msg}', file=sys.stderr, flush=True)
+
+
+# The wait status given to the processes whose fork server died
+_LOST_STATUS = 255 << 8
+
+
+def _send_line(sock: socket.socket, line: bytes, fd: int = -1) -> None:
+    ancdata = []
+    if fd >= 0:
+        ancdata = [
+            (socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))
+        ]
+    sent = sock.sendmsg([line], ancdata)
+    if sent < len(line):
+        sock.sendall(line[sent:])
+
+
+def _reap_children(sock: socket.socket) -> None:
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        _send_line(sock, b'X %d %d\n' % (pid, status))
+
+
+def _serve(sock: socket.socket) -> None:
+    """The loop of the fork server, until polysh closes its socket"""
+    # Ctrl-C and the terminal hangup are for polysh only
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(devnull, fd)
+    max_fd = os.sysconf('SC_OPEN_MAX')
+    os.closerange(3, sock.fileno())
+    os.closerange(sock.fileno() + 1, max_fd)
+
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    requests = b''
+    while True:
+        readable, _, _ = select.select([sock, wakeup_r], [], [])
+        if wakeup_r in readable:
+            os.read(wakeup_r, 4096)
+            _reap_children(sock)
+        if sock not in readable:
+            continue
+        data = sock.recv(65536)
+        if not data:
+            return
+        requests += data
+        while b'\n' in requests:
+            line, requests = requests.split(b'\n', 1)
+            request = json.loads(line.decode())
+            try:
+                pid, fd = spawn.start(request['args'], request['command'])
+            except OSError as e:
+                _send_line(sock, b'E %d\n' % e.errno)
+                continue
+            _send_line(sock, b'P %d\n' % pid, fd)
+            os.close(fd)
+
+
+class ForkServerDispatcher:
+    """Our end of the socket to the fork server, receiving the wait status
+    of the processes it started"""
+
+    def __init__(self, sock: socket.socket, pid: int) -> None:
+        self.sock = sock
+        self.pid = pid
+        self.fd = sock.fileno()
+        self.received = b''
+        # The pty master passed with the reply being received
+        self.passed_fd = -1
+        dispatcher_registry.register(self.fd, self)
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    def receive(self, flags: int = 0) -> Optional[Tuple[bytes, int]]:
+        """Read from the fork server, store the wait statuses and return the
+        reply to a request with its file descriptor if one was received"""
+        fds = array.array('i')
+        data, ancdata, _, _ = self.sock.recvmsg(
+            65536, socket.CMSG_SPACE(fds.itemsize), flags
+        )
+        if not data:
+            raise EOFError
+        for level, kind, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(
+                    cmsg_data[: len(cmsg_data) - len(cmsg_data) % fds.itemsize]
+                )
+                self.passed_fd = fds[0]
+        self.received += data
+        reply = None
+        while b'\n' in self.received:
+            line, self.received = self.received.split(b'\n', 1)
+            words = line.split()
+            if words[0] == b'X':
+                _statuses[int(words[1])] = int(words[2])
+            else:
+                reply = (line, self.passed_fd)
+                self.passed_fd = -1
+        _schedule_dispatch()
+        return reply
+
+    def handle_read(self) -> None:
+        try:
+            # What was readable may have been received while waiting
+            self.receive(socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass
+        except EOFError:
+            self.handle_close()
+
+    def handle_write(self) -> None:
+        pass
+
+    def handle_close(self) -> None:
+        global _server
+        _trace(f'fork server {self.pid} closed')
+        dispatcher_registry.unregister(self.fd)
+        self.sock.close()
+        _server = None
+        for watcher in list(_watchers.values()):
+            _statuses.setdefault(watcher.pid, _LOST_STATUS)
+        _schedule_dispatch()
+
+
+class ForkServerWatcher:
+    """Pass the wait status of a process started by the fork server to a
+    callback, like child_watcher.ChildWatcher"""
+
+    def __init__(self, pid: int, on_exit: Callable[[int], None]) -> None:
+        self.pid = pid
+        self.on_exit = on_exit
+        _watchers[pid] = self
+        _schedule_dispatch()
+
+    def wait(self) -> int:
+        """Block until the process exits and return its wait status"""
+        while self.pid not in _statuses:
+            if _server is None:
+                _statuses[self.pid] = _LOST_STATUS
+                break
+            try:
+                _server.receive()
+            except EOFError:
+                _server.handle_close()
+        self.close()
+        return _statuses.pop(self.pid)
+
+    def close(self) -> None:
+        _watchers.pop(self.pid, None)
+
+
+_server = None  # type: Optional[ForkServerDispatcher]
+
+# The wait status of the processes that exited, by pid
+_statuses = {}  # type: Dict[int, int]
+
+# The processes waited for, by pid
+_watchers = {}  # type: Dict[int, ForkServerWatcher]
+
+_dispatch_timer = None  # type: Optional[event_loop.Timer]
+
+
+def _dispatch() -> None:
+    global _dispatch_timer
+    _dispatch_timer = None
+    for pid in [pid for pid in _statuses if pid in _watchers]:
+        watcher = _watchers.pop(pid)
+        watcher.on_exit(_statuses.pop(pid))
+
+
+def _schedule_dispatch() -> None:
+    """The callbacks are called from the event loop, not while waiting for a
+    reply or another process"""
+    global _dispatch_timer
+    if _dispatch_timer is None and any(pid in _watchers for pid in _statuses):
+        _dispatch_timer = event_loop.call_later(0, _dispatch)
+
+
+def launch() -> None:
+    """Fork the fork server"""
+    global _server
+    parent_sock, child_sock = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        # Child
+        try:
+            parent_sock.close()
+            _serve(child_sock)
+        finally:
+            os._exit(0)
+
+    child_sock.close()
+    _server = ForkServerDispatcher(parent_sock, pid)
+    _trace(f'started fork server {pid}')
+
+
+def running() -> bool:
+    return _server is not None
+
+
+def start(args: Optional[List[str]], command: str) -> Tuple[int, int]:
+    """Like spawn.start(), in the fork server"""
+    if _server is None:
+        raise OSError(errno.EPIPE, 'The fork server is gone')
+    request = {'args': args, 'command': command}
+    _server.sock.sendall(json.dumps(request).encode() + b'\n')
+    reply = None
+    while reply is None:
+        try:
+            reply = _server.receive()
+        except EOFError:
+            _server.handle_close()
+            raise OSError(errno.EPIPE, 'The fork server is gone')
+    line, fd = reply
+    kind, number = line.split()
+    if kind == b'E':
+        raise OSError(int(number), os.strerror(int(number)))
+    return int(number), fd
+
+
+def watch(pid: int, on_exit: Callable[[int], None]) -> ForkServerWatcher:
+    """Call on_exit(wait_status) when the process started by the fork
+    server exits"""
+    return ForkServerWatcher(pid, on_exit)
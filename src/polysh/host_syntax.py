@@ -17,7 +17,11 @@ Copyright (c) 2024 InnoGames GmbH
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+from typing import Dict
+from typing import Iterable
 from typing import Iterator
+from typing import List
+from typing import Set
 from typing import Tuple
 
 # Currently the only expansion is <START_NUMBER-END_NUMBER>
@@ -30,6 +34,8 @@ from typing import Tuple
 
 syntax_pattern = re.compile("<([0-9,-]+)>")
 interval_pattern = re.compile("([0-9]+)(-[0-9]+)?")
+# The last number in a hostname, used to compress lists of hostnames
+last_number_pattern = re.compile("^(.*?)([0-9]+)([^0-9]*)$")
 
 
 def _split_port(hostname: str) -> Tuple[str, str]:
@@ -76,3 +82,60 @@ def expand_syntax(string: str) -> Iterator[str]:
                         yield expanded
     else:
         yield string
+
+
+def _format_intervals(numbers: List[int], width: int) -> str:
+    """[1, 2, 3, 5] => 1-3,5"""
+    intervals = []
+    start = prev = numbers[0]
+    for number in numbers[1:] + [-1]:
+        if number == prev + 1:
+            prev = number
+            continue
+        interval = str(start).zfill(width)
+        if prev != start:
+            interval += "-" + str(prev).zfill(width)
+        intervals.append(interval)
+        start = prev = number
+    return ",".join(intervals)
+
+
+def compress_syntax(strings: Iterable[str]) -> List[str]:
+    """The reverse of expand_syntax, only the last number of each string is
+    compressed: web1, web2, web3, db01, db02 => web<1-3>, db<01-02>"""
+    split = []  # type: List[Tuple[str, str, str]]
+    padded_widths = set()  # type: Set[Tuple[str, str, int]]
+    for string in strings:
+        match = last_number_pattern.match(string)
+        if not match:
+            split.append((string, "", ""))
+            continue
+        prefix, digits, suffix = match.groups()
+        split.append((prefix, digits, suffix))
+        if len(digits) > 1 and digits.startswith("0"):
+            padded_widths.add((prefix, suffix, len(digits)))
+
+    # Grouped by prefix, suffix and zero padding width, in order of first
+    # appearance
+    groups = {}  # type: Dict[Tuple[str, str, int], Set[int]]
+    for prefix, digits, suffix in split:
+        if not digits:
+            groups.setdefault((prefix, suffix, -1), set())
+            continue
+        # 10 belongs with 01 to 09 as <01-10>
+        width = len(digits)
+        if (prefix, suffix, width) not in padded_widths:
+            width = 0
+        groups.setdefault((prefix, suffix, width), set()).add(int(digits))
+
+    compressed = []
+    for (prefix, suffix, width), numbers in groups.items():
+        if width < 0:
+            compressed.append(prefix)
+        elif len(numbers) == 1:
+            number = str(numbers.pop()).zfill(width)
+            compressed.append(prefix + number + suffix)
+        else:
+            intervals = _format_intervals(sorted(numbers), width)
+            compressed.append(prefix + "<" + intervals + ">" + suffix)
+    return compressed
@@ -0,0 +1,67 @@
+"""Polysh - JSON Lines Output
+
+With --format=jsonl, each line printed by a remote shell becomes a JSON
+object on its own line, and a final object per shell gives its exit status
+and timings, so that the output can be parsed without scraping the
+`host : line` text.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+from typing import Any, List, Optional
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def _record(shell: Any, ts: float, stream: str, **fields: Any) -> str:
+    record = {
+        'host': shell.hostname,
+        'display_name': shell.display_name,
+        'ts': round(ts, 6),
+        'stream': stream,
+    }
+    record.update(fields)
+    return _encoder.encode(record)
+
+
+def line_records(shell: Any, stream: str, lines: List[bytes]) -> bytes:
+    """One record per line, the lines were read together"""
+    ts = time.time()
+    records = [
+        _record(shell, ts, stream, line=line.decode(errors='replace'))
+        for line in lines
+    ]
+    return ('\n'.join(records) + '\n').encode()
+
+
+def exit_record(shell: Any, exit_status: Optional[int]) -> bytes:
+    """The final record of a shell, exit_status is None if the ssh process
+    was killed by polysh.  command_status is the exit status of the last
+    command as shown by the prompt.  ready is when the remote shell was
+    ready to receive the command."""
+    ts = time.time()
+    record = _record(
+        shell,
+        ts,
+        'exit',
+        exit_status=exit_status,
+        command_status=shell.last_status,
+        start=round(shell.start_time, 6),
+        ready=shell.ready_time and round(shell.ready_time, 6),
+        duration=round(ts - shell.start_time, 6),
+    )
+    return (record + '\n').encode()
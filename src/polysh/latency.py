@@ -0,0 +1,110 @@
+"""Polysh - Command Latency
+
+The time each remote shell takes to run a command, from its dispatch to the
+next prompt, is recorded to spot the slow machines.  A command starts when
+the first shell starts running it after all the shells were done with the
+previous one.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import math
+from typing import Dict, List, Tuple
+
+# The number of shells still running the current command
+_nr_running = 0
+
+# The latencies of the shells done with the current command, in seconds
+_latencies = []  # type: List[float]
+_sorted = True
+
+# The number of commands started so far, to tell the latencies of a command
+# from those of the previous one
+_nr_commands = 0
+
+# In the coordinator of interactive sharded workers, the number of shells
+# running the command and the latencies of those done, for each worker
+_shards = {}  # type: Dict[int, Tuple[int, List[float]]]
+
+
+def command_started() -> None:
+    """A shell started running a command"""
+    global _nr_running, _sorted, _nr_commands
+    if not _nr_running:
+        # A new command, forget the previous one
+        del _latencies[:]
+        _sorted = True
+        _nr_commands += 1
+    _nr_running += 1
+
+
+def command_done(latency: float) -> None:
+    """A shell is done with the command, after latency seconds"""
+    global _nr_running, _sorted
+    _nr_running -= 1
+    if _latencies and latency < _latencies[-1]:
+        _sorted = False
+    _latencies.append(latency)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of a non-empty sorted list"""
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def current() -> Tuple[int, int, List[float]]:
+    """The number of the current or last command, the number of shells
+    still running it and the latencies of those done, in completion order
+    until summary() sorts them"""
+    return _nr_commands, _nr_running, _latencies
+
+
+def set_shard_state(
+    shard: int, nr_running: int, latencies: List[float]
+) -> None:
+    """The current command as reported by a sharded worker to its
+    coordinator"""
+    _shards[shard] = nr_running, latencies
+
+
+def summary() -> str:
+    """The latency distribution of the current or last command"""
+    global _sorted
+    nr_running = _nr_running
+    if _shards:
+        latencies = sorted(
+            itertools.chain.from_iterable(l for _, l in _shards.values())
+        )
+        nr_running += sum(n for n, _ in _shards.values())
+    else:
+        if not _sorted:
+            _latencies.sort()
+            _sorted = True
+        latencies = _latencies
+    if not latencies:
+        return f'Done on 0/{nr_running} shells'
+    nr_done = len(latencies)
+    stats = ' '.join(
+        f'{name} {value:.3f}s'
+        for name, value in (
+            ('p50', percentile(latencies, 50)),
+            ('p95', percentile(latencies, 95)),
+            ('p99', percentile(latencies, 99)),
+            ('max', latencies[-1]),
+        )
+    )
+    return f'Done on {nr_done}/{nr_done + nr_running} shells: {stats}'
@@ -0,0 +1,206 @@
+"""Polysh - Log Writer
+
+The log file is written by a background thread, so that a slow filesystem
+does not slow down the event loop.  The main thread only appends the
+messages to a bounded buffer, the thread writes them in large chunks,
+optionally compressed with gzip and rotated when the file gets too big.
+Write errors are reported to the main thread through a pipe registered with
+the event loop.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import gzip
+import os
+import sys
+from threading import Condition, Thread
+from typing import List, Optional
+
+from polysh import dispatcher_registry
+from polysh.exceptions import ExitNow
+
+_TRACE = os.environ.get('POLYSH_TRACE')
+
+
+def _trace(msg: str) -> None:
+    if _TRACE:
+        print(f'[trace] {msg}', file=sys.stderr, flush=True)
+
+
+class _ErrorNotification:
+    """The main thread end of the pipe used by the log writer thread to
+    report a write error"""
+
+    def __init__(self, log_writer: 'LogWriter', fd: int) -> None:
+        self.log_writer = log_writer
+        self.fd = fd
+        dispatcher_registry.register(fd, self)
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    def handle_read(self) -> None:
+        os.read(self.fd, 1)
+        self.log_writer.check_error()
+
+    def handle_write(self) -> None:
+        pass
+
+    def handle_close(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        dispatcher_registry.unregister(self.fd)
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+class LogWriter:
+    """Append to a log file from a background thread"""
+
+    # The main thread waits for the writer thread above this
+    MAX_PENDING_SIZE = 4 * 1024 * 1024
+
+    def __init__(
+        self, name: str, compress: bool = False, max_size: int = 0
+    ) -> None:
+        self.name = name
+        self.compress = compress
+        self.max_size = max_size
+        self.fd = self._open()
+        self.condition = Condition()
+        self.pending = []  # type: List[bytes]
+        self.pending_size = 0
+        self.closing = False
+        self.error = None  # type: Optional[OSError]
+        # The thread is started on the first write by each process, a forked
+        # child (e.g. a sharded worker) does not inherit it
+        self.thread = None  # type: Optional[Thread]
+        self.thread_pid = None  # type: Optional[int]
+        self.notification = None  # type: Optional[_ErrorNotification]
+        self.notification_w = -1
+        atexit.register(self.close)
+
+    def _open(self) -> int:
+        return os.open(
+            self.name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666
+        )
+
+    def _start(self) -> None:
+        self.condition = Condition()
+        self.pending = []
+        self.pending_size = 0
+        self.thread_pid = os.getpid()
+        r, self.notification_w = os.pipe()
+        self.notification = _ErrorNotification(self, r)
+        self.thread = Thread(target=self._run, name='log writer', daemon=True)
+        self.thread.start()
+
+    def write(self, msg: bytes) -> None:
+        """Queue msg to be appended to the log file, called by the main
+        thread"""
+        self.check_error()
+        if not msg:
+            return
+        if self.thread_pid != os.getpid():
+            self._start()
+        with self.condition:
+            while (
+                self.pending_size > self.MAX_PENDING_SIZE
+                and self.error is None
+            ):
+                self.condition.wait()
+            self.pending.append(msg)
+            self.pending_size += len(msg)
+            self.condition.notify_all()
+
+    def check_error(self) -> None:
+        """Exit if the writer thread failed"""
+        if self.error is None:
+            return
+        print('Exception while writing log:', self.name)
+        print(self.error)
+        raise ExitNow(1)
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.pending and not self.closing:
+                    self.condition.wait()
+                data = b''.join(self.pending)
+                self.pending = []
+                self.pending_size = 0
+                self.condition.notify_all()
+                if not data:
+                    # Closing
+                    return
+            try:
+                self._write(data)
+            except OSError as e:
+                _trace(f'LogWriter: {e}')
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                os.write(self.notification_w, b'e')
+                return
+
+    def _write(self, data: bytes) -> None:
+        if self.compress:
+            # Each chunk is a complete gzip member, a file of concatenated
+            # members is still a valid gzip file
+            data = gzip.compress(data)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view) :]
+        if self.max_size:
+            self._rotate_if_needed()
+
+    def _rotate_if_needed(self) -> None:
+        """Rename the log file to NAME.1 once it is too big, and start a new
+        one"""
+        st = os.fstat(self.fd)
+        if st.st_size < self.max_size:
+            return
+        try:
+            path_st = os.stat(self.name)
+        except FileNotFoundError:
+            path_st = None
+        if path_st is not None and os.path.samestat(st, path_st):
+            _trace(f'LogWriter: rotating {self.name}')
+            os.replace(self.name, self.name + '.1')
+        # Otherwise another polysh process (e.g. a sharded worker) already
+        # rotated it, just follow
+        os.close(self.fd)
+        self.fd = self._open()
+
+    def close(self) -> None:
+        """Write the pending messages and close the file"""
+        if self.fd < 0:
+            return
+        if self.thread_pid == os.getpid():
+            with self.condition:
+                self.closing = True
+                self.condition.notify_all()
+            self.thread.join()
+            self.notification.close()
+            os.close(self.notification_w)
+        os.close(self.fd)
+        self.fd = -1
@@ -17,16 +17,19 @@ Copyright (c) 2024 InnoGames GmbH
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import asyncio
 import atexit
 import getpass
 import locale
 import os
 import readline
 import resource
+import selectors
 import signal
 import sys
 import termios
-from typing import Callable
+import time
+from typing import Callable, Generator, List, Optional
 
 _TRACE = os.environ.get('POLYSH_TRACE')
 
@@ -37,14 +40,33 @@ def _trace(msg: str) -> None:
 
 from polysh import (
     VERSION,
+    aggregation,
+    buffered_dispatcher,
+    console,
     control_commands,
+    dispatcher_registry,
     dispatchers,
+    event_loop,
+    forkserver,
     remote_dispatcher,
+    sharding,
+    spawn,
     stdin,
 )
+from polysh.asyncio_selector import AsyncioSelector
 from polysh.console import console_output
 from polysh.exceptions import ExitNow
 from polysh.host_syntax import expand_syntax
+from polysh.log_writer import LogWriter
+
+
+# Once all the remote shells printed nothing for this long, their unfinished
+# lines are printed and the prompt is updated
+QUIET_DELAY = 0.2
+
+# Interval of the dead children polling, see _reap_dead_dispatchers()
+REAP_INTERVAL = 1.0
+_reap_timer = None  # type: Optional[event_loop.Timer]
 
 
 def kill_all() -> None:
@@ -65,12 +87,13 @@ def _reap_dead_dispatchers() -> None:
     On macOS, kqueue may not reliably report pty master EOF when the
     child process exits.  As a safety net, periodically try to reap
     children with waitpid(WNOHANG) and disconnect their dispatchers.
+    Children watched through a pidfd are reaped by their watcher instead.
     """
     for r in dispatchers.all_instances():
         if r.state in (
             remote_dispatcher.STATE_TERMINATED,
             remote_dispatcher.STATE_DEAD,
-        ):
+        ) or r.child_watcher is not None:
             continue
         try:
             pid, status = os.waitpid(r.pid, os.WNOHANG)
@@ -86,9 +109,36 @@ def _reap_dead_dispatchers() -> None:
                 remote_dispatcher.options.exit_code, exit_code
             )
             r.disconnect()
+            if remote_dispatcher.options.parallel:
+                r.close()
+
+
+def _has_unwatched_children() -> bool:
+    """Are there running children without a pidfd watcher?"""
+    return any(
+        r.child_watcher is None
+        and r.state
+        not in (remote_dispatcher.STATE_TERMINATED, remote_dispatcher.STATE_DEAD)
+        for r in dispatchers.all_instances()
+    )
+
 
+def _reap_timer_expired() -> None:
+    global _reap_timer
+    _reap_timer = None
+    _reap_dead_dispatchers()
+    _schedule_reaping()
 
-def parse_cmdline() -> argparse.Namespace:
+
+def _schedule_reaping() -> None:
+    """Poll for dead children every REAP_INTERVAL seconds, as long as some
+    of them cannot be watched through a pidfd"""
+    global _reap_timer
+    if _reap_timer is None and _has_unwatched_children():
+        _reap_timer = event_loop.call_later(REAP_INTERVAL, _reap_timer_expired)
+
+
+def parse_cmdline(argv: Optional[List[str]] = None) -> argparse.Namespace:
     description = 'Control commands are prefixed by ":".'
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument(
@@ -131,6 +181,22 @@ def parse_cmdline() -> argparse.Namespace:
         dest='disable_color',
         help='disable colored hostnames [enabled]',
     )
+    parser.add_argument(
+        '--format',
+        type=str,
+        dest='format',
+        choices=['text', 'jsonl'],
+        default='text',
+        help='output format, jsonl prints a JSON object per line, '
+        'non-interactive mode only [%(default)s]',
+    )
+    parser.add_argument(
+        '--aggregate',
+        action='store_true',
+        dest='aggregate',
+        help='print each distinct output of a command once, with the list '
+        'of the hosts that printed it [no]',
+    )
     parser.add_argument(
         '--password-file',
         type=str,
@@ -145,6 +211,20 @@ def parse_cmdline() -> argparse.Namespace:
         dest='log_file',
         help='file to log each machine conversation [none]',
     )
+    parser.add_argument(
+        '--log-compress',
+        action='store_true',
+        dest='log_compress',
+        help='compress the log file with gzip [no]',
+    )
+    parser.add_argument(
+        '--log-max-size',
+        type=int,
+        default=0,
+        metavar='SIZE',
+        dest='log_max_size',
+        help='rotate the log file when it gets bigger than SIZE bytes [never]',
+    )
     parser.add_argument(
         '--abort-errors',
         action='store_true',
@@ -157,11 +237,55 @@ def parse_cmdline() -> argparse.Namespace:
         dest='debug',
         help='print debugging information',
     )
+    parser.add_argument(
+        '--event-loop',
+        type=str,
+        dest='event_loop',
+        choices=['selectors', 'asyncio'],
+        default='selectors',
+        help='event loop backend driving the remote shells [%(default)s]',
+    )
+    parser.add_argument(
+        '--parallel',
+        type=int,
+        dest='parallel',
+        default=0,
+        metavar='N',
+        help='run the command on at most N hosts at the same time, '
+        'non-interactive mode only, 0 for all of them [%(default)s]',
+    )
+    parser.add_argument(
+        '--max-handshakes',
+        type=int,
+        dest='max_handshakes',
+        default=0,
+        metavar='N',
+        help='connect to at most N hosts at the same time, 0 for no limit '
+        '[%(default)s]',
+    )
+    parser.add_argument(
+        '--connect-rate',
+        type=float,
+        dest='connect_rate',
+        default=0,
+        metavar='RATE',
+        help='start at most RATE connections per second, 0 for no limit '
+        '[%(default)s]',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        dest='workers',
+        default=1,
+        metavar='N',
+        help='split the remote shells across N worker processes '
+        '[%(default)s]',
+    )
     parser.add_argument(
         '--profile', action='store_true', dest='profile', default=False
     )
     parser.add_argument('host_names', nargs='*')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     for filename in args.hosts_filenames:
         try:
@@ -178,7 +302,9 @@ def parse_cmdline() -> argparse.Namespace:
 
     if args.log_file:
         try:
-            args.log_file = open(args.log_file, 'a')
+            args.log_file = LogWriter(
+                args.log_file, args.log_compress, args.log_max_size
+            )
         except OSError as e:
             print(e)
             sys.exit(1)
@@ -186,6 +312,13 @@ def parse_cmdline() -> argparse.Namespace:
     if not args.host_names:
         parser.error('no hosts given')
 
+    if args.parallel < 0:
+        parser.error('--parallel cannot be negative')
+    if args.max_handshakes < 0:
+        parser.error('--max-handshakes cannot be negative')
+    if args.connect_rate < 0:
+        parser.error('--connect-rate cannot be negative')
+
     if args.password_file == '-':
         args.password = getpass.getpass()
     elif args.password_file is not None:
@@ -227,6 +360,33 @@ def save_history(histfile: str) -> None:
 
 
 def loop(interactive: bool) -> None:
+    steps = _loop_steps(interactive)
+    timeout = next(steps)
+    while True:
+        try:
+            reads = remote_dispatcher.main_loop_iteration(timeout)
+        except (KeyboardInterrupt, ExitNow) as e:
+            timeout = steps.throw(e)
+        else:
+            timeout = steps.send(reads)
+
+
+async def _loop_async() -> None:
+    steps = _loop_steps(False)
+    timeout = next(steps)
+    while True:
+        try:
+            reads = await remote_dispatcher.main_loop_iteration_async(timeout)
+        except ExitNow as e:
+            timeout = steps.throw(e)
+        else:
+            timeout = steps.send(reads)
+
+
+def _loop_steps(interactive: bool) -> Generator[Optional[float], int, None]:
+    """The main loop, yielding the timeout of each event loop iteration and
+    getting back its number of reads, so that the iterations are either
+    blocking or awaited"""
     histfile = os.path.expanduser('~/.polysh_history')
     init_history(histfile)
     next_signal = None
@@ -242,17 +402,28 @@ def loop(interactive: bool) -> None:
                 control_commands.do_send_ctrl(ctrl)
                 console_output(b'')
                 stdin.the_stdin_thread.prepend_text = None
+            _schedule_reaping()
             _trace(f'loop top: awaited={dispatchers.count_awaited_processes()}')
+            quiet_deadline = time.monotonic() + QUIET_DELAY
             while dispatchers.count_awaited_processes()[0]:
-                if not remote_dispatcher.main_loop_iteration(timeout=0.2):
-                    # No events within timeout — check for dead children
-                    # that the selector missed (macOS kqueue pty quirk)
-                    _reap_dead_dispatchers()
+                if interactive:
+                    dispatchers.print_startup_progress()
+                now = time.monotonic()
+                if now >= quiet_deadline:
                     break
+                reads = yield quiet_deadline - now
+                # Nothing is read while the console is congested, which
+                # does not mean the remote shells are quiet
+                if reads or buffered_dispatcher.reads_paused():
+                    quiet_deadline = time.monotonic() + QUIET_DELAY
             # Now it's quiet
+            if interactive:
+                dispatchers.print_startup_progress()
             for r in dispatchers.all_instances():
                 r.print_unfinished_line()
             current_status = dispatchers.count_awaited_processes()
+            if not current_status[0]:
+                aggregation.print_results()
             if current_status != last_status:
                 console_output(b'')
             last_status = current_status
@@ -272,11 +443,8 @@ def loop(interactive: bool) -> None:
             if not next_signal:
                 # possible race here with the signal handler
                 _trace('blocking main_loop_iteration (waiting for input or remote data)')
-                # Use a timeout so we can periodically check for dead
-                # children.  On macOS, kqueue may not report pty master
-                # EOF, so the selector would block forever.
-                remote_dispatcher.main_loop_iteration(timeout=1.0)
-                _reap_dead_dispatchers()
+                # Timers (e.g. the reaping fallback) bound the wait
+                yield None
                 _trace('main_loop_iteration returned')
         except KeyboardInterrupt:
             if interactive:
@@ -292,6 +460,13 @@ def loop(interactive: bool) -> None:
             sys.exit(e.args[0])
 
 
+def create_selector(event_loop: str) -> selectors.BaseSelector:
+    """Return a new selector for the given --event-loop backend"""
+    if event_loop == 'asyncio':
+        return AsyncioSelector()
+    return selectors.DefaultSelector()
+
+
 def _profile(continuation: Callable) -> None:
     prof_file = 'polysh.prof'
     import cProfile
@@ -322,10 +497,95 @@ def run() -> None:
     args = parse_cmdline()
 
     args.command = find_non_interactive_command(args.command)
-    args.exit_code = 0
     args.interactive = (
         not args.command and sys.stdin.isatty() and sys.stdout.isatty()
     )
+    hosts = _setup(args)
+    if args.event_loop != 'selectors':
+        dispatcher_registry.set_selector(create_selector(args.event_loop))
+
+    if args.workers > 1 and not args.interactive:
+        sharding.run(hosts, args.workers)
+
+    if args.workers > 1:
+        sharding.start(hosts, args.workers)
+    else:
+        _start(hosts)
+
+    def _handle_sigwinch(signum, frame):
+        stdin.propagate_terminal_size()
+        dispatchers.update_terminal_size()
+        sharding.propagate_terminal_size()
+
+    signal.signal(signal.SIGWINCH, _handle_sigwinch)
+
+    stdin.the_stdin_thread = stdin.StdinThread(args.interactive)
+
+    if args.profile:
+
+        def safe_loop() -> None:
+            try:
+                loop(args.interactive)
+            except BaseException:
+                pass
+
+        _profile(safe_loop)
+    else:
+        loop(args.interactive)
+
+
+async def run_async(argv: List[str]) -> int:
+    """Run polysh non-interactively on the running asyncio event loop, and
+    return its exit code.  argv are the command line arguments, including
+    --command.  For applications running asyncio themselves, like automation
+    tools, polysh can only be run once per process."""
+    try:
+        args = parse_cmdline(argv)
+        if not args.command:
+            print('run_async() requires --command', file=sys.stderr)
+            sys.exit(1)
+        if args.workers > 1:
+            print('run_async() does not support --workers', file=sys.stderr)
+            sys.exit(1)
+        args.interactive = False
+        hosts = _setup(args)
+        dispatcher_registry.set_selector(
+            AsyncioSelector(asyncio.get_running_loop())
+        )
+        _start(hosts)
+        stdin.the_stdin_thread = stdin.StdinThread(False)
+        await _loop_async()
+    except SystemExit as e:
+        return e.code or 0
+    finally:
+        kill_all()
+        console.drain_output()
+        # No more callbacks on the event loop of the application
+        dispatcher_registry.set_selector(selectors.DefaultSelector())
+    return remote_dispatcher.options.exit_code
+
+
+def _setup(args: argparse.Namespace) -> List[str]:
+    """Check the options, set up the console and return the hosts"""
+    args.exit_code = 0
+    if args.parallel and args.interactive:
+        print('--parallel requires non-interactive mode', file=sys.stderr)
+        sys.exit(1)
+    if args.format == 'jsonl' and args.interactive:
+        print('--format=jsonl requires non-interactive mode', file=sys.stderr)
+        sys.exit(1)
+    if args.format == 'jsonl' and args.aggregate:
+        print(
+            '--format=jsonl and --aggregate are incompatible',
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    if args.workers > 1 and args.aggregate:
+        print('--workers and --aggregate are incompatible', file=sys.stderr)
+        sys.exit(1)
+    # Decided here so that sharded workers, whose stdout is a pipe, color the
+    # same way
+    args.disable_color = args.disable_color or not sys.stdout.isatty()
     if args.interactive:
         # Set up pty-based stdin interposition BEFORE saving tty settings,
         # so restore_tty_on_exit saves the pty slave's settings (which is
@@ -334,6 +594,8 @@ def run() -> None:
         restore_tty_on_exit()
 
     remote_dispatcher.options = args
+    console.open_stdout_writer()
+    atexit.register(console.drain_output)
 
     hosts = []  # type: List[str]
     for host in args.host_names:
@@ -341,7 +603,11 @@ def run() -> None:
 
     try:
         # stdin, stdout, stderr for polysh and each ssh connection
-        new_soft = 3 + len(hosts) * 3
+        # With --parallel, only that many of them at the same time
+        nr_alive = len(hosts)
+        if args.parallel:
+            nr_alive = min(nr_alive, args.parallel)
+        new_soft = 3 + nr_alive * 3
         old_soft, old_hard = resource.getrlimit(resource.RLIMIT_NOFILE)
         if new_soft > old_soft:
             # We are allowed to change the soft limit as we please but must be
@@ -356,27 +622,15 @@ def run() -> None:
         )
         sys.exit(1)
 
-    dispatchers.create_remote_dispatchers(hosts)
+    return hosts
 
-    def _handle_sigwinch(signum, frame):
-        stdin.propagate_terminal_size()
-        dispatchers.update_terminal_size()
 
-    signal.signal(signal.SIGWINCH, _handle_sigwinch)
-
-    stdin.the_stdin_thread = stdin.StdinThread(args.interactive)
+def _start(hosts: List[str]) -> None:
+    if spawn.forks():
+        # Fork a small process now rather than polysh once it has grown
+        forkserver.launch()
 
-    if args.profile:
-
-        def safe_loop() -> None:
-            try:
-                loop(args.interactive)
-            except BaseException:
-                pass
-
-        _profile(safe_loop)
-    else:
-        loop(args.interactive)
+    dispatchers.create_remote_dispatchers(hosts)
 
 
 def main():
@@ -16,14 +16,15 @@ Copyright (c) 2024 InnoGames GmbH
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import os
 import platform
-import pty
 import select
 import signal
 import sys
 import termios
-from typing import List, Optional
+import time
+from typing import List, Optional, Tuple, Union
 
 _TRACE = os.environ.get('POLYSH_TRACE')
 
@@ -32,9 +33,20 @@ def _trace(msg: str) -> None:
     if _TRACE:
         print(f'[trace] {msg}', file=sys.stderr, flush=True)
 
-from polysh import callbacks, display_names, event_loop
+from polysh import (
+    admission,
+    aggregation,
+    callbacks,
+    child_watcher,
+    display_names,
+    event_loop,
+    forkserver,
+    jsonl,
+    latency,
+    spawn,
+)
 from polysh.buffered_dispatcher import BufferedDispatcher
-from polysh.console import console_output
+from polysh.console import batched_output, console_output
 from polysh.exceptions import ExitNow
 
 options = None  # type: Optional[Namespace]
@@ -57,42 +69,68 @@ def main_loop_iteration(timeout: Optional[float] = None) -> int:
     """Return the number of RemoteDispatcher.handle_read() calls made by this
     iteration"""
     prev_nr_read = nr_handle_read
-    event_loop.loop_iteration(timeout=timeout)
+    # All the output of the iteration is written at once
+    with batched_output():
+        event_loop.loop_iteration(timeout=timeout)
     reads = nr_handle_read - prev_nr_read
     _trace(f'main_loop_iteration: timeout={timeout} reads={reads}')
     return reads
 
 
+async def main_loop_iteration_async(timeout: Optional[float] = None) -> int:
+    """Like main_loop_iteration(), awaiting the events on the running asyncio
+    event loop"""
+    prev_nr_read = nr_handle_read
+    with batched_output():
+        await event_loop.loop_iteration_async(timeout=timeout)
+    reads = nr_handle_read - prev_nr_read
+    _trace(f'main_loop_iteration_async: timeout={timeout} reads={reads}')
+    return reads
+
+
 def log(msg: bytes) -> None:
     if options.log_file:
-        fd = options.log_file.fileno()
-        while msg:
-            try:
-                written = os.write(fd, msg)
-            except OSError as e:
-                print('Exception while writing log:', options.log_file.name)
-                print(e)
-                raise ExitNow(1)
-            msg = msg[written:]
+        options.log_file.write(msg)
+
+
+def _prompt_line(trigger1: bytes, trigger2: bytes) -> bytes:
+    """Set a prompt made of the callback trigger, split so that the echo of
+    the command line does not trigger it, followed by the exit status of the
+    last command"""
+    return b'PS1="' + trigger1 + b'""' + trigger2 + b'"\'$?\'"\n"\n'
+
+
+@functools.lru_cache(maxsize=1)
+def _command_line(command: str) -> bytes:
+    """The non-interactive command, encoded once so that the write queues of
+    all the shells share the same bytes"""
+    return command.encode() + b'\n'
 
 
 class RemoteDispatcher(BufferedDispatcher):
     """A RemoteDispatcher is a ssh process we communicate with"""
 
-    def __init__(self, hostname: str, port: str) -> None:
+    def __init__(
+        self, hostname: str, port: str, display_name: Optional[str] = None
+    ) -> None:
         if port != '22':
             port = '-p ' + port
         else:
             port = ''
 
-        self.pid, fd = pty.fork()
-        if self.pid == 0:
-            # Child
-            self.launch_ssh(hostname, port)
-            sys.exit(1)
-
-        # Parent
+        self.pid, fd = self.launch_ssh(hostname, port)
         super().__init__(fd)
+        self.start_time = time.time()
+        # When the remote shell first printed its prompt
+        self.ready_time = None  # type: Optional[float]
+        # The wait status of the ssh process, once reaped
+        self.exit_status = None  # type: Optional[int]
+        if forkserver.running():
+            self.child_watcher = forkserver.watch(self.pid, self.child_exited)
+        else:
+            self.child_watcher = child_watcher.watch(
+                self.pid, self.child_exited
+            )
         self.temporary = False
         self.hostname = hostname
         self.port = port
@@ -101,25 +139,53 @@ class RemoteDispatcher(BufferedDispatcher):
         self.state = STATE_NOT_STARTED
         self.term_size = (-1, -1)
         self.display_name = None  # type: Optional[str]
-        self.change_name(self.hostname.encode())
+        if display_name is None:
+            self.change_name(self.hostname.encode())
+        else:
+            # Reserved when the host was queued
+            self.display_name = display_name
+        self.callbacks = callbacks.Callbacks()
+        # Position in the output (see read_base) before which the data not
+        # consumed yet was already searched for a password prompt
+        self.password_scan_pos = 0
         self.init_string = self.configure_tty() + self.set_prompt()
         self.init_string_sent = False
         self.read_in_state_not_started = b''
         self.command = options.command
         self.last_printed_line = b''
+        # When it was printed, to tell if it is from the running command
+        self.last_printed_time = 0.0
+        # The exit status of the last command of the user, from the prompt,
+        # not of the commands sent by polysh itself
+        self.last_status = None  # type: Optional[int]
+        self.user_command_done = False
+        # The number of lines of the user still waiting for their prompt
+        self.user_lines_sent = 0
+        self.real_prompt_seen = False
+        # When the current command was dispatched, and how long the last
+        # one took, in seconds
+        self.running_since = 0.0
+        self.last_latency = None  # type: Optional[float]
         self.color_code = None
-        if sys.stdout.isatty() and not options.disable_color:
+        # Cache of _line_prefixes()
+        self.line_prefixes = (b'', b'')
+        self.line_prefixes_key = None  # type: Optional[Tuple[str, int]]
+        if not options.disable_color:
             COLORS.insert(0, COLORS.pop())  # Rotate the colors
             self.color_code = COLORS[0]
 
-    def launch_ssh(self, name: str, port: str) -> None:
-        """Launch the ssh command in the child process"""
+    def launch_ssh(self, name: str, port: str) -> Tuple[int, int]:
+        """Launch the ssh command on a new pty, return its pid and the pty
+        master"""
         if options.user:
             name = '%s@%s' % (options.user, name)
         evaluated = options.ssh % {'host': name, 'port': port}
         if evaluated == options.ssh:
             evaluated = '%s %s' % (evaluated, name)
-        os.execlp('/bin/sh', 'sh', '-c', evaluated)
+        args = spawn.ssh_args(options.ssh, name, port)
+        if forkserver.running():
+            return forkserver.start(args, evaluated)
+        return spawn.start(args, evaluated)
 
     def set_enabled(self, enabled: bool) -> None:
         if enabled != self.enabled and options.interactive:
@@ -135,9 +201,24 @@ class RemoteDispatcher(BufferedDispatcher):
             _trace(f'{self.hostname}: state {STATE_NAMES[self.state]} -> {STATE_NAMES[state]}')
             if self.debug:
                 self.print_debug(b'state => ' + STATE_NAMES[state].encode())
-            if self.state is STATE_NOT_STARTED:
-                self.read_in_state_not_started = b''
+            previous = self.state
             self.state = state
+            if previous is STATE_NOT_STARTED:
+                self.read_in_state_not_started = b''
+            elif previous is STATE_RUNNING:
+                if options.aggregate:
+                    aggregation.command_done(self)
+                self.last_latency = time.monotonic() - self.running_since
+                latency.command_done(self.last_latency)
+            if state is STATE_RUNNING:
+                self.running_since = time.monotonic()
+                latency.command_started()
+            self.update_interest()
+            # Last, as they may start other shells
+            if previous is STATE_NOT_STARTED:
+                admission.handshake_done()
+            if state is STATE_DEAD:
+                admission.shell_dead()
 
     def disconnect(self) -> None:
         """We are no more interested in this remote process"""
@@ -147,16 +228,29 @@ class RemoteDispatcher(BufferedDispatcher):
         except OSError as e:
             # The process was already dead, no problem
             _trace(f'{self.hostname}: kill(-{self.pid}) failed: {e}')
-        self.read_buffer = b''
-        self.write_buffer = b''
+        self.clear_read_buffer()
+        self.clear_write_queue()
+        self.callbacks.clear()
         self.set_enabled(False)
-        if self.read_in_state_not_started:
-            self.print_lines(self.read_in_state_not_started)
-            self.read_in_state_not_started = b''
+        self.print_read_in_state_not_started()
+        if options.format == 'jsonl' and self.state is not STATE_DEAD:
+            if self.exit_status is None:
+                exit_code = None
+            elif os.WIFEXITED(self.exit_status):
+                exit_code = os.WEXITSTATUS(self.exit_status)
+            else:
+                exit_code = 1
+            console_output(jsonl.exit_record(self, exit_code), logging_msg=b'')
         if options.abort_error and self.state is STATE_NOT_STARTED:
             raise ExitNow(1)
         self.change_state(STATE_DEAD)
 
+    def print_read_in_state_not_started(self) -> None:
+        """Print what was read before the remote shell started"""
+        if self.read_in_state_not_started:
+            self.print_lines(self.read_in_state_not_started)
+            self.read_in_state_not_started = b''
+
     def configure_tty(self) -> bytes:
         """We don't want \n to be replaced with \r\n, and we disable the echo"""
         attr = termios.tcgetattr(self.fd)
@@ -169,14 +263,39 @@ class RemoteDispatcher(BufferedDispatcher):
         # unsetopt zle prevents Zsh from resetting the tty
         return b'unsetopt zle 2> /dev/null;stty -echo -onlcr -ctlecho; bind "set enable-bracketed-paste off" 2> /dev/null;'
 
-    def seen_prompt_cb(self, unused: str) -> None:
+    def record_status(self, status: bytes) -> None:
+        """The prompt shows the exit status of the command that just
+        completed"""
+        self.user_command_done = True
+        try:
+            self.last_status = int(status)
+        except ValueError:
+            # This shell does not expand $? in its prompt
+            self.last_status = None
+
+    def real_prompt_cb(self, status: bytes) -> None:
+        """The prompt after each line of the non-interactive command, except
+        the first one that follows the PS1 assignment"""
+        if self.real_prompt_seen:
+            self.record_status(status)
+        self.real_prompt_seen = True
+
+    def seen_prompt_cb(self, status: bytes) -> None:
         _trace(f'{self.hostname}: seen_prompt_cb, interactive={options.interactive}')
+        if self.ready_time is None:
+            self.ready_time = time.time()
+        if self.user_lines_sent:
+            # With several lines, the status of the last one is kept
+            self.user_lines_sent -= 1
+            self.record_status(status)
         if options.interactive:
             self.change_state(STATE_IDLE)
         elif self.command:
-            p1, p2 = callbacks.add(b'real prompt ends', lambda d: None, True)
-            self.dispatch_command(b'PS1="' + p1 + b'""' + p2 + b'\n"\n')
-            self.dispatch_command(self.command.encode() + b'\n')
+            p1, p2 = self.callbacks.add(
+                b'real prompt ends', self.real_prompt_cb, True
+            )
+            self.dispatch_command(_prompt_line(p1, p2))
+            self.dispatch_command(_command_line(self.command))
             self.dispatch_command(b'exit 2>/dev/null\n')
             self.command = None
 
@@ -189,10 +308,17 @@ class RemoteDispatcher(BufferedDispatcher):
         command_line += b'TERM=ansi;'
         command_line += b'unset precmd_functions;'
         command_line += b'unset HISTFILE;'
-        prompt1, prompt2 = callbacks.add(b'prompt', self.seen_prompt_cb, True)
-        command_line += b'PS1="' + prompt1 + b'""' + prompt2 + b'\n"\n'
+        prompt1, prompt2 = self.callbacks.add(
+            b'prompt', self.seen_prompt_cb, True
+        )
+        command_line += _prompt_line(prompt1, prompt2)
         return command_line
 
+    def reset_prompt(self) -> None:
+        """Configure the remote shell again, e.g. after it was replaced by
+        another program"""
+        self.dispatch_command(self.init_string)
+
     def readable(self) -> bool:
         """We are always interested in reading from active remote processes if
         the buffer is OK"""
@@ -214,64 +340,126 @@ class RemoteDispatcher(BufferedDispatcher):
             _trace(f'{self.hostname}: handle_close() skipped, already DEAD')
             return
 
-        _trace(f'{self.hostname}: calling waitpid({self.pid}, 0)')
-        pid, status = os.waitpid(self.pid, 0)
+        if self.exit_status is None:
+            _trace(f'{self.hostname}: waiting for {self.pid}')
+            if self.child_watcher is not None:
+                self.exit_status = self.child_watcher.wait()
+            else:
+                pid, self.exit_status = os.waitpid(self.pid, 0)
+        status = self.exit_status
         exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
-        _trace(f'{self.hostname}: waitpid returned pid={pid} status={status} exit_code={exit_code}')
+        _trace(f'{self.hostname}: status={status} exit_code={exit_code}')
         options.exit_code = max(options.exit_code, exit_code)
         if exit_code and options.interactive:
             console_output(f'Error talking to {self.display_name}\n'.encode())
         self.disconnect()
         if self.temporary:
             self.close()
+        elif options.parallel:
+            # The pty is freed for the next hosts, but not the name so that
+            # they do not show the same one
+            BufferedDispatcher.close(self)
+
+    def child_exited(self, status: int) -> None:
+        """The child watcher reaped our ssh process"""
+        self.exit_status = status
+        if self.state is STATE_DEAD:
+            return
+        # Process what the ssh process wrote before exiting
+        try:
+            self.handle_read()
+        except OSError:
+            pass
+        self.handle_close()
+
+    def _line_prefixes(self) -> Tuple[bytes, bytes]:
+        """Return the console and log prefixes of the output lines, they are
+        only rebuilt when the display name or its alignment changes"""
+        key = (self.display_name, display_names.max_display_name_length)
+        if key != self.line_prefixes_key:
+            indent = key[1] - len(self.display_name)
+            log_prefix = self.display_name.encode() + indent * b' ' + b' : '
+            if self.color_code is None:
+                console_prefix = log_prefix
+            else:
+                console_prefix = (
+                    b'\033[1;'
+                    + str(self.color_code).encode()
+                    + b'm'
+                    + log_prefix
+                    + b'\033[1;m'
+                )
+            self.line_prefixes = (console_prefix, log_prefix)
+            self.line_prefixes_key = key
+        return self.line_prefixes
 
     def print_lines(self, lines: bytes) -> None:
-        from polysh.display_names import max_display_name_length
-
-        lines = lines.strip(b'\n')
-        while True:
-            no_empty_lines = lines.replace(b'\n\n', b'\n')
-            if len(no_empty_lines) == len(lines):
-                break
-            lines = no_empty_lines
-        if not lines:
+        # Empty lines are dropped
+        split_lines = [line for line in lines.split(b'\n') if line]
+        if not split_lines:
             return
-        indent = max_display_name_length - len(self.display_name)
-        log_prefix = self.display_name.encode() + indent * b' ' + b' : '
-        if self.color_code is None:
-            console_prefix = log_prefix
+        console_prefix, log_prefix = self._line_prefixes()
+        log_data = log_prefix + (b'\n' + log_prefix).join(split_lines) + b'\n'
+        if options.aggregate and self.state is STATE_RUNNING:
+            # Printed by aggregation.print_results() with the same output of
+            # the other shells
+            log(log_data)
+            aggregation.add_lines(self, split_lines)
+        elif options.format == 'jsonl':
+            if self.state is STATE_NOT_STARTED:
+                # Printed by ssh before the remote shell started
+                stream = 'ssh'
+            else:
+                stream = 'stdout'
+            console_output(
+                jsonl.line_records(self, stream, split_lines),
+                logging_msg=log_data,
+            )
         else:
-            console_prefix = (
-                b'\033[1;'
-                + str(self.color_code).encode()
-                + b'm'
-                + log_prefix
-                + b'\033[1;m'
+            console_data = (
+                console_prefix
+                + (b'\n' + console_prefix).join(split_lines)
+                + b'\n'
             )
-        console_data = (
-            console_prefix
-            + lines.replace(b'\n', b'\n' + console_prefix)
-            + b'\n'
+            console_output(console_data, logging_msg=log_data)
+        self.last_printed_line = split_lines[-1]
+        self.last_printed_time = time.monotonic()
+
+    def _find_trigger(self) -> int:
+        """Index in read_buffer of the first callback trigger not consumed
+        yet, or -1"""
+        pos = self.callbacks.find(
+            self.read_buffer,
+            self.read_base,
+            self.read_base + self.read_offset,
         )
-        log_data = (
-            log_prefix + lines.replace(b'\n', b'\n' + log_prefix) + b'\n'
+        return pos - self.read_base if pos >= 0 else -1
+
+    def _find_password_prompt(self) -> bool:
+        """Whether the data not consumed yet asks for a password, only the
+        new data is searched"""
+        prompt = b'password:'
+        start = max(
+            self.read_offset,
+            self.password_scan_pos - self.read_base - len(prompt) + 1,
         )
-        console_output(console_data, logging_msg=log_data)
-        self.last_printed_line = lines[lines.rfind(b'\n') + 1 :]
+        self.password_scan_pos = self.read_base + len(self.read_buffer)
+        return prompt in self._read_data(start).lower()
 
-    def handle_read_fast_case(self, data: bytes) -> bool:
+    def handle_read_fast_case(self) -> bool:
         """If we are in a fast case we'll avoid the long processing of each
         line"""
-        if self.state is not STATE_RUNNING or callbacks.any_in(data):
+        if self.state is not STATE_RUNNING or self._find_trigger() >= 0:
             # Slow case :-(
             return False
 
-        last_nl = data.rfind(b'\n')
+        last_nl = self._find_newline(last=True)
         if last_nl == -1:
             # No '\n' in data => slow case
             return False
-        self.read_buffer = data[last_nl + 1 :]
-        self.print_lines(data[:last_nl])
+        lines = self._read_data(self.read_offset, last_nl)
+        self.consume_read(last_nl + 1)
+        self.print_lines(lines)
         return True
 
     def handle_read(self) -> None:
@@ -282,29 +470,27 @@ class RemoteDispatcher(BufferedDispatcher):
         global nr_handle_read
         nr_handle_read += 1
         _trace(f'{self.hostname}: handle_read state={STATE_NAMES[self.state]}')
-        new_data = self._handle_read_chunk()
+        new_data_start = len(self.read_buffer)
+        self._handle_read_chunk()
         if self.debug:
-            self.print_debug(b'==> ' + new_data)
-        if self.handle_read_fast_case(self.read_buffer):
+            self.print_debug(b'==> ' + self._read_data(new_data_start))
+        if self.handle_read_fast_case():
             return
-        lf_pos = new_data.find(b'\n')
-        if lf_pos >= 0:
-            # Optimization: we knew there were no '\n' in the previous read
-            # buffer, so we searched only in the new_data and we offset the
-            # found index by the length of the previous buffer
-            lf_pos += len(self.read_buffer) - len(new_data)
-        elif (
-            self.state is STATE_NOT_STARTED
+        lf_pos = self._find_newline()
+        if (
+            lf_pos < 0
+            and self.state is STATE_NOT_STARTED
             and options.password is not None
-            and b'password:' in self.read_buffer.lower()
+            and self._find_password_prompt()
         ):
             self.dispatch_write(f'{options.password}\n'.encode())
-            self.read_buffer = b''
+            self.clear_read_buffer()
             return
         while lf_pos >= 0:
             # For each line in the buffer
-            line = self.read_buffer[: lf_pos + 1]
-            if callbacks.process(line):
+            line = self._read_data(self.read_offset, lf_pos + 1)
+            trigger = self._find_trigger()
+            if 0 <= trigger <= lf_pos and self.callbacks.process(line):
                 pass
             elif self.state in (STATE_IDLE, STATE_RUNNING):
                 self.print_lines(line)
@@ -325,10 +511,10 @@ class RemoteDispatcher(BufferedDispatcher):
                     )
 
             # Go to the next line in the buffer
-            self.read_buffer = self.read_buffer[lf_pos + 1 :]
-            if self.handle_read_fast_case(self.read_buffer):
+            self.consume_read(lf_pos + 1)
+            if self.handle_read_fast_case():
                 return
-            lf_pos = self.read_buffer.find(b'\n')
+            lf_pos = self._find_newline()
         if self.state is STATE_NOT_STARTED and not self.init_string_sent:
             self.dispatch_write(self.init_string)
             self.init_string_sent = True
@@ -336,9 +522,11 @@ class RemoteDispatcher(BufferedDispatcher):
     def print_unfinished_line(self) -> None:
         """The unfinished line stayed long enough in the buffer to be printed"""
         if self.state is STATE_RUNNING:
-            if not callbacks.process(self.read_buffer):
-                self.print_lines(self.read_buffer)
-            self.read_buffer = b''
+            line = self._read_data(self.read_offset)
+            if self._find_trigger() < 0 or not self.callbacks.process(line):
+                self.print_lines(line)
+            self.clear_read_buffer()
+            self.update_interest()
 
     def writable(self) -> bool:
         """Do we want to write something?"""
@@ -346,11 +534,14 @@ class RemoteDispatcher(BufferedDispatcher):
 
     def handle_write(self) -> None:
         """Let's write as much as we can"""
-        num_sent = self.send(self.write_buffer)
-        if self.debug:
-            if self.state is not STATE_NOT_STARTED or options.password is None:
-                self.print_debug(b'<== ' + self.write_buffer[:num_sent])
-        self.write_buffer = self.write_buffer[num_sent:]
+        if self.debug and (
+            self.state is not STATE_NOT_STARTED or options.password is None
+        ):
+            pending = b''.join(self.write_queue)
+            num_sent = self.send_queued()
+            self.print_debug(b'<== ' + pending[:num_sent])
+        else:
+            self.send_queued()
 
     def print_debug(self, msg: bytes) -> None:
         """Log some debugging information to the console"""
@@ -374,15 +565,26 @@ class RemoteDispatcher(BufferedDispatcher):
             self.last_printed_line.strip(),
         ]
 
-    def dispatch_write(self, buf: bytes) -> bool:
+    def dispatch_write(self, buf: Union[bytes, memoryview]) -> bool:
         """There is new stuff to write when possible"""
         if self.state != STATE_DEAD and self.enabled:
             super().dispatch_write(buf)
             return True
         return False
 
-    def dispatch_command(self, command: bytes) -> None:
+    def dispatch_command(
+        self, command: Union[bytes, memoryview], user_lines: int = 0
+    ) -> None:
+        """Send a command, made of user_lines lines typed by the user, or
+        sent by polysh itself if 0"""
         if self.dispatch_write(command):
+            if user_lines:
+                self.user_lines_sent += user_lines
+            else:
+                # Lines continuing a shell construct have no prompt, so the
+                # count may be off, but the prompts of polysh's commands
+                # must not count
+                self.user_lines_sent = 0
             self.change_state(STATE_RUNNING)
 
     def change_name(self, new_name: Optional[bytes]) -> None:
@@ -392,13 +594,19 @@ class RemoteDispatcher(BufferedDispatcher):
             name = self.hostname
         else:
             name = new_name.decode()
+        if options.interactive and options.workers > 1:
+            from polysh import sharding
+
+            # The other workers must take the same name, in the same order
+            sharding.request_name(self, name)
+            return
         self.display_name = display_names.change(self.display_name, name)
 
     def rename(self, name: bytes) -> None:
         """Send to the remote shell, its new name to be shell expanded"""
         if name:
             # defug callback add?
-            rename1, rename2 = callbacks.add(
+            rename1, rename2 = self.callbacks.add(
                 b'rename', self.change_name, False
             )
             self.dispatch_command(
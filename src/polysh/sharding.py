@@ -0,0 +1,798 @@
+"""Polysh - Sharded Fan-out
+
+The remote shells can be split across several worker processes so that
+reading, line splitting and formatting of the remote output use more than
+one core.  Each worker owns the ptys and state machines of its subset of
+hosts.  All the workers reserve the display names and colors of all the
+hosts in the same order, so that they are the same as without sharding.
+
+In non-interactive mode, each worker writes its formatted console output to
+a pipe.  The coordinator merges these pipes line by line on its stdout and
+aggregates the exit codes.
+
+In interactive mode, the coordinator keeps the prompt, the control commands
+and the console.  Each worker is connected to it by a socket carrying
+messages both ways.  The workers send their console output and the changes
+of the states of their shells, which the coordinator mirrors in a
+ShellProxy per shell.  The control commands act on the proxies, which
+forward the calls to the workers.  The display names are changed by the
+coordinator only, and the changes broadcast to all the workers so that
+they stay unique and aligned.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import itertools
+import os
+import pickle
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from polysh import (
+    admission,
+    buffered_dispatcher,
+    console,
+    dispatcher_registry,
+    dispatchers,
+    display_names,
+    event_loop,
+    latency,
+    remote_dispatcher,
+)
+from polysh.buffered_dispatcher import BufferedDispatcher
+from polysh.console import batched_output, console_output
+from polysh.exceptions import ExitNow
+from polysh.log_writer import LogWriter
+
+_TRACE = os.environ.get('POLYSH_TRACE')
+
+
+def _trace(msg: str) -> None:
+    if _TRACE:
+        print(f'[trace] {msg}', file=sys.stderr, flush=True)
+
+
+class WorkerOutputDispatcher(BufferedDispatcher):
+    """The coordinator end of the pipe carrying the console output of a
+    worker.  Only complete lines are copied to stdout, so that the output of
+    different workers is never interleaved within a line."""
+
+    def __init__(self, fd: int, pid: int) -> None:
+        super().__init__(fd)
+        self.pid = pid
+
+    def handle_read(self) -> None:
+        self._handle_read_chunk()
+        last_nl = self._find_newline(last=True)
+        if last_nl >= 0:
+            console.safe_write(self._read_data(self.read_offset, last_nl + 1))
+            self.consume_read(last_nl + 1)
+
+    def writable(self) -> bool:
+        return False
+
+    def handle_close(self) -> None:
+        _trace(f'worker {self.pid}: output closed')
+        if self.read_buffer_size():
+            console.safe_write(self._read_data(self.read_offset))
+            self.clear_read_buffer()
+        self.close()
+
+
+# The messages of the interactive mode are pickled tuples, each preceded by
+# its length
+_HEADER = struct.Struct('!I')
+
+
+class Channel(BufferedDispatcher):
+    """An end of the socket between the coordinator and an interactive
+    worker"""
+
+    def __init__(self, sock: socket.socket) -> None:
+        # Closed by close(), not when garbage collected
+        self.socket = sock
+        super().__init__(sock.fileno())
+
+    def send_message(self, *msg: Any) -> None:
+        data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+        self.dispatch_write(_HEADER.pack(len(data)))
+        self.dispatch_write(data)
+
+    def send_segments(self, segments: List[memoryview]) -> int:
+        # A closed peer is reported by an error rather than SIGPIPE
+        return self.socket.sendmsg(
+            segments, (), getattr(socket, 'MSG_NOSIGNAL', 0)
+        )
+
+    def handle_read(self) -> None:
+        # The messages are not text, _handle_read_chunk() would alter them
+        try:
+            data = os.read(self.fd, self.MAX_READ_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            self.handle_close()
+            return
+        self.read_buffer += data
+        while self.read_buffer_size() >= _HEADER.size:
+            (length,) = _HEADER.unpack_from(self.read_buffer, self.read_offset)
+            start = self.read_offset + _HEADER.size
+            if len(self.read_buffer) < start + length:
+                break
+            msg = pickle.loads(self._read_data(start, start + length))
+            self.consume_read(start + length)
+            self.handle_message(*msg)
+            if dispatcher_registry.get_dispatcher(self.fd) is not self:
+                # Closed by the message
+                return
+
+    def handle_message(self, kind: str, *args: Any) -> None:
+        getattr(self, 'handle_' + kind)(*args)
+
+    def handle_write(self) -> None:
+        try:
+            self.send_queued()
+        except BlockingIOError:
+            pass
+
+    def close(self) -> None:
+        self.clear_write_queue()
+        # The fd is closed by BufferedDispatcher.close()
+        self.socket.detach()
+        super().close()
+
+
+class ShellProxy:
+    """The mirror in the coordinator of a remote shell run by a worker.  It
+    has the attributes of a RemoteDispatcher used by the control commands,
+    and forwards its method calls to the worker."""
+
+    def __init__(
+        self, channel: 'WorkerChannel', key: int, values: Tuple
+    ) -> None:
+        self.channel = channel
+        self.key = key
+        # The coordinator owns the display name once the shell is known
+        self.display_name = values[0]
+        self.hostname = values[1]
+        self.pid = values[2]
+        # Watched by its worker
+        self.child_watcher = channel
+        self.enabled = True
+        self.state = values[4]
+        self._debug = remote_dispatcher.options.debug
+        self.update(values)
+
+    def update(self, values: Tuple) -> None:
+        """The worker reported new values for the attributes of the shell.
+        The enabled flag and the state are only applied by sync(), as the
+        coordinator changes them itself before the worker catches up."""
+        (
+            _,
+            _,
+            _,
+            self.reported_enabled,
+            self.reported_state,
+            self.last_printed_line,
+            self.last_printed_time,
+            self.last_status,
+            self.user_command_done,
+            self.running_since,
+            self.nr_read_bytes,
+            self.nr_read_syscalls,
+            self.read_size,
+            self.nr_unread_bytes,
+            self.read_in_state_not_started,
+        ) = values
+
+    def sync(self) -> None:
+        """The worker processed all our messages, its values are current"""
+        self._set_enabled(self.reported_enabled)
+        self.state = self.reported_state
+
+    def _set_enabled(self, enabled: bool) -> None:
+        if enabled != self.enabled:
+            # The other workers follow the alignment changes of our shell
+            display_names.set_enabled(self.display_name, enabled)
+            for channel in _channels:
+                if channel is not self.channel:
+                    channel.send_message('enabled', self.display_name, enabled)
+        self.enabled = enabled
+
+    def _call(self, method: str, *args: Any) -> None:
+        self.channel.send_message('call', self.key, method, args)
+
+    get_info = remote_dispatcher.RemoteDispatcher.get_info
+    read_stats = BufferedDispatcher.read_stats
+
+    @property
+    def debug(self) -> bool:
+        return self._debug
+
+    @debug.setter
+    def debug(self, debug: bool) -> None:
+        self._debug = debug
+        self.channel.send_message('debug', self.key, debug)
+
+    def read_buffer_size(self) -> int:
+        return self.nr_unread_bytes
+
+    def print_unfinished_line(self) -> None:
+        # Printed by the worker
+        pass
+
+    def dispatch_write(self, buf: Union[bytes, memoryview]) -> bool:
+        if self.state != remote_dispatcher.STATE_DEAD and self.enabled:
+            self._call('dispatch_write', bytes(buf))
+            return True
+        return False
+
+    def dispatch_command(
+        self, command: Union[bytes, memoryview], user_lines: int = 0
+    ) -> None:
+        if self.state != remote_dispatcher.STATE_DEAD and self.enabled:
+            self._call('dispatch_command', bytes(command), user_lines)
+            self.state = remote_dispatcher.STATE_RUNNING
+
+    def reset_prompt(self) -> None:
+        self._call('reset_prompt')
+
+    def rename(self, name: bytes) -> None:
+        self._call('rename', name)
+
+    def print_read_in_state_not_started(self) -> None:
+        self._call('print_read_in_state_not_started')
+
+    def set_enabled(self, enabled: bool) -> None:
+        self._set_enabled(enabled)
+        self._call('set_enabled', enabled)
+
+    def disconnect(self) -> None:
+        self._set_enabled(False)
+        self.state = remote_dispatcher.STATE_DEAD
+        self._call('disconnect')
+
+    def close(self) -> None:
+        del dispatchers.shell_proxies[self.key]
+        del self.channel.proxies[self.key]
+        self.channel.closed.add(self.key)
+        display_names.change(self.display_name, None)
+        for channel in _channels:
+            if channel is self.channel:
+                channel.send_message('close_shell', self.key)
+            else:
+                channel.send_message('forget', self.display_name)
+
+
+class WorkerChannel(Channel):
+    """The coordinator end of the socket of an interactive worker"""
+
+    def __init__(self, sock: socket.socket, shard: int, pid: int) -> None:
+        super().__init__(sock)
+        self.shard = shard
+        self.pid = pid
+        self.nr_sent = 0
+        # Whether the worker processed all our messages when it last
+        # reported
+        self.synced = True
+        self.proxies = {}  # type: Dict[int, ShellProxy]
+        # The keys of the shells closed since the worker was last synced,
+        # whose older reports are ignored
+        self.closed = set()  # type: Set[int]
+        self.nr_commands = 0
+        self.latencies = []  # type: List[float]
+
+    def send_message(self, *msg: Any) -> None:
+        self.nr_sent += 1
+        super().send_message(*msg)
+
+    def readable(self) -> bool:
+        # The output of the worker goes to the console
+        return not buffered_dispatcher.reads_paused()
+
+    def handle_output(self, data: bytes) -> None:
+        # Counted as a read of the remote shells by the main loop
+        remote_dispatcher.nr_handle_read += 1
+        # Logged by the worker
+        console_output(data, logging_msg=b'')
+
+    def handle_state(
+        self,
+        shells: Dict[int, Tuple],
+        nr_received: int,
+        progress: Tuple[int, int],
+        exit_code: int,
+        latency_state: Tuple[int, int, List[float]],
+    ) -> None:
+        synced = nr_received == self.nr_sent
+        for key, values in shells.items():
+            if key in self.closed:
+                continue
+            proxy = self.proxies.get(key)
+            if proxy is None:
+                proxy = ShellProxy(self, key, values)
+                self.proxies[key] = proxy
+                dispatchers.shell_proxies[key] = proxy
+            else:
+                proxy.update(values)
+            if synced and self.synced:
+                proxy.sync()
+        if synced:
+            if not self.synced:
+                for proxy in self.proxies.values():
+                    proxy.sync()
+            self.closed.clear()
+            admission.set_shard_progress(self.shard, *progress)
+        self.synced = synced
+        options = remote_dispatcher.options
+        options.exit_code = max(options.exit_code, exit_code)
+        nr_commands, nr_running, new_latencies = latency_state
+        if nr_commands != self.nr_commands:
+            self.nr_commands = nr_commands
+            self.latencies = []
+        self.latencies.extend(new_latencies)
+        latency.set_shard_state(self.shard, nr_running, self.latencies)
+
+    def handle_rename(self, key: int, name: str) -> None:
+        proxy = self.proxies.get(key)
+        if proxy is None:
+            return
+        prev_name = proxy.display_name
+        try:
+            proxy.display_name = display_names.change(prev_name, name)
+        except Exception as e:
+            console_output(f'{e}\n'.encode())
+            return
+        for channel in _channels:
+            owned = channel is self
+            channel.send_message('name', prev_name, name, key if owned else None)
+
+    def handle_close(self) -> None:
+        self.close()
+        _, status = os.waitpid(self.pid, 0)
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+        _trace(f'worker {self.pid} exited with {code}')
+        console_output(f'Worker {self.shard} exited\n'.encode())
+        raise ExitNow(max(code, 1))
+
+
+class CoordinatorChannel(Channel):
+    """The worker end of the socket to the coordinator, it is also the
+    console of the worker"""
+
+    def __init__(self, sock: socket.socket, shard: int, nr_workers: int):
+        super().__init__(sock)
+        self.shard = shard
+        self.nr_workers = nr_workers
+        self.nr_received = 0
+        # The keys are unique across the workers
+        self.key_sequence = itertools.count()
+        self.keys = {}  # type: Dict[remote_dispatcher.RemoteDispatcher, int]
+        self.shells = {}  # type: Dict[int, remote_dispatcher.RemoteDispatcher]
+        # The values last sent for each shell and for the whole worker
+        self.states = {}  # type: Dict[int, Tuple]
+        self.last_state = None  # type: Optional[Tuple]
+        self.nr_commands = 0
+        self.nr_latencies_sent = 0
+
+    def readable(self) -> bool:
+        # The input is paused while the remote shells cannot take more
+        return not buffered_dispatcher.congested()
+
+    def write(self, buffers: List[bytes]) -> None:
+        """The console output of the worker"""
+        data = b''.join(buffers)
+        if data:
+            self.send_message('output', data)
+
+    def write_congestion_changed(self, congested: bool) -> None:
+        buffered_dispatcher.pause_reads(congested)
+
+    def key(self, shell: remote_dispatcher.RemoteDispatcher) -> int:
+        key = self.keys.get(shell)
+        if key is None:
+            key = self.shard + self.nr_workers * next(self.key_sequence)
+            self.keys[shell] = key
+            self.shells[key] = shell
+        return key
+
+    def send_state(self) -> None:
+        """Send what changed since the last call"""
+        shells = {}
+        for shell in dispatcher_registry.iter_dispatchers():
+            if not isinstance(shell, remote_dispatcher.RemoteDispatcher):
+                continue
+            key = self.key(shell)
+            values = (
+                shell.display_name,
+                shell.hostname,
+                shell.pid,
+                shell.enabled,
+                shell.state,
+                shell.last_printed_line,
+                shell.last_printed_time,
+                shell.last_status,
+                shell.user_command_done,
+                shell.running_since,
+                shell.nr_read_bytes,
+                shell.nr_read_syscalls,
+                shell.read_size,
+                shell.read_buffer_size(),
+                bool(shell.read_in_state_not_started),
+            )
+            if self.states.get(key) != values:
+                self.states[key] = values
+                shells[key] = values
+        nr_commands, nr_running, latencies = latency.current()
+        if nr_commands != self.nr_commands:
+            self.nr_commands = nr_commands
+            self.nr_latencies_sent = 0
+        new_latencies = latencies[self.nr_latencies_sent :]
+        self.nr_latencies_sent = len(latencies)
+        state = (
+            self.nr_received,
+            admission.progress(),
+            remote_dispatcher.options.exit_code,
+            (nr_commands, nr_running, new_latencies),
+        )
+        if shells or state != self.last_state:
+            self.last_state = state
+            self.send_message('state', shells, *state)
+
+    def handle_message(self, kind: str, *args: Any) -> None:
+        self.nr_received += 1
+        super().handle_message(kind, *args)
+
+    def handle_input(self, data: bytes) -> None:
+        from polysh import stdin
+
+        stdin.dispatch_input(data)
+
+    def handle_call(self, key: int, method: str, args: Tuple) -> None:
+        shell = self.shells.get(key)
+        if shell is not None:
+            getattr(shell, method)(*args)
+
+    def handle_debug(self, key: int, debug: bool) -> None:
+        shell = self.shells.get(key)
+        if shell is not None:
+            shell.debug = debug
+
+    def handle_close_shell(self, key: int) -> None:
+        shell = self.shells.pop(key, None)
+        if shell is not None:
+            del self.keys[shell]
+            self.states.pop(key, None)
+            shell.close()
+
+    def handle_add(self, hosts: List[str], shards: List[int]) -> None:
+        _add_hosts(hosts, shards, self.shard)
+
+    def handle_forget(self, name: str) -> None:
+        display_names.change(name, None)
+
+    def handle_name(
+        self, prev_name: str, prefix: str, key: Optional[int]
+    ) -> None:
+        name = display_names.change(prev_name, prefix)
+        shell = self.shells.get(key)
+        if shell is not None:
+            shell.display_name = name
+
+    def handle_enabled(self, name: str, enabled: bool) -> None:
+        display_names.set_enabled(name, enabled)
+
+    def handle_log(self, path: Optional[str]) -> None:
+        options = remote_dispatcher.options
+        if options.log_file:
+            options.log_file.close()
+            options.log_file = None
+        if path:
+            try:
+                options.log_file = LogWriter(
+                    path, options.log_compress, options.log_max_size
+                )
+            except OSError:
+                # Reported by the coordinator
+                pass
+
+    def handle_chdir(self, path: str) -> None:
+        try:
+            os.chdir(path)
+        except OSError:
+            # Reported by the coordinator
+            pass
+
+    def handle_close(self) -> None:
+        _trace(f'shard {self.shard}: coordinator gone')
+        self.close()
+        raise ExitNow(0)
+
+
+def _share(limit: int, nr_workers: int, shard: int) -> int:
+    """The part of a limit for the whole fleet given to a shard, the sum
+    of the parts is the limit"""
+    share, remainder = divmod(limit, nr_workers)
+    return share + (shard < remainder)
+
+
+def _cap_nr_workers(hosts: List[str], nr_workers: int) -> int:
+    """No more workers than hosts, each of them is allowed at least one
+    shell of the admission limits"""
+    nr_workers = min(nr_workers, len(hosts))
+    options = remote_dispatcher.options
+    for limit in options.max_handshakes, options.parallel:
+        if limit:
+            nr_workers = min(nr_workers, limit)
+    return nr_workers
+
+
+def _start_worker(nr_workers: int, shard: int) -> None:
+    """Start over in a forked worker, with its share of the admission
+    limits"""
+    from polysh.main import create_selector
+
+    options = remote_dispatcher.options
+    # The selector and dispatchers inherited from the coordinator are shared
+    # with it through fork(), each worker starts from a fresh registry
+    for inherited in dispatcher_registry.all_dispatchers():
+        if isinstance(inherited, Channel):
+            # Not closed again when garbage collected
+            inherited.socket.detach()
+        os.close(inherited.fd)
+    dispatcher_registry.reset(create_selector(options.event_loop))
+
+    # The admission limits are for the whole fleet, shared by the workers
+    if options.max_handshakes:
+        options.max_handshakes = _share(
+            options.max_handshakes, nr_workers, shard
+        )
+    if options.parallel:
+        options.parallel = _share(options.parallel, nr_workers, shard)
+    options.connect_rate /= nr_workers
+
+
+def _add_hosts(hosts: List[str], shards: List[int], shard: int) -> None:
+    """Start the hosts of our shard"""
+    for host, host_shard in zip(hosts, shards):
+        if host_shard == shard:
+            dispatchers.create_remote_dispatchers([host])
+            continue
+        # Reserve the display names and colors of the hosts handled by the
+        # other workers, so that names stay unique and aligned across
+        # workers, and colors are the same as without sharding.
+        admission.reserve(host.split(':', 1)[0])
+
+
+def _run_worker(hosts: List[str], nr_workers: int, shard: int) -> None:
+    """Run the remote shells of a shard in the current (worker) process"""
+    from polysh.main import loop
+
+    _start_worker(nr_workers, shard)
+    # Our stdout is now the pipe to the coordinator
+    console.open_stdout_writer()
+    _add_hosts(hosts, [i % nr_workers for i in range(len(hosts))], shard)
+    loop(False)
+
+
+def _fork(run_worker: Callable[[], None]) -> int:
+    """Call run_worker() in a new worker process, and return its pid"""
+    pid = os.fork()
+    if pid:
+        return pid
+
+    exit_code = 1
+    try:
+        run_worker()
+    except SystemExit as e:
+        exit_code = e.code or 0
+    except Exception:
+        # os._exit() does not print it, our stderr is still the one of
+        # polysh
+        traceback.print_exc()
+    finally:
+        try:
+            # atexit handlers are not run by os._exit()
+            console.drain_output()
+            if remote_dispatcher.options.log_file:
+                remote_dispatcher.options.log_file.close()
+        finally:
+            os._exit(exit_code)
+
+
+def run(hosts: List[str], nr_workers: int) -> None:
+    """Fork the workers, merge their output and exit with the highest exit
+    code"""
+    nr_workers = _cap_nr_workers(hosts, nr_workers)
+    workers = []  # type: List[int]
+    for shard in range(nr_workers):
+        read_fd, write_fd = os.pipe()
+
+        def run_worker() -> None:
+            os.close(read_fd)
+            os.dup2(write_fd, 1)
+            os.close(write_fd)
+            _run_worker(hosts, nr_workers, shard)
+
+        pid = _fork(run_worker)
+        os.close(write_fd)
+        WorkerOutputDispatcher(read_fd, pid)
+        workers.append(pid)
+        _trace(f'started worker {pid} for shard {shard}/{nr_workers}')
+
+    exit_code = 0
+    try:
+        while any(
+            isinstance(d, WorkerOutputDispatcher)
+            for d in dispatcher_registry.iter_dispatchers()
+        ):
+            event_loop.loop_iteration()
+    except KeyboardInterrupt:
+        # The workers kill their remote shells on SIGINT
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except OSError:
+                pass
+        raise
+    finally:
+        for pid in workers:
+            _, status = os.waitpid(pid, 0)
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+            _trace(f'worker {pid} exited with {code}')
+            exit_code = max(exit_code, code)
+
+    sys.exit(exit_code)
+
+
+# In the coordinator of interactive workers, the channel to each of them
+_channels = []  # type: List[WorkerChannel]
+_nr_hosts = 0
+
+# In an interactive worker, the channel to the coordinator
+_coordinator = None  # type: Optional[CoordinatorChannel]
+
+
+def _serve(sock: socket.socket, nr_workers: int, shard: int) -> None:
+    """Run the remote shells of a shard for the coordinator connected to
+    sock, in the current (interactive worker) process"""
+    global _coordinator
+    from polysh.main import QUIET_DELAY, _schedule_reaping, kill_all
+
+    # Our shells are not interrupted by the ^C of the user, the coordinator
+    # sends it to them
+    os.setpgid(0, 0)
+    # Only the coordinator reads the terminal
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.close(null_fd)
+    _start_worker(nr_workers, shard)
+    _coordinator = CoordinatorChannel(sock, shard, nr_workers)
+    console.set_stdout_writer(_coordinator)
+    signal.signal(
+        signal.SIGWINCH,
+        lambda signum, frame: dispatchers.update_terminal_size(),
+    )
+
+    try:
+        # Like the main loop, the unfinished lines are printed once the
+        # remote shells are quiet
+        quiet_deadline = None  # type: Optional[float]
+        while True:
+            _schedule_reaping()
+            timeout = None
+            if quiet_deadline is not None:
+                timeout = max(quiet_deadline - time.monotonic(), 0)
+            reads = remote_dispatcher.main_loop_iteration(timeout)
+            if reads or buffered_dispatcher.reads_paused():
+                quiet_deadline = time.monotonic() + QUIET_DELAY
+            elif (
+                quiet_deadline is not None
+                and time.monotonic() >= quiet_deadline
+            ):
+                quiet_deadline = None
+                with batched_output():
+                    for r in dispatchers.all_instances():
+                        r.print_unfinished_line()
+            _coordinator.send_state()
+    except ExitNow as e:
+        sys.exit(e.args[0])
+    finally:
+        kill_all()
+
+
+def start(hosts: List[str], nr_workers: int) -> None:
+    """Fork the interactive workers and start the hosts on them"""
+    nr_workers = _cap_nr_workers(hosts, nr_workers)
+    for shard in range(nr_workers):
+        coordinator_sock, worker_sock = socket.socketpair()
+
+        def run_worker() -> None:
+            coordinator_sock.close()
+            _serve(worker_sock, nr_workers, shard)
+
+        pid = _fork(run_worker)
+        worker_sock.close()
+        _channels.append(WorkerChannel(coordinator_sock, shard, pid))
+        _trace(f'started worker {pid} for shard {shard}/{nr_workers}')
+
+    atexit.register(_stop_workers)
+    dispatchers.shell_proxies = {}
+    add_hosts(hosts)
+
+
+def _stop_workers() -> None:
+    """The workers kill their remote shells once we are gone"""
+    for channel in _channels:
+        if dispatcher_registry.get_dispatcher(channel.fd) is channel:
+            channel.close()
+            os.waitpid(channel.pid, 0)
+
+
+def add_hosts(hosts: List[str]) -> None:
+    """Start the hosts on the workers, in turn"""
+    global _nr_hosts
+    shards = []
+    for host in hosts:
+        shard = _nr_hosts % len(_channels)
+        _nr_hosts += 1
+        shards.append(shard)
+        # The workers take the names in the same order
+        display_names.change(None, host.split(':', 1)[0])
+        # Pending until the worker reports them
+        admission.shard_submitted(shard, 1)
+    for channel in _channels:
+        channel.send_message('add', hosts, shards)
+
+
+def dispatch_input(data: bytes) -> None:
+    """Send lines typed by the user to all the enabled remote shells"""
+    for channel in _channels:
+        channel.send_message('input', data)
+    for proxy in dispatchers.shell_proxies.values():
+        if proxy.enabled and proxy.state is not remote_dispatcher.STATE_DEAD:
+            proxy.state = remote_dispatcher.STATE_RUNNING
+
+
+def request_name(shell: remote_dispatcher.RemoteDispatcher, name: str) -> None:
+    """Ask the coordinator to rename a shell of this worker"""
+    _coordinator.send_message('rename', _coordinator.key(shell), name)
+
+
+def set_log(path: Optional[str]) -> None:
+    """Make the workers log to path, or stop logging if None"""
+    for channel in _channels:
+        channel.send_message('log', path)
+
+
+def chdir(path: str) -> None:
+    """Change the current directory of the workers"""
+    for channel in _channels:
+        channel.send_message('chdir', path)
+
+
+def propagate_terminal_size() -> None:
+    """The terminal was resized, the workers resize their remote shells"""
+    for channel in _channels:
+        try:
+            os.kill(channel.pid, signal.SIGWINCH)
+        except OSError:
+            pass
@@ -0,0 +1,141 @@
+"""Polysh - SSH Process Spawning
+
+Forking the whole polysh interpreter for each remote shell copies its page
+tables, and running the --ssh template through /bin/sh costs one more exec.
+On Linux, polysh opens the pty pair itself and starts ssh with posix_spawn()
+in a new session, the pty becoming its controlling terminal.  The template
+is split into arguments once, it is only run by /bin/sh -c if it uses shell
+syntax.  pty.fork() remains the fallback on the other platforms.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pty
+import shlex
+import sys
+from typing import Dict, List, Optional, Tuple
+
+_TRACE = os.environ.get('POLYSH_TRACE')
+
+
+def _trace(msg: str) -> None:
+    if _TRACE:
+        print(f'[trace] {msg}', file=sys.stderr, flush=True)
+
+
+# os.posix_spawnp() needs Python 3.8.  Opening the pty after setsid() only
+# makes it the controlling terminal on Linux.  Cleared if the libc cannot
+# setsid() in posix_spawn().
+_posix_spawn_available = hasattr(
+    os, 'posix_spawnp'
+) and sys.platform.startswith('linux')
+
+# Templates with any of these characters are left to the shell
+_SHELL_CHARS = frozenset('|&;<>()$`\\*?[]{}~#!\n')
+
+# The arguments of the templates, None for those needing a shell
+_parsed_templates = {}  # type: Dict[str, Optional[List[str]]]
+
+
+def parse_template(template: str) -> Optional[List[str]]:
+    """The arguments of the --ssh template, None if it needs a shell"""
+    if template in _parsed_templates:
+        return _parsed_templates[template]
+    args = None  # type: Optional[List[str]]
+    macros_removed = template.replace('%(host)s', '').replace('%(port)s', '')
+    if not _SHELL_CHARS.intersection(macros_removed):
+        try:
+            args = shlex.split(template)
+        except ValueError:
+            # Unbalanced quotes, let the shell complain
+            pass
+    if args and args[0] == 'exec':
+        del args[0]
+    if not args or '=' in args[0]:
+        # Setting environment variables is left to the shell
+        args = None
+    _parsed_templates[template] = args
+    return args
+
+
+def ssh_args(template: str, name: str, port: str) -> Optional[List[str]]:
+    """The ssh command for a host as arguments, None if it needs a shell.
+    Like for the shell, the port option is split into words and the host
+    name is appended if the template does not contain any macro."""
+    template_args = parse_template(template)
+    if template_args is None:
+        return None
+    values = {'host': name, 'port': port}
+    args = []  # type: List[str]
+    for arg in template_args:
+        if '%(port)s' in arg:
+            args.extend((arg % values).split())
+        else:
+            args.append(arg % values)
+    if template % values == template:
+        args.append(name)
+    return args
+
+
+def _spawn(args: List[str]) -> Tuple[int, int]:
+    master_fd, slave_fd = os.openpty()
+    try:
+        file_actions = [
+            (os.POSIX_SPAWN_OPEN, 0, os.ttyname(slave_fd), os.O_RDWR, 0),
+            (os.POSIX_SPAWN_DUP2, 0, 1),
+            (os.POSIX_SPAWN_DUP2, 0, 2),
+        ]
+        pid = os.posix_spawnp(
+            args[0], args, os.environ, file_actions=file_actions, setsid=True
+        )
+    except BaseException:
+        os.close(master_fd)
+        raise
+    finally:
+        os.close(slave_fd)
+    return pid, master_fd
+
+
+def start(args: Optional[List[str]], command: str) -> Tuple[int, int]:
+    """Start the process in a new session with a new pty as its controlling
+    terminal and return its pid and the pty master.  The process runs args,
+    or the shell command if args is None or cannot be spawned."""
+    global _posix_spawn_available
+    if _posix_spawn_available:
+        try:
+            if args is not None:
+                try:
+                    return _spawn(args)
+                except OSError as e:
+                    # The shell reports the error on the pty
+                    _trace(f'start: posix_spawnp({args[0]}) failed: {e}')
+            return _spawn(['/bin/sh', '-c', command])
+        except NotImplementedError:
+            _posix_spawn_available = False
+
+    pid, fd = pty.fork()
+    if pid == 0:
+        # Child, it must not return to the caller if exec fails
+        try:
+            os.execlp('/bin/sh', 'sh', '-c', command)
+        finally:
+            os._exit(1)
+    return pid, fd
+
+
+def forks() -> bool:
+    """Does start() fork the calling process?"""
+    return not _posix_spawn_available
@@ -36,12 +36,19 @@ def _trace(msg: str) -> None:
         print(f'[trace] {msg}', file=sys.stderr, flush=True)
 
 from polysh import (
+    buffered_dispatcher,
     completion,
     dispatcher_registry,
     dispatchers,
     remote_dispatcher,
 )
-from polysh.console import console_output, set_last_status_length
+from polysh.console import (
+    console_output,
+    drain_output,
+    flush_output,
+    safe_write,
+    set_last_status_length,
+)
 from polysh.exceptions import ExitNow
 
 the_stdin_thread = None  # type: StdinThread
@@ -84,6 +91,9 @@ def process_input_buffer() -> None:
         return
 
     if data.startswith(b'!'):
+        # The local command writes directly to the terminal
+        flush_output()
+        drain_output()
         try:
             retcode = subprocess.call(data[1:], shell=True)
         except OSError as e:
@@ -102,9 +112,23 @@ def process_input_buffer() -> None:
             )
         return
 
+    dispatch_input(data)
+
+
+def dispatch_input(data: bytes) -> None:
+    """Send lines typed by the user to all the enabled remote shells"""
+    if dispatchers.shell_proxies is not None:
+        from polysh import sharding
+
+        sharding.dispatch_input(data)
+        return
+
+    # All the shells queue this same view of data, see dispatch_write()
+    shared_data = memoryview(data)
+    nr_lines = data.count(b'\n')
     for r in dispatchers.all_instances():
         try:
-            r.dispatch_command(data)
+            r.dispatch_command(shared_data, nr_lines)
         except ExitNow as e:
             raise e
         except Exception as msg:
@@ -124,7 +148,9 @@ def process_input_buffer() -> None:
 # d: there is new data to send
 # A: ACK, same reply for every message, communications are synchronous, so the
 # stdin thread sends a character to the socket, the main thread processes it,
-# sends the ACK, and the stdin thread can go on.
+# sends the ACK, and the stdin thread can go on.  The ACK is delayed while the
+# write queue of a remote shell is congested, this is the flow control of the
+# input.
 
 
 class SocketDispatcher:
@@ -202,9 +228,15 @@ class SocketNotificationReader(SocketDispatcher):
                 raise
             else:
                 self._do(c)
-                self.socket.setblocking(True)
-                self.send(b'A')
-                self.socket.setblocking(False)
+                # Pause the stdin thread until the remote shells have
+                # consumed enough of what it sent
+                buffered_dispatcher.when_drained(self._ack)
+
+    def _ack(self) -> None:
+        _trace('SocketNotificationReader: sending ACK')
+        self.socket.setblocking(True)
+        self.send(b'A')
+        self.socket.setblocking(False)
 
     def writable(self) -> bool:
         """Our writes are blocking"""
@@ -353,7 +385,7 @@ def interrupt_stdin_thread() -> None:
     # Move cursor up to undo the newline that readline printed when it
     # processed our injected Enter.  This lets the next prompt overwrite
     # the current line in-place.
-    os.write(1, b'\033[A\r')
+    safe_write(b'\033[A\r')
 
 
 echo_enabled = True
@@ -404,6 +436,8 @@ class StdinThread(Thread):
             self.prepend_text = None
 
     def want_raw_input(self) -> None:
+        # readline writes the prompt directly, after our output
+        drain_output()
         nr, total = dispatchers.count_awaited_processes()
         if nr:
             prompt = 'waiting (%d/%d)> ' % (nr, total)
@@ -0,0 +1,201 @@
+"""Polysh - Tests - Connection Admission
+
+Unit tests for the queue of the hosts waiting to be started.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import unittest
+from argparse import Namespace
+from unittest import mock
+
+from polysh import admission, display_names, event_loop, remote_dispatcher
+from polysh.exceptions import ExitNow
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.started = []
+        self.saved_options = remote_dispatcher.options
+        remote_dispatcher.options = Namespace(
+            max_handshakes=0,
+            connect_rate=0,
+            parallel=0,
+            disable_color=True,
+            exit_code=0,
+            format='text',
+            abort_error=False,
+            interactive=False,
+            log_file=None,
+        )
+        self.failing = set()
+
+        def fake_dispatcher(hostname, port, display_name):
+            if hostname in self.failing:
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+            self.started.append((hostname, port, display_name))
+
+        patcher = mock.patch.object(
+            remote_dispatcher, 'RemoteDispatcher', fake_dispatcher
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        admission._pending.clear()
+        admission._nr_handshakes = 0
+        admission._nr_alive = 0
+        admission._next_start = 0.0
+        admission._timer = None
+        admission._nr_started_in_batch = 0
+        admission._nr_submitted = admission._nr_started = 0
+        admission._aborting = False
+        admission._shard_progress.clear()
+        display_names.PREFIXES.clear()
+        display_names.NR_ENABLED_DISPLAY_NAMES_BY_LENGTH.clear()
+
+    def tearDown(self):
+        if admission._timer is not None:
+            admission._timer.cancel()
+        remote_dispatcher.options = self.saved_options
+
+    def _names(self):
+        return [name for _, _, name in self.started]
+
+    def test_no_limit(self):
+        for i in range(5):
+            admission.submit([(f'host{i}', '22')])
+        self.assertEqual(len(self.started), 5)
+        self.assertEqual(admission.nr_pending(), 0)
+
+    def test_batches(self):
+        nr_hosts = admission.START_BATCH * 2 + 1
+        admission.submit([(f'host{i}', '22') for i in range(nr_hosts)])
+        self.assertEqual(len(self.started), admission.START_BATCH)
+        self.assertEqual(
+            admission.progress(), (admission.START_BATCH, nr_hosts)
+        )
+        event_loop.loop_iteration(timeout=0)
+        self.assertEqual(len(self.started), admission.START_BATCH * 2)
+        event_loop.loop_iteration(timeout=0)
+        self.assertEqual(len(self.started), nr_hosts)
+        self.assertEqual(admission.nr_pending(), 0)
+        self.assertIsNone(admission._timer)
+
+    def test_max_handshakes(self):
+        remote_dispatcher.options.max_handshakes = 2
+        for i in range(5):
+            admission.submit([(f'host{i}', '22')])
+        self.assertEqual(self._names(), ['host0', 'host1'])
+        self.assertEqual(admission.nr_pending(), 3)
+        admission.handshake_done()
+        self.assertEqual(self._names(), ['host0', 'host1', 'host2'])
+        admission.handshake_done()
+        admission.handshake_done()
+        self.assertEqual(len(self.started), 5)
+        self.assertEqual(admission.nr_pending(), 0)
+
+    def test_start_failure(self):
+        remote_dispatcher.options.max_handshakes = 1
+        self.failing.add('host1')
+        admission.submit([(f'host{i}', '22') for i in range(3)])
+        with mock.patch.object(admission, 'console_output') as output:
+            admission.handshake_done()
+        output.assert_called_once_with(
+            b'Failed to start host1: [Errno 28] No space left on device\n'
+        )
+        # The next host takes the place of the failed one
+        self.assertEqual(self._names(), ['host0', 'host2'])
+        self.assertEqual(admission.nr_pending(), 0)
+        self.assertEqual(admission._nr_handshakes, 1)
+        self.assertEqual(remote_dispatcher.options.exit_code, 1)
+
+    def test_start_failure_aborts(self):
+        remote_dispatcher.options.abort_error = True
+        self.failing.add('host1')
+        with mock.patch.object(admission, 'console_output'):
+            # Not raised to the caller, starting the first hosts before the
+            # main loop
+            admission.submit([(f'host{i}', '22') for i in range(3)])
+        self.assertEqual(self._names(), ['host0'])
+        with self.assertRaises(ExitNow):
+            event_loop.loop_iteration(timeout=0)
+
+    def test_parallel(self):
+        remote_dispatcher.options.parallel = 2
+        for i in range(4):
+            admission.submit([(f'host{i}', '22')])
+        admission.handshake_done()
+        admission.handshake_done()
+        # Connected but still alive
+        self.assertEqual(self._names(), ['host0', 'host1'])
+        admission.shell_dead()
+        self.assertEqual(self._names(), ['host0', 'host1', 'host2'])
+        admission.shell_dead()
+        self.assertEqual(len(self.started), 4)
+        self.assertEqual(admission.nr_pending(), 0)
+
+    def test_parallel_names(self):
+        remote_dispatcher.options.parallel = 1
+        admission.submit([('localhost', '22')] * 3)
+        admission.shell_dead()
+        # The names are reserved when queued, not reused from dead shells
+        display_names.change('localhost', None)
+        admission.shell_dead()
+        self.assertEqual(
+            self._names(), ['localhost', 'localhost#1', 'localhost#2']
+        )
+
+    def test_connect_rate(self):
+        remote_dispatcher.options.connect_rate = 100
+        for i in range(3):
+            admission.submit([(f'host{i}', '22')])
+        self.assertEqual(self._names(), ['host0'])
+        self.assertIsNotNone(admission._timer)
+        for _ in range(100):
+            if len(self.started) == 3:
+                break
+            event_loop.loop_iteration(timeout=0.1)
+        self.assertEqual(self._names(), ['host0', 'host1', 'host2'])
+        self.assertIsNone(admission._timer)
+
+    def test_reservations_keep_the_order(self):
+        remote_dispatcher.options.max_handshakes = 1
+        admission.submit([('localhost', '22')])
+        admission.reserve('localhost')
+        admission.submit([('localhost', '22')])
+        admission.reserve('localhost')
+        self.assertEqual(self._names(), ['localhost'])
+        # Reservations are not hosts waiting to be started
+        self.assertEqual(admission.nr_pending(), 1)
+        admission.handshake_done()
+        self.assertEqual(self._names(), ['localhost', 'localhost#2'])
+        self.assertEqual(display_names.PREFIXES['localhost'], [True] * 4)
+
+    def test_shard_progress(self):
+        admission.shard_submitted(0, 2)
+        admission.shard_submitted(1, 1)
+        # Until the workers report, their hosts are pending
+        self.assertEqual(admission.progress(), (0, 3))
+        self.assertEqual(admission.nr_pending(), 3)
+        admission.set_shard_progress(0, 2, 2)
+        self.assertEqual(admission.nr_pending(), 1)
+        admission.set_shard_progress(1, 1, 1)
+        self.assertEqual(admission.progress(), (3, 3))
+        self.assertEqual(admission.nr_pending(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
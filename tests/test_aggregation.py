@@ -0,0 +1,125 @@
+"""Polysh - Tests - Output Aggregation
+
+Unit tests for the grouping of identical outputs.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest import mock
+
+from polysh import aggregation
+
+
+class FakeShell:
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+
+class TestAggregation(unittest.TestCase):
+    def setUp(self):
+        aggregation._running.clear()
+        aggregation._completed.clear()
+        aggregation._first_lines.clear()
+        aggregation._samples_memory = 0
+        patcher = mock.patch('polysh.aggregation.console_output')
+        self.console_output = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _output(self):
+        return b''.join(c.args[0] for c in self.console_output.call_args_list)
+
+    def test_identical_outputs_grouped(self):
+        shells = [FakeShell(f'web{i}') for i in range(1, 6)]
+        for shell in shells:
+            # The same output, split differently
+            if shell.display_name == 'web2':
+                aggregation.add_lines(shell, [b'Linux'])
+                aggregation.add_lines(shell, [b'6.1'])
+            elif shell.display_name == 'web4':
+                aggregation.add_lines(shell, [b'Linux', b'5.10'])
+            else:
+                aggregation.add_lines(shell, [b'Linux', b'6.1'])
+            aggregation.command_done(shell)
+        # Only one sample is kept per distinct output
+        self.assertEqual(len(aggregation._completed), 2)
+        self.assertEqual(self._output(), b'')
+
+        aggregation.print_results()
+        self.assertEqual(
+            self._output(),
+            b'web<1-3,5> (4 hosts):\nLinux\n6.1\n'
+            b'web4 (1 host):\nLinux\n5.10\n',
+        )
+        self.assertEqual(aggregation._completed, {})
+
+    def test_no_output_and_running(self):
+        silent = FakeShell('silent')
+        running = FakeShell('running')
+        aggregation.command_done(silent)
+        aggregation.add_lines(running, [b'partial'])
+        aggregation.print_results()
+        self.assertEqual(
+            self._output(),
+            b'running (1 host):\npartial\nsilent (1 host):\n(no output)\n',
+        )
+        self.assertEqual(aggregation._running, {})
+
+    def test_sample_is_bounded(self):
+        shell = FakeShell('big')
+        line = b'x' * 999
+        for _ in range(100):
+            aggregation.add_lines(shell, [line])
+        aggregation.command_done(shell)
+        group = next(iter(aggregation._completed.values()))
+        self.assertEqual(len(group.sample()), aggregation.MAX_SAMPLE_SIZE)
+        self.assertEqual(group.size, 100000)
+
+        aggregation.print_results()
+        shown = (aggregation.MAX_SAMPLE_SIZE // 1000) * 1000
+        self.assertEqual(
+            self._output(),
+            b'big (1 host):\n'
+            + (line + b'\n') * (shown // 1000)
+            + f'[{100000 - shown} more bytes]\n'.encode(),
+        )
+
+    def test_samples_are_shared(self):
+        shells = [FakeShell(f'web{i}') for i in range(1, 101)]
+        lines = [b'x' * 999] * 10
+        for shell in shells:
+            aggregation.add_lines(shell, lines)
+            aggregation.add_lines(shell, [shell.display_name.encode()])
+        # The common lines are kept once, while the commands are running
+        self.assertLess(aggregation._samples_memory, 30000)
+        aggregation.print_results()
+        self.assertIn(b'web42 (1 host):\n' + b'x' * 999, self._output())
+        self.assertEqual(aggregation._samples_memory, 0)
+
+    @mock.patch('polysh.aggregation.MAX_SAMPLES_MEMORY', 3000)
+    def test_samples_memory_is_bounded(self):
+        shells = [FakeShell(f'web{i}') for i in range(1, 4)]
+        for shell in shells:
+            # Distinct outputs of 1000 bytes
+            line = shell.display_name.encode() * 250
+            aggregation.add_lines(shell, [line[:999]])
+        self.assertLessEqual(aggregation._samples_memory, 3000)
+        aggregation.print_results()
+        self.assertIn(b'web2 (1 host):\nweb2web2', self._output())
+        self.assertIn(b'web3 (1 host):\n\n[1000 more bytes]\n', self._output())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+"""Polysh - Tests - asyncio Selector
+
+Unit tests for the asyncio based selector backend.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import selectors
+import time
+import unittest
+
+from polysh import dispatcher_registry
+from polysh.asyncio_selector import AsyncioSelector
+from polysh.event_loop import loop_iteration
+
+
+class FakeDispatcher:
+    """Dispatcher stub that records which handlers were called."""
+
+    def __init__(self, fd, readable=True, writable=False):
+        self.fd = fd
+        self._readable = readable
+        self._writable = writable
+        self.read_called = 0
+        self.write_called = 0
+
+    def readable(self):
+        return self._readable
+
+    def writable(self):
+        return self._writable
+
+    def handle_read(self):
+        self.read_called += 1
+        os.read(self.fd, 4096)
+
+    def handle_write(self):
+        self.write_called += 1
+
+    def handle_close(self):
+        pass
+
+
+class TestAsyncioSelector(unittest.TestCase):
+    def setUp(self):
+        self._fds = []
+        self.selector = AsyncioSelector()
+
+    def tearDown(self):
+        self.selector.close()
+        for fd in self._fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _make_pipe(self):
+        r, w = os.pipe()
+        self._fds.extend([r, w])
+        return r, w
+
+    def test_select_readable(self):
+        r, w = self._make_pipe()
+        key = self.selector.register(r, selectors.EVENT_READ, 'data')
+        os.write(w, b'hello')
+
+        self.assertEqual(
+            self.selector.select(0.1), [(key, selectors.EVENT_READ)]
+        )
+
+    def test_select_timeout(self):
+        r, w = self._make_pipe()
+        self.selector.register(r, selectors.EVENT_READ)
+
+        start = time.monotonic()
+        self.assertEqual(self.selector.select(0.05), [])
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def test_modify_and_unregister(self):
+        r, w = self._make_pipe()
+        self.selector.register(w, selectors.EVENT_READ)
+        key = self.selector.modify(w, selectors.EVENT_WRITE, 'data')
+        self.assertEqual(key.events, selectors.EVENT_WRITE)
+        self.assertIs(self.selector.get_key(w), key)
+        self.assertEqual(
+            self.selector.select(0.1), [(key, selectors.EVENT_WRITE)]
+        )
+
+        self.selector.unregister(w)
+        with self.assertRaises(KeyError):
+            self.selector.get_key(w)
+        self.assertEqual(len(self.selector.get_map()), 0)
+
+    def test_register_twice_raises(self):
+        r, w = self._make_pipe()
+        self.selector.register(r, selectors.EVENT_READ)
+        with self.assertRaises(KeyError):
+            self.selector.register(r, selectors.EVENT_READ)
+
+    def test_asyncio_callbacks_run_while_waiting(self):
+        called = []
+        self.selector.loop.call_soon(called.append, True)
+        self.selector.select(0.01)
+        self.assertEqual(called, [True])
+
+    def test_wait_on_running_loop(self):
+        r, w = self._make_pipe()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        selector = AsyncioSelector(loop)
+        self.addCleanup(selector.close)
+        key = selector.register(r, selectors.EVENT_READ)
+
+        async def wait():
+            loop.call_later(0.01, os.write, w, b'hello')
+            with self.assertRaises(RuntimeError):
+                selector.select(0)
+            return await selector.wait(1)
+
+        self.assertEqual(
+            loop.run_until_complete(wait()), [(key, selectors.EVENT_READ)]
+        )
+
+
+class TestAsyncioEventLoop(unittest.TestCase):
+    def setUp(self):
+        self._fds = []
+        dispatcher_registry._dispatchers.clear()
+        dispatcher_registry._current_events.clear()
+        dispatcher_registry._dirty.clear()
+        dispatcher_registry.set_selector(AsyncioSelector())
+
+    def tearDown(self):
+        for fd in list(dispatcher_registry._dispatchers):
+            dispatcher_registry.unregister(fd)
+        dispatcher_registry.set_selector(selectors.DefaultSelector())
+        for fd in self._fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _make_pipe(self):
+        r, w = os.pipe()
+        self._fds.extend([r, w])
+        return r, w
+
+    def test_dispatch_read_and_write(self):
+        r, w = self._make_pipe()
+        os.write(w, b'data')
+
+        dr = FakeDispatcher(r, readable=True, writable=False)
+        dw = FakeDispatcher(w, readable=False, writable=True)
+        dispatcher_registry.register(r, dr)
+        dispatcher_registry.register(w, dw)
+
+        loop_iteration(timeout=0.1)
+        self.assertEqual(dr.read_called, 1)
+        self.assertEqual(dw.write_called, 1)
+
+        # Nothing left to read, and no more interest in writing
+        dw._writable = False
+        loop_iteration(timeout=0.05)
+        self.assertEqual(dr.read_called, 1)
+        self.assertEqual(dw.write_called, 1)
+
+    def test_set_selector_moves_registrations(self):
+        r, w = self._make_pipe()
+        os.write(w, b'data')
+
+        d = FakeDispatcher(r)
+        dispatcher_registry.register(r, d)
+        dispatcher_registry.set_selector(AsyncioSelector())
+
+        loop_iteration(timeout=0.1)
+        self.assertEqual(d.read_called, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -80,6 +80,41 @@ class TestBasic(unittest.TestCase):
         child.expect('Error talking to localhost')
         child.expect(pexpect.EOF)
 
+    def testWorkers(self):
+        child = launch_polysh(['--workers=2'] + ['localhost'] * 3)
+        child.expect('ready \(3\)> ')
+        child.sendline('echo text')
+        child.expect('localhost#2 : \033\[1;mtext')
+        child.expect('ready \(3\)> ')
+        child.sendline(':disable localhost#1')
+        child.expect('ready \(2\)> ')
+        child.sendline(':list')
+        child.expect('localhost   enabled  idle: text\r\n'
+                     'localhost#1 disabled idle: text\r\n'
+                     'localhost#2 enabled  idle: text\r\n')
+        child.expect('ready \(2\)> ')
+        child.sendline(':enable')
+        child.expect('ready \(3\)> ')
+        child.sendline(':set_aggregate y')
+        child.expect('--workers and --aggregate are incompatible')
+        child.expect('ready \(3\)> ')
+        # The names stay unique across the workers
+        child.sendline(':rename renamed')
+        child.expect('ready \(3\)> ')
+        child.sendline('sleep 1h')
+        child.expect('waiting \(3/3\)> ')
+        child.sendintr()
+        child.expect('ready \(3\)> ')
+        child.sendline('false')
+        child.expect('ready \(3\)> ')
+        child.sendline(':status')
+        child.expect('Failed on 3/3 shells: renamed renamed#<1-2>')
+        child.expect('ready \(3\)> ')
+        child.sendline('exit')
+        for i in range(3):
+            child.expect('logout')
+        child.expect(pexpect.EOF)
+
     def testCleanExit(self):
         child = launch_polysh(['localhost', 'localhost'])
         child.expect('ready \(2\)> ')
@@ -0,0 +1,293 @@
+"""Polysh - Tests - Buffered Dispatcher
+
+Unit tests for the read buffer and write queue handling of
+BufferedDispatcher.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import selectors
+import unittest
+
+from polysh import buffered_dispatcher, dispatcher_registry
+from polysh.buffered_dispatcher import BufferedDispatcher
+
+
+class TestBufferedDispatcher(unittest.TestCase):
+    def setUp(self):
+        dispatcher_registry._dispatchers.clear()
+        dispatcher_registry._current_events.clear()
+        dispatcher_registry._dirty.clear()
+        dispatcher_registry._selector.close()
+        dispatcher_registry._selector = selectors.DefaultSelector()
+        r, self.w = os.pipe()
+        self.dispatcher = BufferedDispatcher(r)
+
+    def tearDown(self):
+        self.dispatcher.close()
+        os.close(self.w)
+
+    def test_read_appends(self):
+        os.write(self.w, b'abc')
+        self.assertEqual(self.dispatcher._handle_read_chunk(), 3)
+        os.write(self.w, b'def')
+        self.assertEqual(self.dispatcher._handle_read_chunk(), 3)
+        self.assertEqual(self.dispatcher.read_buffer, b'abcdef')
+        self.assertEqual(self.dispatcher.read_buffer_size(), 6)
+
+    def test_carriage_returns_become_newlines(self):
+        os.write(self.w, b'a\r\nb\rc')
+        self.dispatcher._handle_read_chunk()
+        self.assertEqual(self.dispatcher.read_buffer, b'a\n\nb\nc')
+
+    def test_large_read_is_complete(self):
+        data = bytes(range(256)).replace(b'\r', b'') * 100
+        os.write(self.w, data)
+        self.assertEqual(self.dispatcher._handle_read_chunk(), len(data))
+        self.assertEqual(self.dispatcher.read_buffer, data)
+
+    def test_read_bounded_by_max_buffer_size(self):
+        self.dispatcher.MAX_BUFFER_SIZE = 8192
+        os.write(self.w, b'x' * 20000)
+        self.dispatcher._handle_read_chunk()
+        self.assertEqual(self.dispatcher.read_buffer_size(), 8192)
+        self.assertFalse(self.dispatcher.readable())
+
+        # Consuming data makes room for more
+        self.dispatcher.consume_read(4096)
+        self.assertTrue(self.dispatcher.readable())
+        self.dispatcher._handle_read_chunk()
+        self.assertEqual(self.dispatcher.read_buffer_size(), 8192)
+
+    def test_read_size_adapts(self):
+        self.assertEqual(self.dispatcher.read_size, 4096)
+        # A flood of output grows the reads
+        os.write(self.w, b'x' * 60000)
+        self.dispatcher._handle_read_chunk()
+        self.assertGreater(self.dispatcher.read_size, 4096)
+        self.assertLessEqual(
+            self.dispatcher.read_size, self.dispatcher.MAX_READ_SIZE
+        )
+
+        # Interactive trickle shrinks them
+        for _ in range(10):
+            os.write(self.w, b'y')
+            self.dispatcher._handle_read_chunk()
+        self.assertEqual(
+            self.dispatcher.read_size, self.dispatcher.MIN_READ_SIZE
+        )
+        self.assertEqual(self.dispatcher.read_buffer_size(), 60010)
+
+    def test_read_stats(self):
+        os.write(self.w, b'abc')
+        self.dispatcher._handle_read_chunk()
+        # One read for the data, one more to see there is nothing left
+        self.assertEqual(self.dispatcher.nr_read_syscalls, 2)
+        self.assertEqual(self.dispatcher.nr_read_bytes, 3)
+        self.assertEqual(
+            self.dispatcher.read_stats(),
+            [b'3 bytes', b'in 2 reads:', b'1 bytes/read,', b'read size 2048'],
+        )
+
+    def test_consume_uses_offset_then_compacts(self):
+        os.write(self.w, b'0123456789')
+        self.dispatcher._handle_read_chunk()
+
+        self.dispatcher.consume_read(3)
+        self.assertEqual(self.dispatcher.read_offset, 3)
+        self.assertEqual(self.dispatcher.read_buffer, b'0123456789')
+        self.assertEqual(
+            self.dispatcher._read_data(self.dispatcher.read_offset),
+            b'3456789',
+        )
+
+        # Most of the buffer is consumed, it gets compacted
+        self.dispatcher.consume_read(6)
+        self.assertEqual(self.dispatcher.read_offset, 0)
+        self.assertEqual(self.dispatcher.read_buffer, b'6789')
+        # The position of the buffer in the whole output is kept
+        self.assertEqual(self.dispatcher.read_base, 6)
+
+        self.dispatcher.consume_read(4)
+        self.assertEqual(self.dispatcher.read_buffer, b'')
+        self.assertEqual(self.dispatcher.read_buffer_size(), 0)
+        self.assertEqual(self.dispatcher.read_base, 10)
+
+    def test_newline_search_resumes(self):
+        os.write(self.w, b'abc')
+        self.dispatcher._handle_read_chunk()
+        self.assertEqual(self.dispatcher._find_newline(), -1)
+        self.assertEqual(self.dispatcher.newline_scan_pos, 3)
+
+        os.write(self.w, b'def\nghi\njk')
+        self.dispatcher._handle_read_chunk()
+        self.assertEqual(self.dispatcher._find_newline(), 6)
+        self.assertEqual(self.dispatcher._find_newline(last=True), 10)
+        self.dispatcher.consume_read(11)
+        # After a compaction, the position is still right
+        self.assertEqual(self.dispatcher.read_base, 11)
+        self.assertEqual(self.dispatcher._find_newline(), -1)
+        self.assertEqual(self.dispatcher.newline_scan_pos, 13)
+        os.write(self.w, b'\n')
+        self.dispatcher._handle_read_chunk()
+        self.assertEqual(self.dispatcher._find_newline(), 2)
+
+    def test_eof_raises(self):
+        os.write(self.w, b'last')
+        os.close(self.w)
+        self.w = os.open(os.devnull, os.O_WRONLY)
+        # The pending data is returned first, then EOF is reported
+        self.assertEqual(self.dispatcher._handle_read_chunk(), 4)
+        with self.assertRaises(OSError):
+            self.dispatcher._handle_read_chunk()
+        self.assertEqual(self.dispatcher.read_buffer, b'last')
+
+
+class TestBufferedDispatcherWrite(unittest.TestCase):
+    def setUp(self):
+        dispatcher_registry._dispatchers.clear()
+        dispatcher_registry._current_events.clear()
+        dispatcher_registry._dirty.clear()
+        dispatcher_registry._selector.close()
+        dispatcher_registry._selector = selectors.DefaultSelector()
+        buffered_dispatcher._congested.clear()
+        buffered_dispatcher._drained_callbacks.clear()
+        self.r, w = os.pipe()
+        self.dispatcher = BufferedDispatcher(w)
+
+    def tearDown(self):
+        self.dispatcher.close()
+        os.close(self.r)
+
+    def _read_all(self):
+        data = b''
+        while True:
+            try:
+                data += os.read(self.r, 65536)
+            except BlockingIOError:
+                return data
+
+    def test_segments_written_in_order(self):
+        self.assertFalse(self.dispatcher.writable())
+        self.dispatcher.dispatch_write(b'abc')
+        self.dispatcher.dispatch_write(bytearray(b'def'))
+        self.dispatcher.dispatch_write(b'')
+        self.assertTrue(self.dispatcher.writable())
+        self.assertEqual(self.dispatcher.write_queue_size, 6)
+
+        self.assertEqual(self.dispatcher.send_queued(), 6)
+        self.assertFalse(self.dispatcher.writable())
+        self.assertEqual(os.read(self.r, 100), b'abcdef')
+
+    def test_partial_write_advances_offset(self):
+        os.set_blocking(self.r, False)
+        chunks = [bytes([65 + i]) * 50000 for i in range(4)]
+        for chunk in chunks:
+            self.dispatcher.dispatch_write(chunk)
+        # The first segment is the original object, not a copy
+        self.assertIs(self.dispatcher.write_queue[0].obj, chunks[0])
+
+        data = b''
+        while self.dispatcher.writable():
+            try:
+                sent = self.dispatcher.send_queued()
+            except BlockingIOError:
+                sent = 0
+            self.assertEqual(
+                self.dispatcher.write_queue_size,
+                sum(len(s) for s in self.dispatcher.write_queue),
+            )
+            if not sent:
+                data += self._read_all()
+        data += self._read_all()
+        self.assertEqual(data, b''.join(chunks))
+
+    def test_broadcast_is_shared(self):
+        r, w = os.pipe()
+        other = BufferedDispatcher(w)
+        try:
+            data = b'broadcast\n'
+            shared = memoryview(data)
+            self.dispatcher.dispatch_write(shared)
+            other.dispatch_write(shared)
+            # Both queues refer to the same data, nothing was copied
+            self.assertIs(self.dispatcher.write_queue[0], shared)
+            self.assertIs(other.write_queue[0], shared)
+
+            self.dispatcher.send_queued()
+            self.assertEqual(os.read(self.r, 100), data)
+            self.assertIs(other.write_queue[0].obj, data)
+        finally:
+            other.close()
+            os.close(r)
+
+        # A view of mutable data is copied
+        buf = bytearray(b'abc')
+        self.dispatcher.dispatch_write(memoryview(buf))
+        buf[:] = b'xyz'
+        self.assertEqual(self.dispatcher.write_queue[0], b'abc')
+
+    def test_backpressure(self):
+        os.set_blocking(self.r, False)
+        self.dispatcher.WRITE_HIGH_WATER = 100000
+        self.dispatcher.WRITE_LOW_WATER = 20000
+        resumed = []
+        buffered_dispatcher.when_drained(lambda: resumed.append(1))
+        self.assertEqual(resumed, [1])
+
+        # Going over the high-water mark pauses the producers, nothing is
+        # lost and the session goes on
+        self.dispatcher.dispatch_write(b'x' * 150000)
+        self.assertTrue(buffered_dispatcher.congested())
+        buffered_dispatcher.when_drained(lambda: resumed.append(2))
+        self.assertEqual(resumed, [1])
+
+        data = b''
+        while self.dispatcher.write_queue_size > 20000:
+            try:
+                self.dispatcher.send_queued()
+            except BlockingIOError:
+                pass
+            if self.dispatcher.write_queue_size > 20000:
+                self.assertEqual(resumed, [1])
+            data += self._read_all()
+        # Below the low-water mark, the producers are resumed
+        self.assertFalse(buffered_dispatcher.congested())
+        self.assertEqual(resumed, [1, 2])
+
+        while self.dispatcher.writable():
+            self.dispatcher.send_queued()
+            data += self._read_all()
+        self.assertEqual(data, b'x' * 150000)
+
+    def test_clear_write_queue_resumes(self):
+        self.dispatcher.WRITE_HIGH_WATER = 10
+        resumed = []
+        self.dispatcher.dispatch_write(b'x' * 20)
+        buffered_dispatcher.when_drained(lambda: resumed.append(1))
+        self.dispatcher.clear_write_queue()
+        self.assertFalse(buffered_dispatcher.congested())
+        self.assertEqual(resumed, [1])
+
+    def test_clear_write_queue(self):
+        self.dispatcher.dispatch_write(b'abc')
+        self.dispatcher.clear_write_queue()
+        self.assertFalse(self.dispatcher.writable())
+        self.assertEqual(self.dispatcher.write_queue_size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
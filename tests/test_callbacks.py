@@ -0,0 +1,86 @@
+"""Polysh - Tests - Callbacks
+
+Unit tests for the search of the callback triggers in the output of the
+remote shells.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from polysh import callbacks
+
+
+class TestCallbacks(unittest.TestCase):
+    def setUp(self):
+        self.callbacks = callbacks.Callbacks()
+        self.called = []
+        t1, t2 = self.callbacks.add(b'test', self.called.append, True)
+        self.trigger = t1 + t2
+
+    def test_process(self):
+        once1, once2 = self.callbacks.add(b'once', self.called.append, False)
+        self.assertFalse(self.callbacks.process(b'nothing\n'))
+        self.assertTrue(self.callbacks.process(self.trigger + b' 1\n'))
+        self.assertTrue(self.callbacks.process(once1 + once2 + b'2\n'))
+        self.assertFalse(self.callbacks.process(once1 + once2 + b'3\n'))
+        self.assertTrue(self.callbacks.process(self.trigger + b'4\n'))
+        self.assertEqual(self.called, [b'1', b'2', b'4'])
+
+        # Another shell does not know our triggers
+        self.assertFalse(callbacks.Callbacks().process(self.trigger + b'\n'))
+        self.callbacks.clear()
+        self.assertFalse(self.callbacks.process(self.trigger + b'\n'))
+
+    def test_find_split_across_reads(self):
+        data = bytearray(b'output\n')
+        self.assertEqual(self.callbacks.find(data, 0, 0), -1)
+        cut = len(callbacks.COMMON_PREFIX) // 2
+        data += self.trigger[:cut]
+        self.assertEqual(self.callbacks.find(data, 0, 0), -1)
+        data += self.trigger[cut:] + b'\n'
+        self.assertEqual(self.callbacks.find(data, 0, 0), 7)
+
+    def test_find_does_not_rescan(self):
+        class Buffer(bytearray):
+            def find(self, sub, start=0):
+                starts.append(start)
+                return super().find(sub, start)
+
+        starts = []
+        data = Buffer(b'x' * 1000)
+        self.assertEqual(self.callbacks.find(data, 0, 0), -1)
+        data += b'y' * 10
+        self.assertEqual(self.callbacks.find(data, 0, 0), -1)
+        self.assertEqual(
+            starts, [0, 1000 - len(callbacks.COMMON_PREFIX) + 1]
+        )
+
+    def test_find_after_consume_and_compaction(self):
+        data = bytearray(b'a\n' + self.trigger + b'\nb\n' + self.trigger)
+        second = len(data) - len(self.trigger)
+        self.assertEqual(self.callbacks.find(data, 0, 0), 2)
+        # Still there while not consumed
+        self.assertEqual(self.callbacks.find(data, 0, 2), 2)
+        # The first trigger line is consumed and dropped from the buffer
+        consumed = 2 + len(self.trigger) + 1
+        del data[:consumed]
+        self.assertEqual(
+            self.callbacks.find(data, consumed, consumed), second
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
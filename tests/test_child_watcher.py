@@ -0,0 +1,76 @@
+"""Polysh - Tests - Child Watcher
+
+Unit tests for the pidfd based child process watcher.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import selectors
+import unittest
+
+from polysh import child_watcher, dispatcher_registry
+from polysh.event_loop import loop_iteration
+
+
+@unittest.skipUnless(child_watcher.available(), 'pidfd not available')
+class TestChildWatcher(unittest.TestCase):
+    def setUp(self):
+        dispatcher_registry._dispatchers.clear()
+        dispatcher_registry._current_events.clear()
+        dispatcher_registry._dirty.clear()
+        dispatcher_registry._selector.close()
+        dispatcher_registry._selector = selectors.DefaultSelector()
+
+    def tearDown(self):
+        for fd in list(dispatcher_registry._dispatchers):
+            dispatcher_registry.unregister(fd)
+
+    def _fork(self, exit_code):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(exit_code)
+        return pid
+
+    def test_child_reaped_on_exit(self):
+        statuses = []
+        pid = self._fork(3)
+        watcher = child_watcher.watch(pid, statuses.append)
+        self.assertIsNotNone(watcher)
+
+        for _ in range(50):
+            loop_iteration(timeout=0.1)
+            if statuses:
+                break
+        self.assertEqual(len(statuses), 1)
+        self.assertEqual(os.WEXITSTATUS(statuses[0]), 3)
+        # The watcher unregistered itself and the child is gone
+        self.assertEqual(dispatcher_registry.all_dispatchers(), [])
+        with self.assertRaises(ChildProcessError):
+            os.waitpid(pid, os.WNOHANG)
+
+    def test_already_reaped_child(self):
+        statuses = []
+        pid = self._fork(0)
+        watcher = child_watcher.watch(pid, statuses.append)
+        os.waitpid(pid, 0)
+
+        watcher.handle_read()
+        self.assertEqual(statuses, [0])
+        self.assertEqual(dispatcher_registry.all_dispatchers(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+"""Polysh - Tests - Console
+
+Unit tests for the batched console output.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import selectors
+import sys
+import threading
+import unittest
+from argparse import Namespace
+from unittest import mock
+
+from polysh import buffered_dispatcher, console, dispatcher_registry
+from polysh import remote_dispatcher
+from polysh.buffered_dispatcher import BufferedDispatcher
+
+
+class TestBatchedOutput(unittest.TestCase):
+    def setUp(self):
+        self.saved_options = remote_dispatcher.options
+        remote_dispatcher.options = Namespace(interactive=False, log_file=None)
+        sys.stdout.flush()
+        self.saved_stdout = os.dup(1)
+        self.r, w = os.pipe()
+        os.set_blocking(self.r, False)
+        os.dup2(w, 1)
+        os.close(w)
+
+    def tearDown(self):
+        os.dup2(self.saved_stdout, 1)
+        os.close(self.saved_stdout)
+        os.close(self.r)
+        remote_dispatcher.options = self.saved_options
+
+    def _read_output(self):
+        try:
+            return os.read(self.r, 65536)
+        except BlockingIOError:
+            return b''
+
+    def test_output_written_at_the_end(self):
+        with mock.patch('os.writev', wraps=os.writev) as writev:
+            with console.batched_output():
+                console.console_output(b'a\n')
+                console.console_output(b'')
+                with console.batched_output():
+                    console.console_output(b'b\n')
+                self.assertEqual(self._read_output(), b'')
+            self.assertEqual(self._read_output(), b'a\nb\n')
+            self.assertEqual(writev.call_count, 1)
+
+        # Without batching, the output is immediate
+        console.console_output(b'c\n')
+        self.assertEqual(self._read_output(), b'c\n')
+
+    def test_flush_output(self):
+        with console.batched_output():
+            console.console_output(b'a\n')
+            console.flush_output()
+            self.assertEqual(self._read_output(), b'a\n')
+            console.console_output(b'b\n')
+        self.assertEqual(self._read_output(), b'b\n')
+
+    def test_flushed_on_exception(self):
+        with self.assertRaises(KeyboardInterrupt):
+            with console.batched_output():
+                console.console_output(b'a\n')
+                raise KeyboardInterrupt
+        self.assertEqual(self._read_output(), b'a\n')
+        self.assertIsNone(console._staged_output)
+
+    def test_status_cleared_once(self):
+        remote_dispatcher.options.interactive = True
+        stdin_thread = mock.Mock()
+        with mock.patch('polysh.stdin.the_stdin_thread', stdin_thread):
+            console.set_last_status_length(3)
+            with console.batched_output():
+                console.console_output(b'a\n')
+                console.console_output(b'b\n')
+        stdin_thread.no_raw_input.assert_called_once_with()
+        self.assertEqual(self._read_output(), b'\r   \ra\nb\n')
+
+
+@unittest.skipUnless(
+    os.path.exists('/proc/self/fd'), 'stdout cannot be reopened'
+)
+class TestStdoutWriter(unittest.TestCase):
+    def setUp(self):
+        dispatcher_registry._dispatchers.clear()
+        dispatcher_registry._current_events.clear()
+        dispatcher_registry._dirty.clear()
+        dispatcher_registry._selector.close()
+        dispatcher_registry._selector = selectors.DefaultSelector()
+        sys.stdout.flush()
+        self.saved_stdout = os.dup(1)
+        self.r, w = os.pipe()
+        os.dup2(w, 1)
+        os.close(w)
+        console.open_stdout_writer()
+        self.writer = console._stdout_writer
+        self.assertIsNotNone(self.writer)
+
+    def tearDown(self):
+        self.writer.handle_close()
+        os.dup2(self.saved_stdout, 1)
+        os.close(self.saved_stdout)
+        os.close(self.r)
+        buffered_dispatcher.pause_reads(False)
+
+    def _read_all(self):
+        data = b''
+        while True:
+            try:
+                data += os.read(self.r, 65536)
+            except BlockingIOError:
+                return data
+
+    def test_slow_stdout_pauses_reads(self):
+        os.set_blocking(self.r, False)
+        pty_r, pty_w = os.pipe()
+        reader = BufferedDispatcher(pty_r)
+        try:
+            self.writer.WRITE_HIGH_WATER = 200000
+            self.writer.WRITE_LOW_WATER = 50000
+            chunks = [bytes([65 + i % 26]) * 10000 for i in range(50)]
+            # A full pipe does not block us, the output is queued
+            for chunk in chunks:
+                console.safe_write(chunk)
+            self.assertTrue(self.writer.writable())
+            self.assertTrue(buffered_dispatcher._reads_paused)
+            self.assertFalse(reader.readable())
+
+            data = b''
+            while self.writer.writable():
+                data += self._read_all()
+                self.writer.handle_write()
+            data += self._read_all()
+            self.assertEqual(data, b''.join(chunks))
+            self.assertFalse(buffered_dispatcher._reads_paused)
+            self.assertTrue(reader.readable())
+        finally:
+            reader.close()
+            os.close(pty_w)
+
+    def test_drain_output(self):
+        console.safe_write(b'x' * 500000)
+        self.assertTrue(self.writer.writable())
+
+        received = []
+
+        def read_everything():
+            while sum(map(len, received)) < 500000:
+                received.append(os.read(self.r, 65536))
+
+        reader = threading.Thread(target=read_everything)
+        reader.start()
+        console.drain_output()
+        reader.join()
+        self.assertFalse(self.writer.writable())
+        self.assertEqual(b''.join(received), b'x' * 500000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -292,3 +292,100 @@ localhost : appended to the log
         child.expect('waiting \(3/3\)> ')
         child.sendintr()
         child.expect(pexpect.EOF)
+
+    def testShowReadStats(self):
+        child = launch_polysh(['localhost'] * 2)
+        child.expect('ready \(2\)> ')
+        child.sendline('seq 10000 > /dev/null')
+        child.expect('ready \(2\)> ')
+        child.sendline(':show_read_st\t')
+        stats = ' +[0-9]+ bytes +in [0-9]+ reads: +[0-9]+ bytes/read, +read size'
+        child.expect('localhost ' + stats)
+        child.expect('localhost#1' + stats)
+        child.expect('ready \(2\)> ')
+        child.sendeof()
+        child.expect(pexpect.EOF)
+
+    def testSetAggregate(self):
+        child = launch_polysh(['localhost'] * 2)
+        child.expect('ready \(2\)> ')
+        child.sendline(':set_aggregate y')
+        child.expect('ready \(2\)> ')
+        child.sendline('echo same')
+        child.expect('localhost localhost#1 \(2 hosts\):\r\nsame')
+        child.expect('ready \(2\)> ')
+        child.sendline(':set_aggregate n')
+        child.expect('ready \(2\)> ')
+        child.sendline('echo separate')
+        child.expect('localhost   : \033\[1;mseparate')
+        child.expect('ready \(2\)> ')
+        child.sendline(':set_aggregate maybe')
+        child.expect("Expected 'y' or 'n', got: maybe")
+        child.expect('ready \(2\)> ')
+        child.sendeof()
+        child.expect(pexpect.EOF)
+
+    def testStatus(self):
+        child = launch_polysh(['localhost'] * 3)
+        child.expect('ready \(3\)> ')
+        child.sendline(':status')
+        # No command was run yet
+        child.expect('Failed on 0/3 shells')
+        self.assertNotIn('unknown', child.before)
+        child.expect('ready \(3\)> ')
+        child.sendline('exit_with() { return $1; }; '
+                       'exit_with ${POLYSH_RANK:-0}')
+        child.expect('ready \(3\)> ')
+        child.sendline(':export_vars')
+        child.expect('ready \(3\)> ')
+        child.sendline('exit_with $POLYSH_RANK')
+        child.expect('ready \(3\)> ')
+        child.sendline(':status')
+        child.expect('localhost#1 1\r\nlocalhost#2 2\r\n')
+        child.expect('Failed on 2/3 shells: localhost#<1-2>')
+        child.expect('ready \(3\)> ')
+        child.sendline(':status localhost')
+        child.expect('Failed on 0/1 shells')
+        child.expect('ready \(3\)> ')
+        # The commands sent by polysh do not count
+        child.sendline(':rename renamed')
+        child.expect('ready \(3\)> ')
+        child.sendline(':status')
+        child.expect('Failed on 2/3 shells: renamed')
+        child.expect('ready \(3\)> ')
+        # The status of the last line, typed while the first one runs
+        child.sendline('sleep 1; false')
+        child.expect('waiting \(3/3\)> ')
+        child.sendline('true')
+        child.expect('ready \(3\)> ')
+        child.sendline(':status')
+        child.expect('Failed on 0/3 shells')
+        child.expect('ready \(3\)> ')
+        child.sendeof()
+        child.expect(pexpect.EOF)
+
+    def testStragglers(self):
+        child = launch_polysh(['localhost'] * 2)
+        child.expect('ready \(2\)> ')
+        child.sendline(':export_vars')
+        child.expect('ready \(2\)> ')
+        child.sendline('echo previous')
+        child.expect('ready \(2\)> ')
+        child.sendline('[ $POLYSH_RANK = 1 ] && sleep 1h')
+        child.expect('waiting \(1/2\)> ')
+        child.sendline(':stragglers')
+        # Nothing printed by the running command yet
+        child.expect('localhost#1 [0-9]+\.[0-9]{3}s *\r\n')
+        child.expect('Done on 1/2 shells: p50 [0-9.]+s p95 [0-9.]+s '
+                     'p99 [0-9.]+s max [0-9.]+s')
+        child.expect('waiting \(1/2\)> ')
+        child.sendline(':stragglers nope')
+        child.expect('Expected a number, got: nope')
+        child.expect('waiting \(1/2\)> ')
+        child.sendintr()
+        child.expect('ready \(2\)> ')
+        child.sendline(':stragglers')
+        child.expect('Done on 2/2 shells')
+        child.expect('ready \(2\)> ')
+        child.sendeof()
+        child.expect(pexpect.EOF)
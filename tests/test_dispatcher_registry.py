@@ -45,6 +45,7 @@ class TestDispatcherRegistry(unittest.TestCase):
         self._fds = []
         dispatcher_registry._dispatchers.clear()
         dispatcher_registry._current_events.clear()
+        dispatcher_registry._dirty.clear()
         dispatcher_registry._selector.close()
         dispatcher_registry._selector = selectors.DefaultSelector()
 
@@ -200,6 +201,40 @@ class TestDispatcherRegistry(unittest.TestCase):
         self.assertIsNone(dispatcher_registry.get_dispatcher(r1))
         self.assertIs(dispatcher_registry.get_dispatcher(r2), d2)
 
+    def test_register_marks_dirty(self):
+        r, w = self._make_pipe()
+        d = FakeDispatcher(r)
+        dispatcher_registry.register(r, d)
+
+        self.assertEqual(dispatcher_registry.pop_dirty(), [d])
+        # pop_dirty() resets the dirty set
+        self.assertEqual(dispatcher_registry.pop_dirty(), [])
+
+    def test_mark_dirty(self):
+        r1, w1 = self._make_pipe()
+        r2, w2 = self._make_pipe()
+        d1 = FakeDispatcher(r1)
+        d2 = FakeDispatcher(r2)
+        dispatcher_registry.register(r1, d1)
+        dispatcher_registry.register(r2, d2)
+        dispatcher_registry.pop_dirty()
+
+        dispatcher_registry.mark_dirty(r2)
+        dispatcher_registry.mark_dirty(r2)
+        self.assertEqual(dispatcher_registry.pop_dirty(), [d2])
+
+    def test_mark_dirty_unknown_fd_is_noop(self):
+        dispatcher_registry.mark_dirty(99999)
+        self.assertEqual(dispatcher_registry.pop_dirty(), [])
+
+    def test_unregister_clears_dirty(self):
+        r, w = self._make_pipe()
+        d = FakeDispatcher(r)
+        dispatcher_registry.register(r, d)
+        dispatcher_registry.unregister(r)
+
+        self.assertEqual(dispatcher_registry.pop_dirty(), [])
+
     def test_get_dispatcher_returns_none_for_unknown(self):
         self.assertIsNone(dispatcher_registry.get_dispatcher(99999))
 
@@ -19,10 +19,11 @@ Copyright (c) 2024 InnoGames GmbH
 
 import os
 import selectors
+import time
 import unittest
 
-from polysh import dispatcher_registry
-from polysh.event_loop import loop_iteration
+from polysh import dispatcher_registry, event_loop
+from polysh.event_loop import call_later, loop_iteration
 
 
 class FakeDispatcher:
@@ -76,15 +77,30 @@ class SelfUnregisteringDispatcher(FakeDispatcher):
         dispatcher_registry.unregister(self.fd)
 
 
+class CountingDispatcher(FakeDispatcher):
+    """Dispatcher that counts how often its interest is polled."""
+
+    def __init__(self, fd, readable=True, writable=False):
+        super().__init__(fd, readable, writable)
+        self.readable_called = 0
+
+    def readable(self):
+        self.readable_called += 1
+        return super().readable()
+
+
 class TestEventLoop(unittest.TestCase):
     def setUp(self):
         self._fds = []
         dispatcher_registry._dispatchers.clear()
         dispatcher_registry._current_events.clear()
+        dispatcher_registry._dirty.clear()
         dispatcher_registry._selector.close()
         dispatcher_registry._selector = selectors.DefaultSelector()
+        event_loop._timers.clear()
 
     def tearDown(self):
+        event_loop._timers.clear()
         for fd in list(dispatcher_registry._dispatchers):
             dispatcher_registry.unregister(fd)
         dispatcher_registry._selector.close()
@@ -203,6 +219,50 @@ class TestEventLoop(unittest.TestCase):
         loop_iteration(timeout=0.05)
         self.assertEqual(d.read_called, read_count)
 
+    def test_idle_dispatchers_not_polled(self):
+        """Only dirty or just dispatched dispatchers are asked for their
+        interest."""
+        r1, w1 = self._make_pipe()
+        r2, w2 = self._make_pipe()
+
+        d1 = CountingDispatcher(r1)
+        d2 = CountingDispatcher(r2)
+        dispatcher_registry.register(r1, d1)
+        dispatcher_registry.register(r2, d2)
+
+        loop_iteration(timeout=0.01)
+        self.assertEqual(d1.readable_called, 1)
+        self.assertEqual(d2.readable_called, 1)
+
+        # Nothing happened, nobody is polled again
+        loop_iteration(timeout=0.01)
+        self.assertEqual(d1.readable_called, 1)
+        self.assertEqual(d2.readable_called, 1)
+
+        # d1 gets an event and is re-evaluated on the next iteration
+        os.write(w1, b'data')
+        loop_iteration(timeout=0.1)
+        loop_iteration(timeout=0.01)
+        self.assertEqual(d1.readable_called, 2)
+        self.assertEqual(d2.readable_called, 1)
+
+    def test_mark_dirty_updates_registration(self):
+        """An interest change reported through mark_dirty() is applied."""
+        r, w = self._make_pipe()
+
+        d = FakeDispatcher(w, readable=False, writable=False)
+        dispatcher_registry.register(w, d)
+        loop_iteration(timeout=0.01)
+        self.assertEqual(d.write_called, 0)
+
+        d._writable = True
+        loop_iteration(timeout=0.01)
+        self.assertEqual(d.write_called, 0)
+
+        dispatcher_registry.mark_dirty(w)
+        loop_iteration(timeout=0.1)
+        self.assertEqual(d.write_called, 1)
+
     def test_multiple_dispatchers_independent(self):
         """Multiple dispatchers should be handled independently."""
         r1, w1 = self._make_pipe()
@@ -219,6 +279,41 @@ class TestEventLoop(unittest.TestCase):
         self.assertGreaterEqual(d1.read_called, 1)
         self.assertEqual(d2.read_called, 0)
 
+    def test_timer_wakes_up_select(self):
+        """select() must not sleep past the next timer deadline."""
+        r, w = self._make_pipe()
+        d = FakeDispatcher(r)
+        dispatcher_registry.register(r, d)
+        called = []
+        call_later(0.05, lambda: called.append(True))
+
+        start = time.monotonic()
+        loop_iteration(timeout=5)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(called, [True])
+        self.assertEqual(d.read_called, 0)
+
+    def test_timers_run_in_deadline_order(self):
+        called = []
+        call_later(0.02, lambda: called.append(2))
+        call_later(0.01, lambda: called.append(1))
+        call_later(0.01, lambda: called.append('1bis'))
+
+        while len(called) < 3:
+            loop_iteration()
+        self.assertEqual(called, [1, '1bis', 2])
+
+    def test_cancelled_timer_not_run(self):
+        called = []
+        timer = call_later(0.01, lambda: called.append(True))
+        timer.cancel()
+
+        # Without other timers, the cancelled one must not bound the timeout
+        start = time.monotonic()
+        loop_iteration(timeout=0.05)
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertEqual(called, [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,96 @@
+"""Polysh - Tests - Fork Server
+
+Unit tests for the helper process starting the remote shells.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import selectors
+import unittest
+
+from polysh import dispatcher_registry, forkserver
+from polysh.event_loop import loop_iteration
+
+
+class TestForkServer(unittest.TestCase):
+    def setUp(self):
+        dispatcher_registry._dispatchers.clear()
+        dispatcher_registry._current_events.clear()
+        dispatcher_registry._dirty.clear()
+        dispatcher_registry._selector.close()
+        dispatcher_registry._selector = selectors.DefaultSelector()
+        forkserver.launch()
+        self.server_pid = forkserver._server.pid
+
+    def tearDown(self):
+        if forkserver.running():
+            forkserver._server.handle_close()
+        os.waitpid(self.server_pid, 0)
+        forkserver._statuses.clear()
+        forkserver._watchers.clear()
+
+    def _read_all(self, fd):
+        output = b''
+        while True:
+            try:
+                data = os.read(fd, 1024)
+            except OSError:
+                # EIO once the process closed the pty
+                break
+            if not data:
+                break
+            output += data
+        os.close(fd)
+        return output
+
+    def test_wait(self):
+        pid, fd = forkserver.start(['sh', '-c', 'echo hello; exit 3'], '')
+        watcher = forkserver.watch(pid, self.fail)
+        self.assertEqual(self._read_all(fd), b'hello\r\n')
+        status = watcher.wait()
+        self.assertEqual(os.WEXITSTATUS(status), 3)
+        # The callback is not called once waited for
+        for _ in range(5):
+            loop_iteration(timeout=0.01)
+
+    def test_callback(self):
+        statuses = []
+        pid, fd = forkserver.start(None, 'exit 4')
+        forkserver.watch(pid, statuses.append)
+        self._read_all(fd)
+        for _ in range(100):
+            if statuses:
+                break
+            loop_iteration(timeout=0.1)
+        self.assertEqual([os.WEXITSTATUS(s) for s in statuses], [4])
+
+    def test_server_gone(self):
+        statuses = []
+        pid, fd = forkserver.start(['sleep', '60'], '')
+        forkserver.watch(pid, statuses.append)
+        forkserver._server.handle_close()
+        self.assertFalse(forkserver.running())
+        for _ in range(5):
+            loop_iteration(timeout=0.01)
+        self.assertEqual(statuses, [forkserver._LOST_STATUS])
+        with self.assertRaises(OSError):
+            forkserver.start(['true'], '')
+        os.kill(pid, 9)
+        os.close(fd)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,6 +19,7 @@ Copyright (c) 2024 InnoGames GmbH
 import unittest
 import pexpect
 
+from polysh.host_syntax import compress_syntax, expand_syntax
 from tests import launch_polysh
 
 
@@ -63,3 +64,20 @@ class TestHostSyntax(unittest.TestCase):
         self.assertHostSyntax('0.0.0.<1>', ['0.0.0.1'])
         self.assertHostSyntax('0.0.0.<1,3-5>',
                               ['0.0.0.1', '0.0.0.3', '0.0.0.4', '0.0.0.5'])
+
+    def assertCompressed(self, strings, compressed):
+        self.assertEqual(compress_syntax(strings), compressed)
+        expanded = [e for c in compressed for e in expand_syntax(c)]
+        self.assertEqual(sorted(expanded), sorted(set(strings)))
+
+    def testCompressSyntax(self):
+        self.assertCompressed(['web1', 'web2', 'web3', 'web5'],
+                              ['web<1-3,5>'])
+        self.assertCompressed(['db09', 'db10', 'db08', 'db12'],
+                              ['db<08-10,12>'])
+        self.assertCompressed(['0.0.1.01', '0.0.1.02', '0.0.2.01'],
+                              ['0.0.1.<01-02>', '0.0.2.01'])
+        self.assertCompressed(['a9', 'a10', 'a9.b', 'localhost', 'a10.b'],
+                              ['a<9-10>', 'a<9-10>.b', 'localhost'])
+        self.assertCompressed(['h0', 'h00', 'h1'], ['h<0-1>', 'h00'])
+        self.assertCompressed(['x1', 'x1'], ['x1'])
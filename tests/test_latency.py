@@ -0,0 +1,80 @@
+"""Polysh - Tests - Command Latency
+
+Unit tests for the latency distribution of the commands.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from polysh import latency
+
+
+class TestLatency(unittest.TestCase):
+    def setUp(self):
+        latency._nr_running = 0
+        del latency._latencies[:]
+        latency._shards.clear()
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(latency.percentile(values, 50), 50)
+        self.assertEqual(latency.percentile(values, 95), 95)
+        self.assertEqual(latency.percentile(values, 99), 99)
+        self.assertEqual(latency.percentile([7], 99), 7)
+        self.assertEqual(latency.percentile([1, 2], 0), 1)
+
+    def test_summary(self):
+        for _ in range(3):
+            latency.command_started()
+        self.assertEqual(latency.summary(), 'Done on 0/3 shells')
+        latency.command_done(2.0)
+        latency.command_done(0.5)
+        self.assertEqual(
+            latency.summary(),
+            'Done on 2/3 shells: '
+            'p50 0.500s p95 2.000s p99 2.000s max 2.000s',
+        )
+        latency.command_done(1.0)
+        self.assertEqual(
+            latency.summary(),
+            'Done on 3/3 shells: '
+            'p50 1.000s p95 2.000s p99 2.000s max 2.000s',
+        )
+        # The next command starts from scratch
+        latency.command_started()
+        self.assertEqual(latency.summary(), 'Done on 0/1 shells')
+
+    def test_summary_of_shards(self):
+        latency.set_shard_state(0, 1, [2.0])
+        latency.set_shard_state(1, 0, [0.5, 1.0])
+        self.assertEqual(
+            latency.summary(),
+            'Done on 3/4 shells: '
+            'p50 1.000s p95 2.000s p99 2.000s max 2.000s',
+        )
+
+    def test_current(self):
+        latency.command_started()
+        nr_commands, nr_running, latencies = latency.current()
+        self.assertEqual(nr_running, 1)
+        latency.command_done(1.0)
+        self.assertEqual(latency.current(), (nr_commands, 0, [1.0]))
+        latency.command_started()
+        self.assertEqual(latency.current(), (nr_commands + 1, 1, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""Polysh - Tests - Log Writer
+
+Unit tests for the background log writer.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import os
+import selectors
+import tempfile
+import unittest
+
+from polysh import dispatcher_registry
+from polysh.event_loop import loop_iteration
+from polysh.exceptions import ExitNow
+from polysh.log_writer import LogWriter
+
+
+class TestLogWriter(unittest.TestCase):
+    def setUp(self):
+        dispatcher_registry._dispatchers.clear()
+        dispatcher_registry._current_events.clear()
+        dispatcher_registry._dirty.clear()
+        dispatcher_registry._selector.close()
+        dispatcher_registry._selector = selectors.DefaultSelector()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'polysh.log')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_appends_in_order(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'before\n')
+        writer = LogWriter(self.path)
+        for i in range(1000):
+            writer.write(f'line {i}\n'.encode())
+        writer.close()
+        expected = b'before\n' + b''.join(
+            f'line {i}\n'.encode() for i in range(1000)
+        )
+        self.assertEqual(self._read(self.path), expected)
+        # The notification pipe is gone with the thread
+        self.assertEqual(dispatcher_registry.all_dispatchers(), [])
+
+    def test_close_without_writes(self):
+        writer = LogWriter(self.path)
+        writer.close()
+        writer.close()
+        self.assertEqual(self._read(self.path), b'')
+
+    def test_compress(self):
+        writer = LogWriter(self.path, compress=True)
+        writer.write(b'first\n')
+        writer.close()
+        writer = LogWriter(self.path, compress=True)
+        writer.write(b'second\n')
+        writer.close()
+        self.assertEqual(
+            gzip.decompress(self._read(self.path)), b'first\nsecond\n'
+        )
+
+    def test_rotation(self):
+        writer = LogWriter(self.path, max_size=100)
+        writer.write(b'a' * 150)
+        writer.close()
+        writer = LogWriter(self.path, max_size=100)
+        writer.write(b'b' * 10)
+        writer.close()
+        self.assertEqual(self._read(self.path + '.1'), b'a' * 150)
+        self.assertEqual(self._read(self.path), b'b' * 10)
+
+    def test_rotation_by_another_process(self):
+        writer = LogWriter(self.path, max_size=100)
+        os.rename(self.path, self.path + '.1')
+        with open(self.path, 'wb') as f:
+            f.write(b'new\n')
+        writer.write(b'a' * 150)
+        writer.close()
+        # The file renamed by the other process is not rotated again
+        self.assertEqual(self._read(self.path + '.1'), b'a' * 150)
+        self.assertEqual(self._read(self.path), b'new\n')
+
+    @unittest.skipUnless(os.path.exists('/dev/full'), 'no /dev/full')
+    def test_write_error_exits(self):
+        writer = LogWriter('/dev/full')
+        writer.write(b'something\n')
+        with self.assertRaises(ExitNow):
+            for _ in range(50):
+                loop_iteration(timeout=0.1)
+        with self.assertRaises(ExitNow):
+            writer.write(b'more\n')
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,6 +16,10 @@ Copyright (c) 2024 InnoGames GmbH
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import subprocess
+import sys
+import time
 import unittest
 import pexpect
 
@@ -68,6 +72,153 @@ class TestNonInteractive(unittest.TestCase):
         CommandCode('true', 0)
         CommandCode('false', 1)
 
+    def testWorkers(self):
+        child = launch_polysh(
+            ['--workers=2', '--command=echo text', 'localhost', 'localhost'])
+        child.expect('\033\[1;36mlocalhost   : \033\[1;mtext')
+        child.expect(pexpect.EOF)
+        child = launch_polysh(
+            ['--workers=2', '--command=echo text', 'localhost', 'localhost'])
+        child.expect('\033\[1;35mlocalhost#1 : \033\[1;mtext')
+        child.expect(pexpect.EOF)
+        child = launch_polysh(
+            ['--workers=3', '--command=echo text; cat'] + ['localhost'] * 3)
+        child.expect('localhost#2 : \033\[1;mtext')
+        child.sendintr()
+        child.expect(pexpect.EOF)
+        child = launch_polysh(
+            ['--workers=2', '--command=false'] + ['localhost'] * 3)
+        child.expect(pexpect.EOF)
+        while child.isalive():
+            child.wait()
+        self.assertEqual(child.exitstatus, 1)
+
+    def testAggregate(self):
+        child = launch_polysh(
+            ['--aggregate', '--command=echo text'] + ['localhost'] * 3)
+        child.expect('localhost localhost#<1-2> \(3 hosts\):\r\ntext\r\n')
+        child.expect(pexpect.EOF)
+        child = launch_polysh(
+            ['--aggregate', '--workers=2', '--command=true', 'localhost'])
+        child.expect('--workers and --aggregate are incompatible')
+        child.expect(pexpect.EOF)
+
+    def testFormatJsonl(self):
+        child = launch_polysh(
+            ['--format=jsonl', '--command=echo text; exit 3'] +
+            ['localhost'] * 2)
+        child.expect(pexpect.EOF)
+        while child.isalive():
+            child.wait()
+        self.assertEqual(child.exitstatus, 3)
+        records = [json.loads(line) for line in child.before.splitlines()]
+        lines = [(r['display_name'], r['line']) for r in records
+                 if r['stream'] == 'stdout' and r['line'] == 'text']
+        self.assertEqual(sorted(lines), [('localhost', 'text'),
+                                         ('localhost#1', 'text')])
+        exits = [r for r in records if r['stream'] == 'exit']
+        self.assertEqual(len(exits), 2)
+        for r in exits:
+            self.assertEqual(r['host'], 'localhost')
+            self.assertEqual(r['exit_status'], 3)
+            # The shell exited before showing the status in its prompt
+            self.assertIsNone(r['command_status'])
+            self.assertLessEqual(r['start'], r['ready'])
+            self.assertLessEqual(r['ready'], r['ts'])
+
+    def testCommandStatus(self):
+        child = launch_polysh(
+            ['--format=jsonl', '--command=(exit 4)'] + ['localhost'])
+        child.expect('"command_status":4')
+        child.expect(pexpect.EOF)
+
+    def testMaxHandshakes(self):
+        child = launch_polysh(
+            ['--max-handshakes=1', '--connect-rate=20', '--format=jsonl',
+             '--command=true'] + ['localhost'] * 3)
+        child.expect(pexpect.EOF)
+        records = [json.loads(line) for line in child.before.splitlines()]
+        exits = sorted((r for r in records if r['stream'] == 'exit'),
+                       key=lambda r: r['start'])
+        self.assertEqual([r['display_name'] for r in exits],
+                         ['localhost', 'localhost#1', 'localhost#2'])
+        for prev, r in zip(exits, exits[1:]):
+            # Started once the previous host was done connecting
+            self.assertLessEqual(prev['ready'], r['start'])
+
+    def testParallel(self):
+        child = launch_polysh(
+            ['--parallel=2', '--format=jsonl', '--command=sleep 0.5'] +
+            ['localhost'] * 5)
+        child.expect(pexpect.EOF)
+        records = [json.loads(line) for line in child.before.splitlines()]
+        exits = [r for r in records if r['stream'] == 'exit']
+        self.assertEqual(len(exits), 5)
+        for r in exits:
+            alive = [o for o in exits
+                     if o['start'] <= r['start'] < o['ts']]
+            self.assertLessEqual(len(alive), 2)
+        child = launch_polysh(['--parallel=2', 'localhost'])
+        child.expect('--parallel requires non-interactive mode')
+        child.expect(pexpect.EOF)
+
+    def testParallelNames(self):
+        # The same host started after the previous one is gone keeps its
+        # own name and alignment
+        child = launch_polysh(
+            ['--parallel=1', '--format=jsonl', '--command=echo hi'] +
+            ['localhost'] * 3)
+        child.expect(pexpect.EOF)
+        records = [json.loads(line) for line in child.before.splitlines()]
+        names = [r['display_name'] for r in records if r['stream'] == 'exit']
+        self.assertEqual(names, ['localhost', 'localhost#1', 'localhost#2'])
+        child = launch_polysh(
+            ['--parallel=1', '--command=echo hi'] + ['localhost'] * 3)
+        child.expect('localhost   : \033\\[1;mhi')
+        child.expect('localhost#1 : \033\\[1;mhi')
+        child.expect('localhost#2 : \033\\[1;mhi')
+        child.expect(pexpect.EOF)
+
+    def testSlowStdout(self):
+        # A reader slower than the remote shells congests the console, the
+        # lines must not be split meanwhile
+        process = subprocess.Popen(
+            ['uv', 'run', 'polysh', '--command=seq 1 50000'] +
+            ['localhost'] * 3,
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        time.sleep(2)
+        output = process.communicate(timeout=120)[0].decode()
+        lines = output.splitlines()
+        self.assertEqual(len(lines), 150000)
+        for line in lines:
+            self.assertRegex(line, r'^localhost(#[12])? *: [0-9]+$')
+        numbers = sorted(int(line.split(': ')[1]) for line in lines)
+        self.assertEqual(numbers, sorted(list(range(1, 50001)) * 3))
+
+    def testRunAsync(self):
+        # Embedded in an application running its own asyncio event loop
+        script = '''
+import asyncio, sys
+from polysh.main import run_async
+
+async def main():
+    ticks = []
+    loop = asyncio.get_running_loop()
+    loop.call_later(0.1, ticks.append, 1)
+    code = await run_async(sys.argv[1:])
+    print(f'exit code {code}, ticks {len(ticks)}', flush=True)
+
+asyncio.run(main())
+'''
+        output = subprocess.run(
+            [sys.executable, '-c', script,
+             '--command=sleep 0.5; echo hello; false', 'localhost'],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, timeout=60,
+        ).stdout.decode()
+        self.assertEqual(
+            output, 'localhost : hello\nexit code 1, ticks 1\n'
+        )
+
     def testInvalidCharacters(self):
         child = launch_polysh(
             ["--command=printf '%b' '\xacfoo\u2018bar\n'", 'localhost'])
@@ -0,0 +1,46 @@
+"""Polysh - Tests - Sharded Fan-out
+
+Unit tests for the split of the remote shells across the workers.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from polysh import sharding
+
+
+class TestSharding(unittest.TestCase):
+    def test_share(self):
+        self.assertEqual(
+            [sharding._share(5, 2, shard) for shard in range(2)], [3, 2]
+        )
+        self.assertEqual(
+            [sharding._share(4, 4, shard) for shard in range(4)], [1] * 4
+        )
+
+    def test_shares_sum_to_the_limit(self):
+        for limit in range(1, 50):
+            for nr_workers in range(1, limit + 1):
+                shares = [
+                    sharding._share(limit, nr_workers, shard)
+                    for shard in range(nr_workers)
+                ]
+                self.assertEqual(sum(shares), limit)
+                self.assertGreaterEqual(min(shares), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
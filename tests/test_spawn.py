@@ -0,0 +1,87 @@
+"""Polysh - Tests - SSH Process Spawning
+
+Unit tests for the parsing of the --ssh template and the spawned processes.
+
+Copyright (c) 2024 InnoGames GmbH
+"""
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import unittest
+
+from polysh import spawn
+
+DEFAULT_SSH = 'exec ssh -oLogLevel=Quiet -t %(host)s %(port)s'
+
+
+class TestSshArgs(unittest.TestCase):
+    def test_default_template(self):
+        self.assertEqual(
+            spawn.ssh_args(DEFAULT_SSH, 'web1', ''),
+            ['ssh', '-oLogLevel=Quiet', '-t', 'web1'],
+        )
+        self.assertEqual(
+            spawn.ssh_args(DEFAULT_SSH, 'root@web1', '-p 2222'),
+            ['ssh', '-oLogLevel=Quiet', '-t', 'root@web1', '-p', '2222'],
+        )
+
+    def test_host_appended(self):
+        self.assertEqual(
+            spawn.ssh_args("ssh -o 'ProxyJump bastion'", 'web1', ''),
+            ['ssh', '-o', 'ProxyJump bastion', 'web1'],
+        )
+
+    def test_shell_needed(self):
+        for template in (
+            'usleep $((RANDOM*50)); exec ssh',
+            'ssh %(host)s 2> /dev/null',
+            'LC_ALL=C ssh',
+            "ssh 'unbalanced",
+            '',
+        ):
+            self.assertIsNone(spawn.ssh_args(template, 'web1', ''), template)
+
+    def _output(self, pid, fd):
+        output = b''
+        while True:
+            try:
+                data = os.read(fd, 1024)
+            except OSError:
+                # EIO once the child closed the pty
+                break
+            if not data:
+                break
+            output += data
+        os.close(fd)
+        _, status = os.waitpid(pid, 0)
+        return output, status
+
+    def test_start(self):
+        pid, fd = spawn.start(
+            ['sh', '-c', 'test -t 0 && ps -o sid= -p $$'], 'false'
+        )
+        output, status = self._output(pid, fd)
+        self.assertEqual(status, 0)
+        # A new session
+        self.assertEqual(int(output), pid)
+
+    def test_start_falls_back_to_the_shell(self):
+        pid, fd = spawn.start(['/nonexistent/ssh'], 'echo fallback')
+        output, status = self._output(pid, fd)
+        self.assertEqual(status, 0)
+        self.assertEqual(output, b'fallback\r\n')
+
+
+if __name__ == '__main__':
+    unittest.main()